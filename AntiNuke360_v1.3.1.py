@@ -2,34 +2,69 @@ import os
 import time
 import asyncio
 import json
+import functools
+import hashlib
+import heapq
+import sqlite3
+import threading
+import zlib
+from array import array
 from collections import defaultdict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import discord
 from discord.ext import commands, tasks
 from discord import app_commands
 from dotenv import load_dotenv
 from pathlib import Path
 
-# 新增：MySQL
-import mysql.connector
-from mysql.connector import Error
+# 新增：MySQL（使用 SQLite 後端時可不安裝）
+try:
+    import mysql.connector
+    from mysql.connector import Error, pooling
+except ImportError:  # pragma: no cover - optional dep
+    mysql = None
+    pooling = None
+
+    class Error(Exception):
+        pass
+
+# 選用：zstd 壓縮快照（未安裝時只使用 zlib）
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dep
+    zstandard = None
 
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
 DEVELOPER_ID = 800536911378251787
 
-# 這三個 JSON 不再使用，但保留常數名稱以免其他地方硬編碼
+# 舊版 JSON：黑白名單檔案若仍在工作目錄，啟動時由 import_legacy_json() 匯入儲存後端；
+# 其餘兩個不再使用，但保留常數名稱以免其他地方硬編碼
 BLACKLIST_FILE = "bot_blacklist.json"
 WHITELIST_FILE = "bot_whitelist.json"
 SERVER_WHITELIST_FILE = "server_whitelist.json"
 GUILDS_FILE = "guilds_data.json"
 
-SNAPSHOT_DIR = Path("snapshots")
 SNAPSHOT_TTL_SECONDS = 72 * 3600  # 72 hours
 VERSION = "v1.3.1"  # 版本號
 
-SNAPSHOT_DIR.mkdir(exist_ok=True)
+# 快照壓縮：SNAPSHOT_CODEC=zlib（預設）或 zstd（需安裝 zstandard）
+SNAPSHOT_CODEC = os.getenv("SNAPSHOT_CODEC", "zlib").lower()
+SNAPSHOT_COMPRESS_LEVEL = int(os.getenv("SNAPSHOT_COMPRESS_LEVEL", "6"))
+# 每個伺服器保留的快照世代數；過期（超過 TTL）的世代由背景 GC 批次刪除
+SNAPSHOT_GENERATIONS = max(1, int(os.getenv("SNAPSHOT_GENERATIONS", "5")))
+SNAPSHOT_GC_INTERVAL = int(os.getenv("SNAPSHOT_GC_INTERVAL", "3600"))
+SNAPSHOT_GC_BATCH = max(1, int(os.getenv("SNAPSHOT_GC_BATCH", "500")))
+# 增量快照：變動項目超過基底項目數的這個比例，或基底超過 TTL 的一半時，改存新的完整基底
+SNAPSHOT_DELTA_MAX_RATIO = float(os.getenv("SNAPSHOT_DELTA_MAX_RATIO", "0.5"))
 
-user_actions = defaultdict(lambda: defaultdict(lambda: defaultdict(deque)))
+# 異常行為計數：guild_id -> {(user_id, action_type): ActionCounter}，閒置的計數器由 action_counter_gc_loop 清除
+user_actions = defaultdict(dict)
+# 跨操作類型的威脅分數：guild_id -> {user_id: ThreatScore}，一併由 action_counter_gc_loop 清除
+threat_scores = defaultdict(dict)
+ACTION_COUNTER_GC_INTERVAL = max(10, int(os.getenv("ACTION_COUNTER_GC_INTERVAL", "60")))
 whitelisted_users = defaultdict(set)
 # server_whitelists structure (in-memory):
 # guild_id -> {
@@ -48,11 +83,24 @@ permission_errors = defaultdict(deque)
 # 防止短時間內重複詢問還原
 restore_prompted = defaultdict(lambda: 0)
 
+# 相似訊息模式：以 MinHash 比對近似內容（改幾個字、加隨機尾碼也算同一則）
+HIJACK_SIMILARITY_DEFAULT = os.getenv("ANTI_HIJACK_SIMILARITY", "0") == "1"
+HIJACK_SIMILARITY_THRESHOLD = max(0.1, min(1.0, float(os.getenv("ANTI_HIJACK_SIMILARITY_THRESHOLD", "0.5"))))  # 草圖重疊比例
+HIJACK_SHINGLE_SIZE = 4           # 字元 shingle 長度
+HIJACK_MINHASH_SIZE = 16          # 每則訊息保留最小的幾個 shingle 雜湊
+HIJACK_MINHASH_MATCH = max(1, round(HIJACK_MINHASH_SIZE * HIJACK_SIMILARITY_THRESHOLD))
+HIJACK_MINHASH_MIN_CHARS = 16     # 短於此長度的訊息仍以完全相同比對
+HIJACK_MINHASH_MAX_CHARS = 128    # 只取訊息前段計算，讓每則訊息成本有上限
+
 # 反被盜帳設定
-anti_hijack_settings = defaultdict(lambda: {"enabled": True})
+anti_hijack_settings = defaultdict(lambda: {"enabled": True, "similarity": HIJACK_SIMILARITY_DEFAULT})
 
-# 反被盜帳偵測用：guild_id -> user_id -> content -> deque[(timestamp, channel_id)]
-hijack_tracker = defaultdict(lambda: defaultdict(lambda: defaultdict(deque)))
+# 反被盜帳偵測用：guild_id -> {user_id: HijackWindow}；訊息內容只保留指紋或 MinHash 草圖，閒置的時間窗由 action_counter_gc_loop 清除
+hijack_tracker = defaultdict(dict)
+HIJACK_WINDOW_SECONDS = 5
+HIJACK_MIN_MESSAGES = 3      # 時間窗內相同訊息至少幾則
+HIJACK_MIN_CHANNELS = 3      # 且分佈在至少幾個頻道
+HIJACK_MAX_ENTRIES = 32      # 每個使用者時間窗最多記住幾則訊息
 
 # 固定防護參數
 PROTECTION_CONFIG = {
@@ -76,6 +124,19 @@ SENSITIVE_ACTIONS = {
     "webhook_create"
 }
 
+# 威脅分數：每次敏感操作依權重加分，分數以半衰期指數衰減，超過上限即視為攻擊
+# 可抓到混合多種操作、但每一種都沒超過單一門檻的攻擊（例如刪頻道、建身分組、踢人各 6 次）
+THREAT_WEIGHTS = {
+    "channel_create": 0.5,
+    "channel_delete": 1.0,
+    "member_kick": 1.0,
+    "member_ban": 1.0,
+    "role_create": 0.5,
+    "webhook_create": 1.0,
+}
+THREAT_SCORE_LIMIT = float(os.getenv("THREAT_SCORE_LIMIT", "7.5"))  # 設為 0 停用
+THREAT_SCORE_HALF_LIFE = max(1.0, float(os.getenv("THREAT_SCORE_HALF_LIFE", "10")))  # 秒
+
 # 自訂狀態文字
 STATUS_MESSAGES = [
     "炸？AntiNuke360讓你沒地方炸！",
@@ -111,7 +172,7 @@ ANNOUNCEMENT_WAIT_TIMEOUT = 12 * 3600  # 12 小時等待最新管理員上線
 ANNOUNCEMENT_CHECK_INTERVAL = 60  # 每次檢查間隔（秒）
 pending_announcement_tasks = set()  # 儲存等待 DM 的 asyncio task
 
-# ========== MySQL 連線 & SQL 存取函式 ==========
+# ========== MySQL 連線池 & 儲存後端 ==========
 
 MYSQL_HOST = os.getenv("MYSQL_HOST", "c6f22e13-cd22-42c9-b4e9-6f5055d1aebd")
 MYSQL_PORT = int(os.getenv("MYSQL_PORT", "3306"))
@@ -119,47 +180,298 @@ MYSQL_USER = os.getenv("MYSQL_USER", "")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD", "")
 MYSQL_DB = os.getenv("MYSQL_DB", "")
 
+# 連線池設定：所有 DB 存取都在固定大小的執行緒池中進行，執行緒數 = 連線數，
+# 因此不會在 event loop 上阻塞，也不會把連線池借光
+MYSQL_POOL_NAME = os.getenv("MYSQL_POOL_NAME", "antinuke360")
+MYSQL_POOL_SIZE = max(1, min(32, int(os.getenv("MYSQL_POOL_SIZE", "5"))))  # mysql.connector 上限 32
+MYSQL_POOL_RESET_SESSION = os.getenv("MYSQL_POOL_RESET_SESSION", "1") == "1"
+MYSQL_POOL_PING = os.getenv("MYSQL_POOL_PING", "1") == "1"  # 借出前 ping，斷線自動重連
+MYSQL_CONNECT_TIMEOUT = int(os.getenv("MYSQL_CONNECT_TIMEOUT", "10"))
+
+db_pool = None
+db_pool_lock = threading.Lock()
+db_executor = ThreadPoolExecutor(max_workers=MYSQL_POOL_SIZE, thread_name_prefix="antinuke360-db")
+
+# 連線池使用統計（/status 會顯示）
+db_pool_stats = {"checkouts": 0, "in_use": 0, "peak_in_use": 0, "reconnects": 0, "errors": 0}
+db_pool_stats_lock = threading.Lock()
+
+
+def get_db_pool():
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = pooling.MySQLConnectionPool(
+                pool_name=MYSQL_POOL_NAME,
+                pool_size=MYSQL_POOL_SIZE,
+                pool_reset_session=MYSQL_POOL_RESET_SESSION,
+                host=MYSQL_HOST,
+                port=MYSQL_PORT,
+                user=MYSQL_USER,
+                password=MYSQL_PASSWORD,
+                database=MYSQL_DB,
+                connection_timeout=MYSQL_CONNECT_TIMEOUT,
+            )
+            print(f"[DB] 已建立 MySQL 連線池 {MYSQL_POOL_NAME} (大小: {MYSQL_POOL_SIZE})")
+        return db_pool
+
 
 def get_db_connection():
-    return mysql.connector.connect(
-        host=MYSQL_HOST,
-        port=MYSQL_PORT,
-        user=MYSQL_USER,
-        password=MYSQL_PASSWORD,
-        database=MYSQL_DB,
-        connection_timeout=10,
-    )
+    """從連線池借出一條連線；conn.close() 會把連線歸還連線池而不是真的斷線。"""
+    try:
+        conn = get_db_pool().get_connection()
+    except Error:
+        with db_pool_stats_lock:
+            db_pool_stats["errors"] += 1
+        raise
+    if MYSQL_POOL_PING:
+        try:
+            conn.ping(reconnect=False)
+        except Error:
+            # 連線已失效（例如 MySQL wait_timeout），重連一次
+            with db_pool_stats_lock:
+                db_pool_stats["reconnects"] += 1
+            try:
+                conn.reconnect(attempts=2, delay=1)
+            except Error:
+                conn.close()
+                with db_pool_stats_lock:
+                    db_pool_stats["errors"] += 1
+                raise
+    with db_pool_stats_lock:
+        db_pool_stats["checkouts"] += 1
+        db_pool_stats["in_use"] += 1
+        if db_pool_stats["in_use"] > db_pool_stats["peak_in_use"]:
+            db_pool_stats["peak_in_use"] = db_pool_stats["in_use"]
+    return conn
 
 
-def ensure_snapshots_table():
+@contextmanager
+def db_connection():
+    conn = get_db_connection()
     try:
-        conn = get_db_connection()
+        yield conn
+    finally:
+        try:
+            conn.close()
+        finally:
+            with db_pool_stats_lock:
+                db_pool_stats["in_use"] -= 1
+
+
+async def run_db(func, *args):
+    """在 DB 執行緒池中執行阻塞的存取函式，避免卡住 event loop。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args))
+
+
+# ========== 儲存後端 ==========
+# STORAGE_BACKEND=mysql（預設）或 sqlite。SQLite 以 WAL 模式執行，
+# 不需要資料庫伺服器即可在單機上執行或做壓力測試。
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "mysql").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "antinuke360.db")
+
+DB_ERRORS = (Error, sqlite3.Error)
+
+# server_whitelist_entries 的 list_type 與記憶體結構的 key 相同
+SERVER_WHITELIST_LIST_TYPES = ("anti_kick", "temporary", "permanent")
+
+# write-behind 各種變更的刪除語句（兩種後端語法相同）；server_guild 會清空該伺服器所有白名單資料，
+# 必須排在最前面執行
+PERSIST_DELETE_SQL = {
+    "server_guild": [
+        "DELETE FROM server_whitelist_entries WHERE guild_id = %s",
+        "DELETE FROM server_settings WHERE guild_id = %s",
+    ],
+    "blacklist": ["DELETE FROM bot_blacklist WHERE bot_id = %s"],
+    "whitelist": ["DELETE FROM bot_whitelist WHERE bot_id = %s"],
+    "server_whitelist": ["DELETE FROM server_whitelist_entries WHERE guild_id = %s AND list_type = %s AND user_id = %s"],
+    "server_settings": ["DELETE FROM server_settings WHERE guild_id = %s"],
+    "guilds": ["DELETE FROM guilds_data WHERE guild_id = %s"],
+}
+
+
+class StorageBackend:
+    """
+    儲存後端介面：全域黑白名單、server_whitelist、guilds_data 與快照。
+    所有方法都是阻塞呼叫，請在 DB 執行緒池（run_db）中使用；失敗時拋出 DB_ERRORS。
+    """
+
+    name = "base"
+    label = "base"
+
+    def ensure_schema(self):
+        raise NotImplementedError
+
+    def load_blacklist(self) -> dict:
+        raise NotImplementedError
+
+    def load_whitelist(self) -> dict:
+        raise NotImplementedError
+
+    def load_server_whitelist(self, now: float):
+        """回傳 (entries, settings) 兩個 list[dict]；已過期的臨時白名單在讀取前刪除。"""
+        raise NotImplementedError
+
+    def load_guilds_data(self) -> dict:
+        raise NotImplementedError
+
+    def write_batch(self, batch: dict):
+        """以單一交易寫入 write-behind 合併後的變更：{(kind, *key): (op, params)}。"""
+        raise NotImplementedError
+
+    def bulk_upsert(self, kind: str, rows: list):
+        raise NotImplementedError
+
+    def save_snapshot(self, guild_id: int, format_version: int, blob: bytes, raw_size: int, created_at: float, keep: int,
+                      base_id: int = None, struct_hash: str = None, pinned: int = None):
+        """
+        新增一個快照世代（base_id 不為 None 時為增量快照），並只保留該伺服器最新的 keep 個世代；
+        仍被保留世代引用的基底，以及 pinned 世代（與其基底）不會被刪除，也不佔 keep 的名額。回傳新世代的 id。
+        """
+        raise NotImplementedError
+
+    def load_snapshot(self, guild_id: int, snapshot_id: int = None):
+        """
+        回傳快照資料列 dict（id, created_at, base_id, struct_hash, format_version, snapshot_data, snapshot_json,
+        raw_size, stored_size；增量快照另有 base 欄位放基底資料列），
+        snapshot_id 為 None 時取最新世代；不存在時回傳 None。資料不在此解壓縮。
+        """
+        raise NotImplementedError
+
+    def latest_snapshot_meta(self, guild_id: int):
+        """回傳最新世代的中繼資料（不含快照內容），不存在時回傳 None。"""
+        raise NotImplementedError
+
+    def touch_snapshot(self, snapshot_id: int, created_at: float):
+        """結構未變時只更新世代的 created_at，讓它繼續有效。"""
+        raise NotImplementedError
+
+    def list_snapshots(self, guild_id: int) -> list:
+        """回傳該伺服器所有世代的中繼資料（不含快照內容），由新到舊。"""
+        raise NotImplementedError
+
+    def delete_expired_snapshots(self, cutoff: float, batch_size: int) -> int:
+        """
+        以每批 batch_size 筆刪除 created_at 早於 cutoff 的世代，回傳刪除筆數。
+        仍被未過期增量快照引用的基底會保留。
+        """
+        raise NotImplementedError
+
+    def snapshot_totals(self) -> dict:
+        """回傳所有快照的 {"count", "raw_size", "stored_size"} 合計。"""
+        raise NotImplementedError
+
+    def start_restore_run(self, guild_id: int, plan_id: str, snapshot_id: int, mode: str, started_at: float):
+        """登記一次新的還原（每個伺服器只保留一筆），並清掉該伺服器舊的操作紀錄。"""
+        raise NotImplementedError
+
+    def record_restore_ops(self, guild_id: int, plan_id: str, ops: list):
+        """寫入已完成的還原操作：ops 為 [(op_key, result_id, completed_at)]。"""
+        raise NotImplementedError
+
+    def load_restore_runs(self, guild_id: int = None) -> list:
+        """回傳尚未完成的還原（guild_id, plan_id, snapshot_id, mode, started_at），ops 欄位為 {op_key: result_id}。"""
+        raise NotImplementedError
+
+    def finish_restore_run(self, guild_id: int, plan_id: str):
+        """還原完成後刪除該次還原與其操作紀錄。"""
+        raise NotImplementedError
+
+
+class SQLStorageBackend(StorageBackend):
+    """MySQL 與 SQLite 共用的 SQL 實作；子類別提供連線、參數符號、DDL 與 upsert 語法。"""
+
+    schema_sql = []
+    upsert_sql = {}
+
+    def connection(self):
+        raise NotImplementedError
+
+    def prepare(self, sql: str) -> str:
+        return sql
+
+    # 舊版資料表缺少時以 ALTER TABLE 補上的欄位：{table: {column: ddl}}
+    added_columns = {}
+
+    def fetch_all(self, conn, sql: str, params=()):
+        raise NotImplementedError
+
+    def table_exists(self, conn, table: str) -> bool:
+        raise NotImplementedError
+
+    def table_columns(self, conn, table: str) -> dict:
+        """回傳 {欄位名稱: 是否 NOT NULL}。"""
+        raise NotImplementedError
+
+    def ensure_columns(self, conn):
         cursor = conn.cursor()
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS snapshots (
-                guild_id BIGINT PRIMARY KEY,
-                snapshot_json LONGTEXT NOT NULL,
-                updated_at DOUBLE
-            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
-            """
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("[DB] 已確認 snapshots 資料表存在。")
-    except Error as e:
-        print(f"[DB ERROR] 建立/確認 snapshots 表失敗: {e}")
+        try:
+            for table, columns in self.added_columns.items():
+                if not self.table_exists(conn, table):
+                    continue
+                existing = self.table_columns(conn, table)
+                for column, ddl in columns.items():
+                    if column not in existing:
+                        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+                        print(f"[DB] 已為 {table} 新增欄位 {column}")
+            conn.commit()
+        finally:
+            cursor.close()
 
+    def migrate(self, conn):
+        self.ensure_columns(conn)
+        self.migrate_legacy_snapshots(conn)
 
-def load_blacklist():
-    """從 MySQL 載入全域黑名單到記憶體 dict，結構維持與舊 JSON 一樣。"""
-    data = {}
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT bot_id, name, reason, timestamp, guilds_detected FROM bot_blacklist")
-        for row in cursor.fetchall():
+    def migrate_legacy_snapshots(self, conn):
+        """
+        舊版 snapshots 表每個伺服器只有一列；snapshot_generations 為空時把它們搬過來當作第一個世代。
+        搬移後舊表改名為 snapshots_legacy，之後啟動不會再搬一次（世代全部過期後也不會把舊快照搬回來）。
+        """
+        if not self.table_exists(conn, "snapshots"):
+            return
+        copy = not self.fetch_all(conn, "SELECT id FROM snapshot_generations LIMIT 1")
+        cursor = conn.cursor()
+        try:
+            copied = 0
+            if copy:
+                cursor.execute(
+                    "INSERT INTO snapshot_generations "
+                    "(guild_id, created_at, format_version, snapshot_data, snapshot_json, raw_size, stored_size) "
+                    "SELECT guild_id, COALESCE(updated_at, 0), format_version, snapshot_data, snapshot_json, raw_size, stored_size "
+                    "FROM snapshots"
+                )
+                copied = cursor.rowcount
+                conn.commit()
+            if self.table_exists(conn, "snapshots_legacy"):
+                cursor.execute("DROP TABLE snapshots")
+            else:
+                cursor.execute("ALTER TABLE snapshots RENAME TO snapshots_legacy")
+            conn.commit()
+            if copied:
+                print(f"[DB] 已將舊 snapshots 表的 {copied} 份快照搬移至 snapshot_generations")
+            print("[DB] 舊 snapshots 表已改名為 snapshots_legacy")
+        except DB_ERRORS:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def ensure_schema(self):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            for ddl in self.schema_sql:
+                cursor.execute(ddl)
+            conn.commit()
+            cursor.close()
+            self.migrate(conn)
+
+    def load_blacklist(self):
+        with self.connection() as conn:
+            rows = self.fetch_all(conn, "SELECT bot_id, name, reason, timestamp, guilds_detected FROM bot_blacklist")
+        data = {}
+        for row in rows:
             bot_id = str(row["bot_id"])
             guilds = []
             if row["guilds_detected"]:
@@ -173,782 +485,2795 @@ def load_blacklist():
                 "timestamp": float(row["timestamp"]) if row["timestamp"] is not None else 0,
                 "guilds_detected": guilds,
             }
-        cursor.close()
-        conn.close()
-        print(f"[DB] 從 MySQL 載入黑名單 {len(data)} 筆")
-    except Error as e:
-        print(f"[DB ERROR] 載入黑名單失敗: {e}")
-    return data
-
-
-def save_blacklist(data):
-    """將記憶體中的黑名單 dict 寫回 MySQL。"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM bot_blacklist")
-        insert_sql = """
-            INSERT INTO bot_blacklist (bot_id, name, reason, timestamp, guilds_detected)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        rows = 0
-        for bot_id_str, info in data.items():
-            try:
-                bot_id = int(bot_id_str)
-            except ValueError:
-                continue
-            name = info.get("name", bot_id_str)
-            reason = info.get("reason", "")
-            ts = info.get("timestamp", None)
-            ts_val = float(ts) if ts is not None else None
-            guilds = info.get("guilds_detected", [])
-            guilds_str = json.dumps(guilds, ensure_ascii=False)
-            cursor.execute(insert_sql, (bot_id, name, reason, ts_val, guilds_str))
-            rows += 1
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"[DB] 已儲存黑名單 {rows} 筆到 MySQL")
-    except Error as e:
-        print(f"[DB ERROR] 儲存黑名單失敗: {e}")
-
+        return data
 
-def load_whitelist():
-    """從 MySQL 載入全域白名單到記憶體 dict。"""
-    data = {}
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT bot_id, name, reason, timestamp FROM bot_whitelist")
-        for row in cursor.fetchall():
+    def load_whitelist(self):
+        with self.connection() as conn:
+            rows = self.fetch_all(conn, "SELECT bot_id, name, reason, timestamp FROM bot_whitelist")
+        data = {}
+        for row in rows:
             bot_id = str(row["bot_id"])
             data[bot_id] = {
                 "name": row.get("name") or bot_id,
                 "reason": row.get("reason") or "",
                 "timestamp": float(row["timestamp"]) if row["timestamp"] is not None else 0,
             }
-        cursor.close()
-        conn.close()
-        print(f"[DB] 從 MySQL 載入白名單 {len(data)} 筆")
-    except Error as e:
-        print(f"[DB ERROR] 載入白名單失敗: {e}")
-    return data
+        return data
 
+    def load_server_whitelist(self, now):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                self.prepare("DELETE FROM server_whitelist_entries WHERE list_type = 'temporary' AND expiry <= %s"),
+                (now,),
+            )
+            conn.commit()
+            cursor.close()
+            entries = self.fetch_all(conn, "SELECT guild_id, list_type, user_id, expiry FROM server_whitelist_entries")
+            settings = self.fetch_all(conn, "SELECT guild_id, log_channel_id FROM server_settings")
+        return entries, settings
 
-def save_whitelist(data):
-    """將全域白名單 dict 寫回 MySQL。"""
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM bot_whitelist")
-        insert_sql = """
-            INSERT INTO bot_whitelist (bot_id, name, reason, timestamp)
-            VALUES (%s, %s, %s, %s)
-        """
-        rows = 0
-        for bot_id_str, info in data.items():
+    def load_guilds_data(self):
+        with self.connection() as conn:
+            rows = self.fetch_all(conn, "SELECT guild_id, joined_at, welcome_channel_id FROM guilds_data")
+        data = {}
+        for row in rows:
+            welcome = row["welcome_channel_id"]
+            data[str(row["guild_id"])] = {
+                "joined_at": float(row["joined_at"]) if row["joined_at"] is not None else time.time(),
+                "welcome_channel_id": int(welcome) if welcome is not None else None,
+            }
+        return data
+
+    def _execute_grouped(self, deletes: dict, upserts: dict):
+        with self.connection() as conn:
+            cursor = conn.cursor()
             try:
-                bot_id = int(bot_id_str)
-            except ValueError:
-                continue
-            name = info.get("name", bot_id_str)
-            reason = info.get("reason") or ""
-            ts = info.get("timestamp", None)
-            ts_val = float(ts) if ts is not None else None
-            cursor.execute(insert_sql, (bot_id, name, reason, ts_val))
-            rows += 1
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"[DB] 已儲存白名單 {rows} 筆到 MySQL")
-    except Error as e:
-        print(f"[DB ERROR] 儲存白名單失敗: {e}")
+                for kind, delete_sqls in PERSIST_DELETE_SQL.items():
+                    rows = deletes.get(kind)
+                    if rows:
+                        for sql in delete_sqls:
+                            cursor.executemany(self.prepare(sql), rows)
+                for kind, rows in upserts.items():
+                    if rows:
+                        cursor.executemany(self.prepare(self.upsert_sql[kind]), rows)
+                conn.commit()
+            except DB_ERRORS:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
 
+    def write_batch(self, batch):
+        deletes = defaultdict(list)
+        upserts = defaultdict(list)
+        for full_key, (op, params) in batch.items():
+            (deletes if op == "delete" else upserts)[full_key[0]].append(params)
+        self._execute_grouped(deletes, upserts)
 
-def load_server_whitelist():
-    """
-    從 MySQL 載入 server_whitelist 表，填滿 in-memory 的 server_whitelists 結構。
-    結構同原本 JSON 轉換後的記憶體格式。
-    """
-    global server_whitelists
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(
-            """
-            SELECT guild_id, anti_kick_user_id, temp_user_id, temp_expiry, perm_user_id, log_channel_id
-            FROM server_whitelist
-            """
-        )
-        server_whitelists = defaultdict(lambda: {"anti_kick": set(), "temporary": {}, "permanent": set(), "log_channel": None})
-        for row in cursor.fetchall():
-            gid = int(row["guild_id"])
-            anti = server_whitelists[gid]["anti_kick"]
-            temp = server_whitelists[gid]["temporary"]
-            perm = server_whitelists[gid]["permanent"]
-
-            if row["anti_kick_user_id"] is not None:
-                anti.add(int(row["anti_kick_user_id"]))
-            if row["temp_user_id"] is not None:
-                uid = int(row["temp_user_id"])
-                expiry = float(row["temp_expiry"]) if row["temp_expiry"] is not None else time.time()
-                temp[uid] = expiry
-            if row["perm_user_id"] is not None:
-                perm.add(int(row["perm_user_id"]))
-            if row["log_channel_id"] is not None:
-                server_whitelists[gid]["log_channel"] = int(row["log_channel_id"])
+    def bulk_upsert(self, kind, rows):
+        self._execute_grouped({}, {kind: rows})
 
-        cursor.close()
-        conn.close()
-        print(f"[DB] 從 MySQL 載入 server_whitelist，guild 數量: {len(server_whitelists)}")
-    except Error as e:
-        print(f"[DB ERROR] 載入 server_whitelist 失敗: {e}")
-        return {}
+    SNAPSHOT_META_COLUMNS = "id, guild_id, created_at, base_id, struct_hash, format_version, raw_size, stored_size"
 
+    def save_snapshot(self, guild_id, format_version, blob, raw_size, created_at, keep, base_id=None, struct_hash=None, pinned=None):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    self.prepare(
+                        "INSERT INTO snapshot_generations "
+                        "(guild_id, created_at, base_id, struct_hash, format_version, snapshot_data, snapshot_json, raw_size, stored_size) "
+                        "VALUES (%s, %s, %s, %s, %s, %s, NULL, %s, %s)"
+                    ),
+                    (guild_id, created_at, base_id, struct_hash, format_version, blob, raw_size, len(blob)),
+                )
+                snapshot_id = cursor.lastrowid
+                cursor.execute(
+                    self.prepare("SELECT id, base_id FROM snapshot_generations WHERE guild_id = %s ORDER BY created_at DESC, id DESC"),
+                    (guild_id,),
+                )
+                rows = cursor.fetchall()
+                referenced = {row[1] for row in rows[:keep] if row[1] is not None}
+                if pinned is not None:
+                    referenced.add(pinned)
+                    referenced.update(row[1] for row in rows if row[0] == pinned and row[1] is not None)
+                stale = [(row[0],) for row in rows[keep:] if row[0] not in referenced]
+                if stale:
+                    cursor.executemany(self.prepare("DELETE FROM snapshot_generations WHERE id = %s"), stale)
+                conn.commit()
+                return snapshot_id
+            except DB_ERRORS:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
 
-def save_server_whitelist():
-    """
-    將 in-memory 的 server_whitelists 寫回 MySQL。
-    邏輯：清空表，再依照記憶體重建所有列。
-    """
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM server_whitelist")
-        insert_sql = """
-            INSERT INTO server_whitelist
-            (guild_id, anti_kick_user_id, temp_user_id, temp_expiry, perm_user_id, log_channel_id)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """
-        rows = 0
-        for gid, v in server_whitelists.items():
-            anti = v.get("anti_kick", set()) or set()
-            perm = v.get("permanent", set()) or set()
-            temporary = v.get("temporary", {}) or {}
-            log_ch = v.get("log_channel", None)
-            log_ch_id = int(log_ch) if log_ch is not None else None
-
-            for uid in anti:
-                cursor.execute(insert_sql, (gid, uid, None, None, None, log_ch_id))
-                rows += 1
-            for uid in perm:
-                cursor.execute(insert_sql, (gid, None, None, None, uid, log_ch_id))
-                rows += 1
-            for uid, expiry in temporary.items():
-                cursor.execute(insert_sql, (gid, None, uid, float(expiry), None, log_ch_id))
-                rows += 1
-            if not anti and not perm and not temporary and log_ch_id is not None:
-                cursor.execute(insert_sql, (gid, None, None, None, None, log_ch_id))
-                rows += 1
-
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"[DB] 已儲存 server_whitelist {rows} 列到 MySQL")
-    except Error as e:
-        print(f"[DB ERROR] 儲存 server_whitelist 失敗: {e}")
+    def load_snapshot(self, guild_id, snapshot_id=None):
+        columns = self.SNAPSHOT_META_COLUMNS + ", snapshot_data, snapshot_json"
+        with self.connection() as conn:
+            if snapshot_id is None:
+                rows = self.fetch_all(
+                    conn,
+                    f"SELECT {columns} FROM snapshot_generations WHERE guild_id = %s ORDER BY created_at DESC, id DESC LIMIT 1",
+                    (guild_id,),
+                )
+            else:
+                rows = self.fetch_all(
+                    conn,
+                    f"SELECT {columns} FROM snapshot_generations WHERE guild_id = %s AND id = %s",
+                    (guild_id, snapshot_id),
+                )
+            if not rows:
+                return None
+            row = rows[0]
+            if row["base_id"] is not None:
+                base_rows = self.fetch_all(
+                    conn,
+                    f"SELECT {columns} FROM snapshot_generations WHERE id = %s",
+                    (row["base_id"],),
+                )
+                row["base"] = base_rows[0] if base_rows else None
+        return row
+
+    def latest_snapshot_meta(self, guild_id):
+        with self.connection() as conn:
+            rows = self.fetch_all(
+                conn,
+                f"SELECT {self.SNAPSHOT_META_COLUMNS} FROM snapshot_generations WHERE guild_id = %s "
+                "ORDER BY created_at DESC, id DESC LIMIT 1",
+                (guild_id,),
+            )
+        return rows[0] if rows else None
 
+    def touch_snapshot(self, snapshot_id, created_at):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(self.prepare("UPDATE snapshot_generations SET created_at = %s WHERE id = %s"), (created_at, snapshot_id))
+            conn.commit()
+            cursor.close()
 
-def load_guilds_data():
-    """
-    從 MySQL 載入 guilds_data，回傳 dict 結構與原 JSON 相同：
-    {
-      "guild_id_str": {
-        "joined_at": float,
-        "welcome_channel_id": int or None
-      }
-    }
-    """
-    data = {}
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT guild_id, joined_at, welcome_channel_id FROM guilds_data")
-        for row in cursor.fetchall():
-            gid_str = str(row["guild_id"])
-            joined_at = float(row["joined_at"]) if row["joined_at"] is not None else time.time()
-            welcome = row["welcome_channel_id"]
-            welcome_id = int(welcome) if welcome is not None else None
-            data[gid_str] = {
-                "joined_at": joined_at,
-                "welcome_channel_id": welcome_id
-            }
-        cursor.close()
-        conn.close()
-        print(f"[DB] 從 MySQL 載入 guilds_data {len(data)} 筆")
-    except Error as e:
-        print(f"[DB ERROR] 載入 guilds_data 失敗: {e}")
-    return data
+    def list_snapshots(self, guild_id):
+        with self.connection() as conn:
+            return self.fetch_all(
+                conn,
+                f"SELECT {self.SNAPSHOT_META_COLUMNS} FROM snapshot_generations WHERE guild_id = %s ORDER BY created_at DESC, id DESC",
+                (guild_id,),
+            )
 
+    def delete_expired_snapshots(self, cutoff, batch_size):
+        deleted = 0
+        with self.connection() as conn:
+            while True:
+                rows = self.fetch_all(
+                    conn,
+                    "SELECT g.id FROM snapshot_generations g WHERE g.created_at < %s AND NOT EXISTS ("
+                    "SELECT 1 FROM snapshot_generations d WHERE d.base_id = g.id AND d.created_at >= %s"
+                    ") ORDER BY g.id LIMIT %s",
+                    (cutoff, cutoff, batch_size),
+                )
+                if not rows:
+                    break
+                ids = [row["id"] for row in rows]
+                cursor = conn.cursor()
+                try:
+                    placeholders = ", ".join(["%s"] * len(ids))
+                    cursor.execute(self.prepare(f"DELETE FROM snapshot_generations WHERE id IN ({placeholders})"), ids)
+                    conn.commit()
+                except DB_ERRORS:
+                    conn.rollback()
+                    raise
+                finally:
+                    cursor.close()
+                deleted += len(ids)
+                if len(ids) < batch_size:
+                    break
+        return deleted
 
-def save_guilds_data(data):
-    """
-    將 guilds_data dict 寫回 MySQL。
-    """
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM guilds_data")
-        insert_sql = """
-            INSERT INTO guilds_data (guild_id, joined_at, welcome_channel_id)
-            VALUES (%s, %s, %s)
-        """
-        rows = 0
-        for gid_str, info in data.items():
+    def snapshot_totals(self):
+        with self.connection() as conn:
+            rows = self.fetch_all(
+                conn,
+                "SELECT COUNT(*) AS count, SUM(raw_size) AS raw_size, SUM(stored_size) AS stored_size FROM snapshot_generations",
+            )
+        row = rows[0] if rows else {}
+        return {k: int(row.get(k) or 0) for k in ("count", "raw_size", "stored_size")}
+
+    def start_restore_run(self, guild_id, plan_id, snapshot_id, mode, started_at):
+        with self.connection() as conn:
+            cursor = conn.cursor()
             try:
-                gid = int(gid_str)
-            except ValueError:
-                continue
-            joined_at = float(info.get("joined_at", time.time()))
-            welcome = info.get("welcome_channel_id", None)
-            welcome_id = int(welcome) if welcome is not None else None
-            cursor.execute(insert_sql, (gid, joined_at, welcome_id))
-            rows += 1
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"[DB] 已儲存 guilds_data {rows} 筆到 MySQL")
-    except Error as e:
-        print(f"[DB ERROR] 儲存 guilds_data 失敗: {e}")
-
-
-def add_to_guilds_data(guild_id):
-    data = load_guilds_data()
-    guild_id_str = str(guild_id)
-    if guild_id_str not in data:
-        data[guild_id_str] = {
-            "joined_at": time.time(),
-            "welcome_channel_id": None
-        }
-        save_guilds_data(data)
+                cursor.execute(self.prepare("DELETE FROM restore_oplog WHERE guild_id = %s"), (guild_id,))
+                cursor.execute(self.prepare(self.upsert_sql["restore_runs"]), (guild_id, plan_id, snapshot_id, mode, started_at))
+                conn.commit()
+            except DB_ERRORS:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
 
+    def record_restore_ops(self, guild_id, plan_id, ops):
+        self._execute_grouped({}, {"restore_oplog": [(guild_id, plan_id, key, result_id, at) for key, result_id, at in ops]})
 
-def remove_from_guilds_data(guild_id):
-    data = load_guilds_data()
-    guild_id_str = str(guild_id)
-    if guild_id_str in data:
-        del data[guild_id_str]
-        save_guilds_data(data)
+    def load_restore_runs(self, guild_id=None):
+        with self.connection() as conn:
+            sql = "SELECT guild_id, plan_id, snapshot_id, mode, started_at FROM restore_runs"
+            runs = self.fetch_all(conn, sql + " WHERE guild_id = %s", (guild_id,)) if guild_id is not None else self.fetch_all(conn, sql)
+            for run in runs:
+                rows = self.fetch_all(
+                    conn,
+                    "SELECT op_key, result_id FROM restore_oplog WHERE guild_id = %s AND plan_id = %s",
+                    (run["guild_id"], run["plan_id"]),
+                )
+                run["ops"] = {row["op_key"]: row["result_id"] for row in rows}
+        return runs
 
+    def finish_restore_run(self, guild_id, plan_id):
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(self.prepare("DELETE FROM restore_oplog WHERE guild_id = %s AND plan_id = %s"), (guild_id, plan_id))
+                cursor.execute(self.prepare("DELETE FROM restore_runs WHERE guild_id = %s AND plan_id = %s"), (guild_id, plan_id))
+                conn.commit()
+            except DB_ERRORS:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
 
-# 啟動時從 DB 載入黑白名單 & server_whitelist，並確認 snapshots 表
-bot_blacklist = load_blacklist()
-bot_whitelist = load_whitelist()
-load_server_whitelist()
-ensure_snapshots_table()
 
-class AntiNukeBot(commands.Bot):
-    def __init__(self):
-        intents = discord.Intents.default()
-        intents.guilds = True
-        intents.members = True
-        intents.moderation = True
-        intents.message_content = True
-        intents.presences = True
-        super().__init__(command_prefix="!", intents=intents)
-        self.status_index = 0
-        self.last_status_update = 0
+class MySQLStorageBackend(SQLStorageBackend):
+    name = "mysql"
+    label = "MySQL"
 
-    async def setup_hook(self):
-        try:
-            synced = await self.tree.sync()
-            print(f"已同步 {len(synced)} 個斜線指令。")
-        except Exception as e:
-            print(f"同步斜線指令失敗: {e}")
+    schema_sql = [
+        """
+        CREATE TABLE IF NOT EXISTS bot_blacklist (
+            bot_id BIGINT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            reason TEXT,
+            timestamp DOUBLE,
+            guilds_detected TEXT
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_whitelist (
+            bot_id BIGINT PRIMARY KEY,
+            name VARCHAR(255) NOT NULL,
+            reason TEXT,
+            timestamp DOUBLE
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS server_whitelist_entries (
+            guild_id BIGINT NOT NULL,
+            list_type VARCHAR(16) NOT NULL,
+            user_id BIGINT NOT NULL,
+            expiry DOUBLE DEFAULT NULL,
+            PRIMARY KEY (guild_id, list_type, user_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS server_settings (
+            guild_id BIGINT PRIMARY KEY,
+            log_channel_id BIGINT DEFAULT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS guilds_data (
+            guild_id BIGINT PRIMARY KEY,
+            joined_at DOUBLE,
+            welcome_channel_id BIGINT
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS snapshot_generations (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            guild_id BIGINT NOT NULL,
+            created_at DOUBLE NOT NULL,
+            base_id BIGINT NULL,
+            struct_hash CHAR(32) NULL,
+            format_version TINYINT NOT NULL DEFAULT 1,
+            snapshot_data LONGBLOB NULL,
+            snapshot_json LONGTEXT NULL,
+            raw_size INT NULL,
+            stored_size INT NULL,
+            INDEX idx_snapshot_guild_created (guild_id, created_at),
+            INDEX idx_snapshot_created (created_at),
+            INDEX idx_snapshot_base (base_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS restore_runs (
+            guild_id BIGINT PRIMARY KEY,
+            plan_id VARCHAR(64) NOT NULL,
+            snapshot_id BIGINT NULL,
+            mode VARCHAR(16) NOT NULL,
+            started_at DOUBLE NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS restore_oplog (
+            guild_id BIGINT NOT NULL,
+            plan_id VARCHAR(64) NOT NULL,
+            op_key VARCHAR(191) NOT NULL,
+            result_id BIGINT NULL,
+            completed_at DOUBLE NOT NULL,
+            PRIMARY KEY (guild_id, plan_id, op_key)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """,
+    ]
 
-bot = AntiNukeBot()
+    upsert_sql = {
+        "blacklist": """
+            INSERT INTO bot_blacklist (bot_id, name, reason, timestamp, guilds_detected)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                name = VALUES(name),
+                reason = VALUES(reason),
+                timestamp = VALUES(timestamp),
+                guilds_detected = VALUES(guilds_detected)
+        """,
+        "whitelist": """
+            INSERT INTO bot_whitelist (bot_id, name, reason, timestamp)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                name = VALUES(name),
+                reason = VALUES(reason),
+                timestamp = VALUES(timestamp)
+        """,
+        "server_whitelist": """
+            INSERT INTO server_whitelist_entries (guild_id, list_type, user_id, expiry)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE expiry = VALUES(expiry)
+        """,
+        "server_settings": """
+            INSERT INTO server_settings (guild_id, log_channel_id)
+            VALUES (%s, %s)
+            ON DUPLICATE KEY UPDATE log_channel_id = VALUES(log_channel_id)
+        """,
+        "guilds": """
+            INSERT INTO guilds_data (guild_id, joined_at, welcome_channel_id)
+            VALUES (%s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                joined_at = VALUES(joined_at),
+                welcome_channel_id = VALUES(welcome_channel_id)
+        """,
+        "restore_runs": """
+            INSERT INTO restore_runs (guild_id, plan_id, snapshot_id, mode, started_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                plan_id = VALUES(plan_id),
+                snapshot_id = VALUES(snapshot_id),
+                mode = VALUES(mode),
+                started_at = VALUES(started_at)
+        """,
+        "restore_oplog": """
+            INSERT INTO restore_oplog (guild_id, plan_id, op_key, result_id, completed_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE result_id = VALUES(result_id), completed_at = VALUES(completed_at)
+        """,
+    }
 
-@bot.event
-async def on_ready():
-    print("=" * 60)
-    print(f"[READY] Bot 已登入: {bot.user} ({VERSION})")
-    print(f"[READY] 全域黑名單中有 {len(bot_blacklist)} 個機器人")
-    print(f"[READY] 全域白名單中有 {len(bot_whitelist)} 個機器人")
-    print(f"[READY] 正在 {len(bot.guilds)} 個伺服器中")
-    print(f"[READY] 自訂狀態文字已啟用 ({len(STATUS_MESSAGES)} 個)")
-    print(f"[READY] 快照 TTL: {SNAPSHOT_TTL_SECONDS} 秒（存於 MySQL）")
-    print("=" * 60)
-    
-    if not bot.change_status_loop.is_running():
-        bot.change_status_loop.start()
-        print("[STATUS] 已啟動狀態文字循環")
-    if not check_admin_permission_loop.is_running():
-        check_admin_permission_loop.start()
-        print("[PERMISSION CHECK] 已啟動每小時 Administrator 權限檢查循環")
+    # 舊版資料表缺少時補上的欄位
+    added_columns = {
+        "snapshots": {
+            "snapshot_data": "LONGBLOB NULL",
+            "format_version": "TINYINT NOT NULL DEFAULT 0",
+            "raw_size": "INT NULL",
+            "stored_size": "INT NULL",
+        },
+        "snapshot_generations": {
+            "base_id": "BIGINT NULL",
+            "struct_hash": "CHAR(32) NULL",
+        },
+    }
 
-@tasks.loop(seconds=10)
-async def change_status_loop():
-    try:
-        if len(STATUS_MESSAGES) == 0:
-            return
-        
-        status_message = STATUS_MESSAGES[bot.status_index]
-        status_obj = discord.CustomActivity(name=status_message)
-        task = bot.change_presence(activity=status_obj, status=discord.Status.online)
-        await asyncio.shield(task)
-        
-        bot.status_index = (bot.status_index + 1) % len(STATUS_MESSAGES)
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        print(f"[STATUS ERROR] 更新自訂狀態失敗: {e}")
+    def connection(self):
+        return db_connection()
 
-bot.change_status_loop = change_status_loop
+    def fetch_all(self, conn, sql, params=()):
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
 
-# 每小時檢查是否具有 Administrator 權限
-@tasks.loop(hours=1)
-async def check_admin_permission_loop():
-    try:
-        for guild in bot.guilds:
-            try:
-                me = guild.me
-                if not me or not me.guild_permissions.administrator:
-                    print(f"[PERMISSION CHECK LOOP] 伺服器 {guild.name} 缺少 Administrator 權限，通知並離開")
+    def table_exists(self, conn, table):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SHOW TABLES LIKE %s", (table,))
+            return bool(cursor.fetchall())
+        finally:
+            cursor.close()
 
-                    recipients = []
-                    owner = guild.owner
-                    if owner:
-                        recipients.append(owner)
+    def table_columns(self, conn, table):
+        return {row["Field"]: row["Null"] == "NO" for row in self.fetch_all(conn, f"SHOW COLUMNS FROM {table}")}
 
-                    admins = [m for m in guild.members if m.guild_permissions.administrator and not m.bot]
+    def migrate(self, conn):
+        super().migrate(conn)
+        self.migrate_server_whitelist(conn)
 
-                    status_priority = {"online": 0, "idle": 1, "dnd": 2, "offline": 3, None: 3}
-                    def admin_sort_key(m):
-                        st = getattr(m, "status", None)
-                        pr = status_priority.get(str(st), 3)
-                        joined = m.joined_at.timestamp() if m.joined_at else 0
-                        return (pr, -joined)
+    def migrate_server_whitelist(self, conn):
+        """
+        若新表皆空而舊的 server_whitelist 表有資料，在單一交易內搬移過來（舊表保留不動）。
+        """
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT (SELECT COUNT(*) FROM server_whitelist_entries) + (SELECT COUNT(*) FROM server_settings)")
+            new_rows = cursor.fetchone()[0]
+            cursor.execute("SHOW TABLES LIKE 'server_whitelist'")
+            has_legacy = bool(cursor.fetchall())
+            if new_rows or not has_legacy:
+                return
+            try:
+                cursor.execute(
+                    """
+                    INSERT IGNORE INTO server_whitelist_entries (guild_id, list_type, user_id, expiry)
+                    SELECT guild_id, 'anti_kick', anti_kick_user_id, NULL FROM server_whitelist
+                    WHERE anti_kick_user_id IS NOT NULL
+                    """
+                )
+                cursor.execute(
+                    """
+                    INSERT IGNORE INTO server_whitelist_entries (guild_id, list_type, user_id, expiry)
+                    SELECT guild_id, 'temporary', temp_user_id, temp_expiry FROM server_whitelist
+                    WHERE temp_user_id IS NOT NULL
+                    """
+                )
+                cursor.execute(
+                    """
+                    INSERT IGNORE INTO server_whitelist_entries (guild_id, list_type, user_id, expiry)
+                    SELECT guild_id, 'permanent', perm_user_id, NULL FROM server_whitelist
+                    WHERE perm_user_id IS NOT NULL
+                    """
+                )
+                cursor.execute(
+                    """
+                    INSERT IGNORE INTO server_settings (guild_id, log_channel_id)
+                    SELECT guild_id, MAX(log_channel_id) FROM server_whitelist
+                    WHERE log_channel_id IS NOT NULL GROUP BY guild_id
+                    """
+                )
+                conn.commit()
+                print("[DB] 已將舊 server_whitelist 表搬移至 server_whitelist_entries / server_settings")
+            except Error:
+                conn.rollback()
+                raise
+        finally:
+            cursor.close()
 
-                    admins_sorted = sorted(admins, key=admin_sort_key)
 
-                    for a in admins_sorted:
-                        if a not in recipients:
-                            recipients.append(a)
-                        if len(recipients) >= 6:
-                            break
+class SQLiteStorageBackend(SQLStorageBackend):
+    name = "sqlite"
+    label = "SQLite"
 
-                    text = (
-                        f"您好，這裡是 **AntiNuke360 {VERSION}**。\n\n"
-                        "機器人需要 **Administrator** 權限才能正常運作，包含偵測與阻止 nuke 攻擊、封鎖黑名單機器人，"
-                        "以及在伺服器遭受破壞時進行自動還原等功能。\n\n"
-                        "目前我在此伺服器中沒有 **Administrator** 權限，因此將自動離開。\n"
-                        "請在重新邀請本機器人時，勾選 **Administrator** 權限。\n\n"
-                        "若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
-                    )
+    schema_sql = [
+        """
+        CREATE TABLE IF NOT EXISTS bot_blacklist (
+            bot_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            reason TEXT,
+            timestamp REAL,
+            guilds_detected TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS bot_whitelist (
+            bot_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            reason TEXT,
+            timestamp REAL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS server_whitelist_entries (
+            guild_id INTEGER NOT NULL,
+            list_type TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            expiry REAL DEFAULT NULL,
+            PRIMARY KEY (guild_id, list_type, user_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS server_settings (
+            guild_id INTEGER PRIMARY KEY,
+            log_channel_id INTEGER DEFAULT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS guilds_data (
+            guild_id INTEGER PRIMARY KEY,
+            joined_at REAL,
+            welcome_channel_id INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS snapshot_generations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            base_id INTEGER,
+            struct_hash TEXT,
+            format_version INTEGER NOT NULL DEFAULT 1,
+            snapshot_data BLOB,
+            snapshot_json TEXT,
+            raw_size INTEGER,
+            stored_size INTEGER
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_snapshot_guild_created ON snapshot_generations (guild_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_snapshot_created ON snapshot_generations (created_at)",
+        """
+        CREATE TABLE IF NOT EXISTS restore_runs (
+            guild_id INTEGER PRIMARY KEY,
+            plan_id TEXT NOT NULL,
+            snapshot_id INTEGER,
+            mode TEXT NOT NULL,
+            started_at REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS restore_oplog (
+            guild_id INTEGER NOT NULL,
+            plan_id TEXT NOT NULL,
+            op_key TEXT NOT NULL,
+            result_id INTEGER,
+            completed_at REAL NOT NULL,
+            PRIMARY KEY (guild_id, plan_id, op_key)
+        )
+        """,
+    ]
 
-                    for r in recipients:
-                        try:
-                            dm = await r.create_dm()
-                            await dm.send(text)
-                        except Exception:
-                            continue
+    upsert_sql = {
+        "blacklist": """
+            INSERT INTO bot_blacklist (bot_id, name, reason, timestamp, guilds_detected)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT(bot_id) DO UPDATE SET
+                name = excluded.name,
+                reason = excluded.reason,
+                timestamp = excluded.timestamp,
+                guilds_detected = excluded.guilds_detected
+        """,
+        "whitelist": """
+            INSERT INTO bot_whitelist (bot_id, name, reason, timestamp)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT(bot_id) DO UPDATE SET
+                name = excluded.name,
+                reason = excluded.reason,
+                timestamp = excluded.timestamp
+        """,
+        "server_whitelist": """
+            INSERT INTO server_whitelist_entries (guild_id, list_type, user_id, expiry)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT(guild_id, list_type, user_id) DO UPDATE SET expiry = excluded.expiry
+        """,
+        "server_settings": """
+            INSERT INTO server_settings (guild_id, log_channel_id)
+            VALUES (%s, %s)
+            ON CONFLICT(guild_id) DO UPDATE SET log_channel_id = excluded.log_channel_id
+        """,
+        "guilds": """
+            INSERT INTO guilds_data (guild_id, joined_at, welcome_channel_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT(guild_id) DO UPDATE SET
+                joined_at = excluded.joined_at,
+                welcome_channel_id = excluded.welcome_channel_id
+        """,
+        "restore_runs": """
+            INSERT INTO restore_runs (guild_id, plan_id, snapshot_id, mode, started_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT(guild_id) DO UPDATE SET
+                plan_id = excluded.plan_id,
+                snapshot_id = excluded.snapshot_id,
+                mode = excluded.mode,
+                started_at = excluded.started_at
+        """,
+        "restore_oplog": """
+            INSERT INTO restore_oplog (guild_id, plan_id, op_key, result_id, completed_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT(guild_id, plan_id, op_key) DO UPDATE SET
+                result_id = excluded.result_id,
+                completed_at = excluded.completed_at
+        """,
+    }
 
-                    try:
-                        await guild.leave()
-                        print(f"[PERMISSION CHECK LOOP] 已因缺少 Administrator 權限離開伺服器: {guild.name}")
-                    except Exception as e:
-                        print(f"[PERMISSION CHECK LOOP ERROR] 無法離開伺服器 {guild.name}: {e}")
-            except Exception as e:
-                print(f"[PERMISSION CHECK LOOP ERROR] 在伺服器 {guild.name} 檢查 Administrator 權限時發生錯誤: {e}")
-    except Exception as e:
-        print(f"[PERMISSION CHECK LOOP ERROR] 每小時檢查循環發生錯誤: {e}")
+    # 舊版資料表缺少時補上的欄位
+    added_columns = {
+        "snapshots": {
+            "snapshot_data": "BLOB",
+            "format_version": "INTEGER NOT NULL DEFAULT 0",
+            "raw_size": "INTEGER",
+            "stored_size": "INTEGER",
+        },
+        "snapshot_generations": {
+            "base_id": "INTEGER",
+            "struct_hash": "TEXT",
+        },
+    }
 
-# ========== Snapshot utilities：用 MySQL 儲存 ==========
+    def __init__(self, path: str):
+        self.path = path
+        # sqlite3 連線不能跨執行緒共用：每條 DB 執行緒各自持有一條連線
+        self._local = threading.local()
 
-def snapshot_path(guild_id: int) -> Path:
-    return SNAPSHOT_DIR / f"{guild_id}.json"
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
 
-def save_snapshot_file(guild_id: int, data: dict):
-    """
-    將 snapshot 以 JSON 字串存入 MySQL 的 snapshots 表。
-    結構與原 JSON 檔內容相同，只是儲存位置改為 DB。
-    """
+    @contextmanager
+    def connection(self):
+        yield self._connect()
+
+    def prepare(self, sql):
+        return sql.replace("%s", "?")
+
+    def fetch_all(self, conn, sql, params=()):
+        return [dict(row) for row in conn.execute(self.prepare(sql), params).fetchall()]
+
+    def table_exists(self, conn, table):
+        return bool(self.fetch_all(conn, "SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", (table,)))
+
+    def table_columns(self, conn, table):
+        return {row["name"]: bool(row["notnull"]) for row in self.fetch_all(conn, f"PRAGMA table_info({table})")}
+
+
+def create_storage_backend(name: str) -> StorageBackend:
+    if name == "sqlite":
+        return SQLiteStorageBackend(SQLITE_PATH)
+    if name != "mysql":
+        print(f"[DB] 未知的 STORAGE_BACKEND={name}，改用 MySQL")
+    if mysql is None:
+        raise RuntimeError("STORAGE_BACKEND=mysql 需要安裝 mysql-connector-python")
+    return MySQLStorageBackend()
+
+
+storage = create_storage_backend(STORAGE_BACKEND)
+
+
+def ensure_storage_schema():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        snapshot_json = json.dumps(data, ensure_ascii=False)
-        now_ts = time.time()
-        cursor.execute(
-            """
-            INSERT INTO snapshots (guild_id, snapshot_json, updated_at)
-            VALUES (%s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-                snapshot_json = VALUES(snapshot_json),
-                updated_at = VALUES(updated_at)
-            """,
-            (guild_id, snapshot_json, now_ts),
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"[SNAPSHOT] 已將伺服器 {guild_id} 快照儲存至 MySQL snapshots 表")
-    except Error as e:
-        print(f"[SNAPSHOT ERROR] 儲存快照至 MySQL 失敗: {e}")
-
-def load_snapshot_file(guild_id: int):
-    """
-    從 MySQL snapshots 表讀取 snapshot JSON，回傳 dict。
-    若不存在則回傳 None。
-    """
+        storage.ensure_schema()
+        print(f"[DB] 已確認 {storage.label} 資料表存在。")
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 建立/確認 {storage.label} 資料表失敗: {e}")
+
+
+def load_blacklist():
+    """從儲存後端載入全域黑名單到記憶體 dict，結構維持與舊 JSON 一樣。"""
+    data = {}
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT snapshot_json FROM snapshots WHERE guild_id = %s", (guild_id,))
-        row = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if not row:
-            return None
-        try:
-            data = json.loads(row["snapshot_json"])
-            return data
-        except Exception as e:
-            print(f"[SNAPSHOT ERROR] 解析 MySQL 中快照 JSON 失敗: {e}")
-            return None
-    except Error as e:
-        print(f"[SNAPSHOT ERROR] 從 MySQL 讀取快照失敗: {e}")
-        return None
+        data = storage.load_blacklist()
+        print(f"[DB] 從 {storage.label} 載入黑名單 {len(data)} 筆")
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 載入黑名單失敗: {e}")
+    return data
 
-def snapshot_is_valid(snapshot: dict) -> bool:
-    if not snapshot:
-        return False
-    ts = snapshot.get("timestamp", 0)
-    return (time.time() - ts) <= SNAPSHOT_TTL_SECONDS
 
-def snapshot_time_remaining(snapshot: dict) -> int:
-    if not snapshot:
-        return 0
-    expires_at = snapshot.get("timestamp", 0) + SNAPSHOT_TTL_SECONDS
-    return max(0, int(expires_at - time.time()))
+def blacklist_row(bot_id_str, info):
+    try:
+        bot_id = int(bot_id_str)
+    except ValueError:
+        return None
+    ts = info.get("timestamp", None)
+    return (
+        bot_id,
+        info.get("name", bot_id_str),
+        info.get("reason", ""),
+        float(ts) if ts is not None else None,
+        json.dumps(info.get("guilds_detected", []), ensure_ascii=False),
+    )
 
-async def create_snapshot(guild: discord.Guild):
+
+def bulk_upsert(kind, rows, label):
+    """單一交易的 executemany 批次寫入，供匯入等大量資料使用；不會清空整張表。"""
+    if not rows:
+        return True
     try:
-        print(f"[SNAPSHOT] 建立快照: {guild.name} ({guild.id})")
-        data = {"timestamp": time.time(), "roles": [], "categories": [], "channels": []}
-        
-        roles = [r for r in guild.roles if r != guild.default_role]
-        for r in roles:
-            data["roles"].append({
-                "name": r.name,
-                "permissions": r.permissions.value,
-                "color": r.color.value if r.color else 0,
-                "hoist": r.hoist,
-                "mentionable": r.mentionable,
-                "position": r.position
-            })
-        
-        categories = sorted(guild.categories, key=lambda c: c.position)
-        for c in categories:
-            overwrites = []
-            for target, ow in c.overwrites.items():
-                entry = {}
-                if isinstance(target, discord.Role):
-                    entry["type"] = "role"
-                    entry["role_name"] = target.name
-                elif isinstance(target, discord.Member):
-                    entry["type"] = "member"
-                    entry["member_id"] = target.id
-                else:
-                    continue
-                try:
-                    allow = int(ow.pair()[0].value) if hasattr(ow, "pair") else int(ow.read_permissions().value)
-                except Exception:
-                    allow = 0
-                try:
-                    deny = int(ow.pair()[1].value) if hasattr(ow, "pair") else 0
-                except Exception:
-                    deny = 0
-                entry["allow"] = allow
-                entry["deny"] = deny
-                overwrites.append(entry)
-            data["categories"].append({
-                "name": c.name,
-                "position": c.position,
-                "overwrites": overwrites
-            })
-        
-        channels = sorted(guild.channels, key=lambda ch: getattr(ch, "position", 0))
-        for ch in channels:
-            ch_type = "text" if isinstance(ch, discord.TextChannel) else ("voice" if isinstance(ch, discord.VoiceChannel) else "other")
-            parent_name = ch.category.name if ch.category else None
-            overwrites = []
-            for target, ow in ch.overwrites.items():
-                entry = {}
-                if isinstance(target, discord.Role):
-                    entry["type"] = "role"
-                    entry["role_name"] = target.name
-                elif isinstance(target, discord.Member):
-                    entry["type"] = "member"
-                    entry["member_id"] = target.id
-                else:
-                    continue
-                try:
-                    allow = int(ow.pair()[0].value) if hasattr(ow, "pair") else int(ow.read_permissions().value)
-                except Exception:
-                    allow = 0
-                try:
-                    deny = int(ow.pair()[1].value) if hasattr(ow, "pair") else 0
-                except Exception:
-                    deny = 0
-                entry["allow"] = allow
-                entry["deny"] = deny
-                overwrites.append(entry)
-            ch_info = {
-                "name": ch.name,
-                "type": ch_type,
-                "position": getattr(ch, "position", 0),
-                "parent": parent_name,
-                "overwrites": overwrites
-            }
-            if isinstance(ch, discord.TextChannel):
-                ch_info.update({
-                    "topic": ch.topic,
-                    "nsfw": ch.nsfw,
-                    "slowmode": ch.slowmode_delay if hasattr(ch, "slowmode_delay") else getattr(ch, "slowmode", 0)
-                })
-            if isinstance(ch, discord.VoiceChannel):
-                ch_info.update({
-                    "bitrate": ch.bitrate,
-                    "user_limit": ch.user_limit
-                })
-            data["channels"].append(ch_info)
-        
-        save_snapshot_file(guild.id, data)
+        storage.bulk_upsert(kind, rows)
+        print(f"[DB] {label} {len(rows)} 筆")
         return True
-    except Exception as e:
-        print(f"[SNAPSHOT ERROR] 建立快照失敗: {e}")
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] {label}失敗: {e}")
         return False
 
-async def perform_restore(guild: discord.Guild, ctx_sender=None):
-    snapshot = load_snapshot_file(guild.id)
-    if not snapshot or not snapshot_is_valid(snapshot):
-        return False, "沒有有效的快照可用。"
-    
-    me = guild.me
-    if not me:
-        return False, "無法取得 Bot 的成員資料。"
-    if not (me.guild_permissions.manage_roles and me.guild_permissions.manage_channels):
-        return False, "權限不足：需要 Manage Roles 與 Manage Channels 權限來還原快照。"
-    
+
+def bulk_upsert_blacklist(data):
+    """批次匯入黑名單 dict（例如舊 JSON），已存在的 bot_id 會被更新。"""
+    rows = [r for r in (blacklist_row(k, v) for k, v in data.items()) if r is not None]
+    return bulk_upsert("blacklist", rows, "批次匯入黑名單")
+
+
+def load_whitelist():
+    """從儲存後端載入全域白名單到記憶體 dict。"""
+    data = {}
     try:
-        print(f"[RESTORE] 開始清除現有頻道與身分組（若 Bot 有權限）: {guild.name}")
-        for ch in list(guild.channels):
-            try:
-                if ch.permissions_for(me).manage_channels:
-                    await ch.delete(reason="AntiNuke360: 還原前清除現有頻道")
-                    await asyncio.sleep(0.15)
-                else:
-                    print(f"[RESTORE] 無法刪除頻道 (權限不足): {ch.name}")
-            except discord.Forbidden:
-                print(f"[RESTORE] 刪除頻道權限不足: {ch.name}")
-            except Exception as e:
-                print(f"[RESTORE] 刪除頻道失敗 {ch.name}: {e}")
-        
-        bot_top_pos = me.top_role.position if me.top_role else -1
-        for role in sorted(guild.roles, key=lambda r: r.position, reverse=True):
-            if role == guild.default_role:
-                continue
-            if role.position >= bot_top_pos:
-                print(f"[RESTORE] 跳過刪除身分組 (位置高於或等於 Bot): {role.name}")
-                continue
-            try:
-                await role.delete(reason="AntiNuke360: 還原前清除身分組")
-                await asyncio.sleep(0.15)
-            except discord.Forbidden:
-                print(f"[RESTORE] 刪除身分組權限不足: {role.name}")
-            except Exception as e:
-                print(f"[RESTORE] 刪除身分組失敗 {role.name}: {e}")
-        
-        role_map = {}
-        roles_data = sorted(snapshot.get("roles", []), key=lambda r: r.get("position", 0))
-        created_roles = []
-        for rdata in roles_data:
-            name = rdata.get("name", "unnamed")
-            perms = discord.Permissions(rdata.get("permissions", 0))
-            color_val = rdata.get("color", 0)
-            hoist = rdata.get("hoist", False)
-            mentionable = rdata.get("mentionable", False)
-            existing = discord.utils.get(guild.roles, name=name)
-            if existing:
-                role_map[name] = existing
-            else:
-                try:
-                    new_role = await guild.create_role(
-                        name=name,
-                        permissions=perms,
-                        colour=discord.Colour(color_val) if color_val else discord.Colour.default(),
-                        hoist=hoist,
-                        mentionable=mentionable,
-                        reason="AntiNuke360: 還原快照"
-                    )
-                    role_map[name] = new_role
-                    created_roles.append((new_role, rdata.get("position", 0)))
-                    await asyncio.sleep(0.15)
-                except discord.Forbidden:
-                    print(f"[RESTORE] 權限不足，無法建立身分組: {name}")
-                except Exception as e:
-                    print(f"[RESTORE] 建立身分組失敗 {name}: {e}")
-        
-        try:
-            pos_map = {}
-            for name, role in role_map.items():
-                rp = next((r.get("position", 0) for r in roles_data if r.get("name") == name), role.position)
-                pos_map[role] = rp
-            if pos_map:
-                try:
-                    await guild.edit_role_positions({r: p for r, p in pos_map.items()})
-                except AttributeError:
-                    print("[RESTORE] guild.edit_role_positions 不可用，跳過批次設定順位")
-                except discord.Forbidden as e:
-                    print(f"[RESTORE] 調整角色順位失敗 (權限): {e}")
-                except Exception as e:
-                    print(f"[RESTORE] 調整角色順位失敗: {e}")
-        except Exception as e:
-            print(f"[RESTORE] 準備角色順位資料時發生錯誤: {e}")
-        
-        category_map = {}
-        for cdata in sorted(snapshot.get("categories", []), key=lambda c: c.get("position", 0)):
-            name = cdata.get("name", "category")
-            existing = discord.utils.get(guild.categories, name=name)
-            if existing:
-                category_map[name] = existing
-            else:
-                overwrites = {}
-                for ow in cdata.get("overwrites", []):
-                    if ow.get("type") == "role":
-                        role_obj = role_map.get(ow.get("role_name"))
-                        if role_obj:
-                            allow = discord.Permissions(ow.get("allow", 0))
-                            deny = discord.Permissions(ow.get("deny", 0))
-                            overwrites[role_obj] = discord.PermissionOverwrite(allow=allow, deny=deny)
-                    elif ow.get("type") == "member":
-                        member = guild.get_member(ow.get("member_id"))
-                        if member:
-                            allow = discord.Permissions(ow.get("allow", 0))
-                            deny = discord.Permissions(ow.get("deny", 0))
-                            overwrites[member] = discord.PermissionOverwrite(allow=allow, deny=deny)
-                try:
-                    cat = await guild.create_category(name, overwrites=overwrites, reason="AntiNuke360: 還原快照")
-                    category_map[name] = cat
-                    await asyncio.sleep(0.12)
-                except discord.Forbidden:
-                    print(f"[RESTORE] 權限不足，無法建立分類: {name}")
-                except Exception as e:
-                    print(f"[RESTORE] 建立分類失敗 {name}: {e}")
-        
-        created_channels = []
-        for chdata in sorted(snapshot.get("channels", []), key=lambda c: c.get("position", 0)):
-            name = chdata.get("name", "channel")
-            ch_type = chdata.get("type", "text")
-            parent_name = chdata.get("parent")
-            parent = category_map.get(parent_name) if parent_name else None
-            overwrites = {}
-            for ow in chdata.get("overwrites", []):
-                if ow.get("type") == "role":
-                    role_obj = role_map.get(ow.get("role_name"))
-                    if role_obj:
-                        allow = discord.Permissions(ow.get("allow", 0))
-                        deny = discord.Permissions(ow.get("deny", 0))
-                        overwrites[role_obj] = discord.PermissionOverwrite(allow=allow, deny=deny)
-                elif ow.get("type") == "member":
-                    member = guild.get_member(ow.get("member_id"))
-                    if member:
-                        allow = discord.Permissions(ow.get("allow", 0))
-                        deny = discord.Permissions(ow.get("deny", 0))
-                        overwrites[member] = discord.PermissionOverwrite(allow=allow, deny=deny)
-            if ch_type == "text":
-                topic = chdata.get("topic")
-                nsfw = chdata.get("nsfw", False)
-                slowmode = chdata.get("slowmode", 0)
-                try:
-                    ch = await guild.create_text_channel(name, category=parent, topic=topic, nsfw=nsfw, overwrites=overwrites, reason="AntiNuke360: 還原快照")
-                    try:
-                        await ch.edit(slowmode_delay=slowmode)
-                    except Exception:
-                        pass
-                    created_channels.append((ch, chdata.get("position", 0)))
-                    await asyncio.sleep(0.12)
-                except discord.Forbidden:
-                    print(f"[RESTORE] 權限不足，無法建立文字頻道: {name}")
-                except Exception as e:
-                    print(f"[RESTORE] 建立文字頻道失敗 {name}: {e}")
-            elif ch_type == "voice":
-                bitrate = chdata.get("bitrate", None)
-                user_limit = chdata.get("user_limit", None)
-                try:
-                    ch = await guild.create_voice_channel(name, category=parent, bitrate=bitrate, user_limit=user_limit, overwrites=overwrites, reason="AntiNuke360: 還原快照")
-                    created_channels.append((ch, chdata.get("position", 0)))
-                    await asyncio.sleep(0.12)
-                except discord.Forbidden:
-                    print(f"[RESTORE] 權限不足，無法建立語音頻道: {name}")
-                except Exception as e:
-                    print(f"[RESTORE] 建立語音頻道失敗 {name}: {e}")
-            else:
-                continue
-        
-        try:
-            for ch, pos in created_channels:
-                try:
-                    await ch.edit(position=pos)
-                    await asyncio.sleep(0.08)
-                except Exception:
-                    pass
-        except Exception as e:
-            print(f"[RESTORE] 調整頻道順位失敗: {e}")
-        
-        return True, f"已嘗試還原伺服器結構。建立身分組: {len(role_map)}，建立/更新頻道: {len(created_channels)}"
-    except discord.Forbidden as e:
-        print(f"[RESTORE ERROR] 還原失敗: {e}")
-        return False, f"還原失敗: 權限不足 ({e})"
-    except Exception as e:
-        print(f"[RESTORE ERROR] 還原失敗: {e}")
-        return False, f"還原過程中發生錯誤: {e}"
+        data = storage.load_whitelist()
+        print(f"[DB] 從 {storage.label} 載入白名單 {len(data)} 筆")
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 載入白名單失敗: {e}")
+    return data
 
-async def prompt_restore_on_suspect(guild: discord.Guild):
-    now = time.time()
-    if now - restore_prompted[guild.id] < 600:
-        return
-    restore_prompted[guild.id] = now
-    
-    snapshot = load_snapshot_file(guild.id)
-    if not snapshot or not snapshot_is_valid(snapshot):
+
+# 信任旗標：各種名單與身分合成一個位元旗標，偵測時一次查詢即可
+TRUST_PERMANENT = 1       # 本伺服器永久白名單
+TRUST_TEMPORARY = 2       # 本伺服器臨時白名單（敏感操作門檻放寬）
+TRUST_ANTI_KICK = 4       # 本伺服器防踢白名單
+TRUST_LOCAL = 8           # whitelisted_users
+TRUST_GLOBAL_WHITE = 16   # 全域白名單
+TRUST_GLOBAL_BLACK = 32   # 全域黑名單
+TRUST_OWNER = 64          # 伺服器擁有者
+TRUST_EXEMPT = TRUST_OWNER | TRUST_PERMANENT | TRUST_LOCAL | TRUST_GLOBAL_WHITE  # 不計入異常行為
+
+# 全域黑白名單的整數 ID -> 旗標，黑白名單變動時以 refresh_global_trust() 同步。
+# 偵測熱路徑只查這裡（一次整數 dict 查詢，不需 str()）；名稱、原因等資料仍放在以字串為 key 的 bot_blacklist / bot_whitelist
+global_trust = {}
+
+
+def refresh_global_trust(bot_id_str):
+    try:
+        bot_id = int(bot_id_str)
+    except ValueError:
         return
-    
-    remaining = snapshot_time_remaining(snapshot)
-    owner = guild.owner
-    message_text = (
-        f"AntiNuke360 偵測到你的伺服器可能遭受大規模破壞攻擊。\n"
-        f"AntiNuke360 偵測到一個快照可用，剩餘有效時間: {remaining//3600} 小時 {(remaining%3600)//60} 分鐘。\n"
-        "回覆 `Y` 以自動還原伺服器結構（會先嘗試刪除可刪除的身分組與頻道），或回覆 `N` 以略過。\n"
-        "您也可以稍後使用斜線指令 `/restore-snapshot` 手動還原。"
+    flags = (TRUST_GLOBAL_WHITE if bot_id_str in bot_whitelist else 0) | (TRUST_GLOBAL_BLACK if bot_id_str in bot_blacklist else 0)
+    if flags:
+        global_trust[bot_id] = flags
+    else:
+        global_trust.pop(bot_id, None)
+
+
+def is_globally_blacklisted(user_id: int) -> bool:
+    return bool(global_trust.get(user_id, 0) & TRUST_GLOBAL_BLACK)
+
+
+def rebuild_global_trust():
+    global_trust.clear()
+    for bot_id_str in set(bot_blacklist) | set(bot_whitelist):
+        refresh_global_trust(bot_id_str)
+
+
+def whitelist_row(bot_id_str, info):
+    try:
+        bot_id = int(bot_id_str)
+    except ValueError:
+        return None
+    ts = info.get("timestamp", None)
+    return (
+        bot_id,
+        info.get("name", bot_id_str),
+        info.get("reason") or "",
+        float(ts) if ts is not None else None,
     )
-    sent_location = None
+
+
+def bulk_upsert_whitelist(data):
+    """批次匯入白名單 dict（例如舊 JSON），已存在的 bot_id 會被更新。"""
+    rows = [r for r in (whitelist_row(k, v) for k, v in data.items()) if r is not None]
+    return bulk_upsert("whitelist", rows, "批次匯入白名單")
+
+
+def load_server_whitelist():
+    """
+    從 server_whitelist_entries 與 server_settings 載入，
+    填滿 in-memory 的 server_whitelists 結構；已過期的臨時白名單順便刪除。
+    """
+    global server_whitelists
     try:
-        if owner:
-            dm = await owner.create_dm()
-            try:
-                await dm.send(message_text + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
-                sent_location = ("dm", owner.id)
-            except Exception:
-                sent_location = None
-    except Exception:
-        sent_location = None
-    
-    if not sent_location:
-        data = load_guilds_data()
-        welcome_ch_id = data.get(str(guild.id), {}).get("welcome_channel_id")
-        target_ch = None
-        if welcome_ch_id:
-            target_ch = guild.get_channel(welcome_ch_id)
-        if not target_ch:
-            target_ch = guild.system_channel
-        if not target_ch:
-            for ch in guild.text_channels:
-                if ch.permissions_for(guild.me).send_messages:
-                    target_ch = ch
-                    break
-        if target_ch:
-            try:
+        now = time.time()
+        entries, settings = storage.load_server_whitelist(now)
+
+        server_whitelists = defaultdict(lambda: {"anti_kick": set(), "temporary": {}, "permanent": set(), "log_channel": None})
+        for row in entries:
+            gid = int(row["guild_id"])
+            uid = int(row["user_id"])
+            list_type = row["list_type"]
+            if list_type == "temporary":
+                expiry = float(row["expiry"]) if row["expiry"] is not None else now
+                server_whitelists[gid]["temporary"][uid] = expiry
+            elif list_type in SERVER_WHITELIST_LIST_TYPES:
+                server_whitelists[gid][list_type].add(uid)
+        for row in settings:
+            if row["log_channel_id"] is not None:
+                server_whitelists[int(row["guild_id"])]["log_channel"] = int(row["log_channel_id"])
+        print(f"[DB] 從 {storage.label} 載入 server_whitelist，guild 數量: {len(server_whitelists)}")
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 載入 server_whitelist 失敗: {e}")
+        return {}
+
+
+def load_guilds_data():
+    """
+    從儲存後端載入 guilds_data，回傳 dict 結構與原 JSON 相同：
+    {
+      "guild_id_str": {
+        "joined_at": float,
+        "welcome_channel_id": int or None
+      }
+    }
+    """
+    data = {}
+    try:
+        data = storage.load_guilds_data()
+        print(f"[DB] 從 {storage.label} 載入 guilds_data {len(data)} 筆")
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 載入 guilds_data 失敗: {e}")
+    return data
+
+
+# guilds_data 的記憶體快取：guild_id(int) -> {"joined_at": float, "welcome_channel_id": int or None}
+# 啟動時載入一次，之後所有讀取都只查快取，寫入則只動單一列
+guilds_cache = {}
+
+
+def get_welcome_channel_id(guild_id: int):
+    info = guilds_cache.get(guild_id)
+    return info["welcome_channel_id"] if info else None
+
+
+def add_to_guilds_data(guild_id: int):
+    if guild_id not in guilds_cache:
+        guilds_cache[guild_id] = {"joined_at": time.time(), "welcome_channel_id": None}
+        persist_guild_row(guild_id)
+
+
+def remove_from_guilds_data(guild_id: int):
+    guilds_cache.pop(guild_id, None)
+    persist_guild_row(guild_id)
+
+
+def set_welcome_channel(guild_id: int, channel_id):
+    info = guilds_cache.setdefault(guild_id, {"joined_at": time.time(), "welcome_channel_id": None})
+    info["welcome_channel_id"] = channel_id
+    persist_guild_row(guild_id)
+
+
+# ========== Write-behind 持久化佇列 ==========
+# 白名單 / 黑名單 / guilds_data 的變更先寫入本機 append-only journal 並放進佇列，
+# 同一個 key 的多次變更只保留最後狀態，由 persist_flush_loop 每隔幾秒（或累積到門檻時）
+# 以單一交易批次寫入儲存後端。程式崩潰時，未寫入的變更會在下次啟動時從 journal 重播。
+
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "2"))  # 秒
+PERSIST_FLUSH_THRESHOLD = int(os.getenv("PERSIST_FLUSH_THRESHOLD", "200"))  # 待寫入 key 數
+PERSIST_JOURNAL_FILE = Path(os.getenv("PERSIST_JOURNAL_FILE", "persist_journal.jsonl"))
+PERSIST_JOURNAL_FSYNC = os.getenv("PERSIST_JOURNAL_FSYNC", "0") == "1"
+
+class PersistQueue:
+    def __init__(self, journal_path: Path):
+        self.journal_path = journal_path
+        self.flushing_path = journal_path.with_name(journal_path.name + ".flushing")
+        # (kind, *key) -> (op, params)
+        self.pending = {}
+        self._journal = None
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self.stats = {"queued": 0, "coalesced": 0, "flushed": 0, "flushes": 0, "failures": 0, "last_flush_ms": 0.0}
+
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = self.journal_path.open("a", encoding="utf-8")
+        return self._journal
+
+    def _coalesce(self, kind, key, op, params):
+        if kind == "server_guild":
+            # 整個伺服器的白名單資料被清空，之前尚未寫入的該伺服器項目都不用再寫
+            gid = key[0]
+            for k in [k for k in self.pending if k[0] in ("server_whitelist", "server_settings") and k[1] == gid]:
+                del self.pending[k]
+        full_key = (kind,) + tuple(key)
+        if full_key in self.pending:
+            self.stats["coalesced"] += 1
+        self.pending[full_key] = (op, tuple(params))
+
+    def put(self, kind: str, key, op: str, params):
+        record = {"k": kind, "key": list(key), "op": op, "p": list(params)}
+        try:
+            journal = self._open_journal()
+            journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+            journal.flush()
+            if PERSIST_JOURNAL_FSYNC:
+                os.fsync(journal.fileno())
+        except OSError as e:
+            print(f"[PERSIST ERROR] 寫入 journal 失敗: {e}")
+        self._coalesce(kind, key, op, params)
+        self.stats["queued"] += 1
+        if len(self.pending) >= PERSIST_FLUSH_THRESHOLD:
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self.flush())
+
+    def _rotate_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self.journal_path.exists():
+            if self.flushing_path.exists():
+                # 上次啟動重播失敗留下的檔案：接在後面保持順序
+                with self.flushing_path.open("a", encoding="utf-8") as dst, self.journal_path.open("r", encoding="utf-8") as src:
+                    dst.write(src.read())
+                self.journal_path.unlink()
+            else:
+                self.journal_path.replace(self.flushing_path)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.pending:
+                return 0
+            batch = self.pending
+            self.pending = {}
+            self._rotate_journal()
+            started = time.perf_counter()
+            try:
+                await run_db(storage.write_batch, batch)
+            except DB_ERRORS as e:
+                self.stats["failures"] += 1
+                print(f"[PERSIST ERROR] 批次寫入 {len(batch)} 筆失敗，稍後重試: {e}")
+                # 失敗的批次比期間新進的變更舊：先放回批次，再把新變更疊上去；
+                # .flushing 檔保留，下次輪替時新 journal 會接在它後面，重播順序不變
+                newer = self.pending
+                self.pending = batch
+                for full_key, (op, params) in newer.items():
+                    self._coalesce(full_key[0], full_key[1:], op, params)
+                return 0
+            try:
+                self.flushing_path.unlink()
+            except OSError:
+                pass
+            self.stats["flushes"] += 1
+            self.stats["flushed"] += len(batch)
+            self.stats["last_flush_ms"] = (time.perf_counter() - started) * 1000
+            return len(batch)
+
+    def replay(self):
+        """啟動時（event loop 開始前）重播上次未寫入的 journal，並同步寫入儲存後端。"""
+        replayed = 0
+        for path in (self.flushing_path, self.journal_path):
+            if not path.exists():
+                continue
+            with path.open("r", encoding="utf-8") as handle:
+                for line in handle:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                        self._coalesce(record["k"], record["key"], record["op"], record["p"])
+                        replayed += 1
+                    except (ValueError, KeyError):
+                        # 崩潰時寫到一半的最後一行
+                        continue
+        if not self.pending:
+            return
+        print(f"[PERSIST] 從 journal 重播 {replayed} 筆未寫入的變更 ({len(self.pending)} 個 key)")
+        try:
+            storage.write_batch(self.pending)
+        except DB_ERRORS as e:
+            # 保留 journal，下一次 flush 會連同新變更一起寫入
+            print(f"[PERSIST ERROR] 重播 journal 寫入失敗，保留待下次重試: {e}")
+            return
+        self.pending = {}
+        for path in (self.flushing_path, self.journal_path):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+persist_queue = PersistQueue(PERSIST_JOURNAL_FILE)
+
+
+def persist_blacklist(bot_id_str):
+    """依記憶體中的目前狀態排入黑名單 upsert / delete。"""
+    try:
+        bot_id = int(bot_id_str)
+    except ValueError:
+        return
+    info = bot_blacklist.get(bot_id_str)
+    if info is None:
+        persist_queue.put("blacklist", (bot_id,), "delete", (bot_id,))
+    else:
+        persist_queue.put("blacklist", (bot_id,), "upsert", blacklist_row(bot_id_str, info))
+
+
+def persist_whitelist(bot_id_str):
+    try:
+        bot_id = int(bot_id_str)
+    except ValueError:
+        return
+    info = bot_whitelist.get(bot_id_str)
+    if info is None:
+        persist_queue.put("whitelist", (bot_id,), "delete", (bot_id,))
+    else:
+        persist_queue.put("whitelist", (bot_id,), "upsert", whitelist_row(bot_id_str, info))
+
+
+def persist_server_whitelist_entry(guild_id: int, list_type: str, user_id: int):
+    key = (guild_id, list_type, user_id)
+    entries = server_whitelists[guild_id][list_type]
+    if user_id not in entries:
+        persist_queue.put("server_whitelist", key, "delete", key)
+    else:
+        expiry = float(entries[user_id]) if list_type == "temporary" else None
+        persist_queue.put("server_whitelist", key, "upsert", key + (expiry,))
+
+
+def persist_server_settings(guild_id: int):
+    log_ch = server_whitelists[guild_id].get("log_channel")
+    persist_queue.put("server_settings", (guild_id,), "upsert", (guild_id, int(log_ch) if log_ch is not None else None))
+
+
+def persist_server_guild_delete(guild_id: int):
+    persist_queue.put("server_guild", (guild_id,), "delete", (guild_id,))
+
+
+def persist_guild_row(guild_id: int):
+    info = guilds_cache.get(guild_id)
+    if info is None:
+        persist_queue.put("guilds", (guild_id,), "delete", (guild_id,))
+    else:
+        welcome = info.get("welcome_channel_id")
+        persist_queue.put(
+            "guilds",
+            (guild_id,),
+            "upsert",
+            (guild_id, float(info["joined_at"]), int(welcome) if welcome is not None else None),
+        )
+
+
+def import_legacy_json():
+    """
+    把舊版 bot_blacklist.json / bot_whitelist.json 以單一交易批次匯入儲存後端（只匯入資料庫中還沒有的 bot_id，
+    不覆蓋較新的資料），並合併進記憶體中的名單。成功後檔案改名為 *.imported，下次啟動不會重複匯入。
+    """
+    for path, data, importer, label in (
+        (BLACKLIST_FILE, bot_blacklist, bulk_upsert_blacklist, "黑名單"),
+        (WHITELIST_FILE, bot_whitelist, bulk_upsert_whitelist, "白名單"),
+    ):
+        legacy_file = Path(path)
+        if not legacy_file.exists():
+            continue
+        try:
+            legacy = json.loads(legacy_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            print(f"[IMPORT ERROR] 讀取 {path} 失敗: {e}")
+            continue
+        if not isinstance(legacy, dict):
+            print(f"[IMPORT ERROR] {path} 格式不正確，略過")
+            continue
+        new_entries = {
+            bot_id: info for bot_id, info in legacy.items()
+            if bot_id.isdigit() and bot_id not in data and isinstance(info, dict)
+        }
+        if not importer(new_entries):
+            continue
+        data.update(new_entries)
+        try:
+            legacy_file.rename(legacy_file.with_name(legacy_file.name + ".imported"))
+        except OSError as e:
+            print(f"[IMPORT ERROR] 無法重新命名 {path}: {e}")
+        print(f"[IMPORT] 已從 {path} 匯入{label} {len(new_entries)} 筆（{len(legacy) - len(new_entries)} 筆已存在或格式不符，略過）")
+
+
+# 啟動時先確認資料表並重播 journal，再從儲存後端載入黑白名單 & server_whitelist & guilds_data
+ensure_storage_schema()
+persist_queue.replay()
+bot_blacklist = load_blacklist()
+bot_whitelist = load_whitelist()
+import_legacy_json()
+rebuild_global_trust()
+load_server_whitelist()
+guilds_cache = {int(gid_str): info for gid_str, info in load_guilds_data().items()}
+
+class AntiNukeBot(commands.Bot):
+    def __init__(self):
+        intents = discord.Intents.default()
+        intents.guilds = True
+        intents.members = True
+        intents.moderation = True
+        intents.message_content = True
+        intents.presences = True
+        super().__init__(command_prefix="!", intents=intents)
+        self.status_index = 0
+        self.last_status_update = 0
+
+    async def setup_hook(self):
+        try:
+            synced = await self.tree.sync()
+            print(f"已同步 {len(synced)} 個斜線指令。")
+        except Exception as e:
+            print(f"同步斜線指令失敗: {e}")
+
+    async def close(self):
+        # 關閉前把 write-behind 佇列寫完，journal 只在寫入失敗時留下
+        try:
+            await persist_queue.flush()
+        except Exception as e:
+            print(f"[PERSIST ERROR] 關閉前寫入失敗: {e}")
+        persist_queue.close()
+        await super().close()
+
+bot = AntiNukeBot()
+
+@bot.event
+async def on_ready():
+    print("=" * 60)
+    print(f"[READY] Bot 已登入: {bot.user} ({VERSION})")
+    print(f"[READY] 全域黑名單中有 {len(bot_blacklist)} 個機器人")
+    print(f"[READY] 全域白名單中有 {len(bot_whitelist)} 個機器人")
+    print(f"[READY] 正在 {len(bot.guilds)} 個伺服器中")
+    print(f"[READY] 自訂狀態文字已啟用 ({len(STATUS_MESSAGES)} 個)")
+    print(f"[READY] 快照 TTL: {SNAPSHOT_TTL_SECONDS} 秒（存於 {storage.label}）")
+    if storage.name == "mysql":
+        print(f"[READY] MySQL 連線池大小: {MYSQL_POOL_SIZE}（借出前 ping: {'開' if MYSQL_POOL_PING else '關'}）")
+    else:
+        print(f"[READY] SQLite 資料庫: {SQLITE_PATH}（WAL 模式）")
+    print("=" * 60)
+    
+    if not bot.change_status_loop.is_running():
+        bot.change_status_loop.start()
+        print("[STATUS] 已啟動狀態文字循環")
+    if not check_admin_permission_loop.is_running():
+        check_admin_permission_loop.start()
+        print("[PERMISSION CHECK] 已啟動每小時 Administrator 權限檢查循環")
+    if not persist_flush_loop.is_running():
+        persist_flush_loop.start()
+        print(f"[PERSIST] 已啟動 write-behind 寫入循環 (每 {PERSIST_FLUSH_INTERVAL} 秒或累積 {PERSIST_FLUSH_THRESHOLD} 筆)")
+    if not snapshot_gc_loop.is_running():
+        snapshot_gc_loop.start()
+        print(f"[SNAPSHOT GC] 已啟動過期快照清理循環 (每 {SNAPSHOT_GC_INTERVAL} 秒，保留 {SNAPSHOT_GENERATIONS} 個世代)")
+    if not action_counter_gc_loop.is_running():
+        action_counter_gc_loop.start()
+        print(f"[TRACK] 已啟動閒置行為計數器清理循環 (每 {ACTION_COUNTER_GC_INTERVAL} 秒)")
+
+@tasks.loop(seconds=10)
+async def change_status_loop():
+    try:
+        if len(STATUS_MESSAGES) == 0:
+            return
+        
+        status_message = STATUS_MESSAGES[bot.status_index]
+        status_obj = discord.CustomActivity(name=status_message)
+        task = bot.change_presence(activity=status_obj, status=discord.Status.online)
+        await asyncio.shield(task)
+        
+        bot.status_index = (bot.status_index + 1) % len(STATUS_MESSAGES)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"[STATUS ERROR] 更新自訂狀態失敗: {e}")
+
+bot.change_status_loop = change_status_loop
+
+# 每小時檢查是否具有 Administrator 權限
+@tasks.loop(hours=1)
+async def check_admin_permission_loop():
+    try:
+        for guild in bot.guilds:
+            try:
+                me = guild.me
+                if not me or not me.guild_permissions.administrator:
+                    print(f"[PERMISSION CHECK LOOP] 伺服器 {guild.name} 缺少 Administrator 權限，通知並離開")
+
+                    recipients = []
+                    owner = guild.owner
+                    if owner:
+                        recipients.append(owner)
+
+                    admins = [m for m in guild.members if m.guild_permissions.administrator and not m.bot]
+
+                    status_priority = {"online": 0, "idle": 1, "dnd": 2, "offline": 3, None: 3}
+                    def admin_sort_key(m):
+                        st = getattr(m, "status", None)
+                        pr = status_priority.get(str(st), 3)
+                        joined = m.joined_at.timestamp() if m.joined_at else 0
+                        return (pr, -joined)
+
+                    admins_sorted = sorted(admins, key=admin_sort_key)
+
+                    for a in admins_sorted:
+                        if a not in recipients:
+                            recipients.append(a)
+                        if len(recipients) >= 6:
+                            break
+
+                    text = (
+                        f"您好，這裡是 **AntiNuke360 {VERSION}**。\n\n"
+                        "機器人需要 **Administrator** 權限才能正常運作，包含偵測與阻止 nuke 攻擊、封鎖黑名單機器人，"
+                        "以及在伺服器遭受破壞時進行自動還原等功能。\n\n"
+                        "目前我在此伺服器中沒有 **Administrator** 權限，因此將自動離開。\n"
+                        "請在重新邀請本機器人時，勾選 **Administrator** 權限。\n\n"
+                        "若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
+                    )
+
+                    for r in recipients:
+                        try:
+                            dm = await r.create_dm()
+                            await dm.send(text)
+                        except Exception:
+                            continue
+
+                    try:
+                        await guild.leave()
+                        print(f"[PERMISSION CHECK LOOP] 已因缺少 Administrator 權限離開伺服器: {guild.name}")
+                    except Exception as e:
+                        print(f"[PERMISSION CHECK LOOP ERROR] 無法離開伺服器 {guild.name}: {e}")
+            except Exception as e:
+                print(f"[PERMISSION CHECK LOOP ERROR] 在伺服器 {guild.name} 檢查 Administrator 權限時發生錯誤: {e}")
+    except Exception as e:
+        print(f"[PERMISSION CHECK LOOP ERROR] 每小時檢查循環發生錯誤: {e}")
+
+@tasks.loop(seconds=PERSIST_FLUSH_INTERVAL)
+async def persist_flush_loop():
+    try:
+        await persist_queue.flush()
+    except Exception as e:
+        print(f"[PERSIST ERROR] write-behind 寫入循環發生錯誤: {e}")
+
+@tasks.loop(seconds=SNAPSHOT_GC_INTERVAL)
+async def snapshot_gc_loop():
+    """批次刪除超過 TTL 的快照世代，避免 snapshot_generations 無限增長。"""
+    try:
+        cutoff = time.time() - SNAPSHOT_TTL_SECONDS
+        deleted = await run_db(storage.delete_expired_snapshots, cutoff, SNAPSHOT_GC_BATCH)
+        if deleted:
+            print(f"[SNAPSHOT GC] 已刪除 {deleted} 份過期快照")
+    except DB_ERRORS as e:
+        print(f"[SNAPSHOT GC ERROR] 刪除過期快照失敗: {e}")
+
+# ========== Snapshot utilities：存於儲存後端 ==========
+
+# 快照儲存格式：0 = 舊版未壓縮 JSON（snapshot_json 欄位），1 = zlib，2 = zstd
+SNAPSHOT_FORMAT_JSON = 0
+SNAPSHOT_FORMAT_ZLIB = 1
+SNAPSHOT_FORMAT_ZSTD = 2
+
+snapshot_stats = {"saved": 0, "deltas": 0, "unchanged": 0, "raw_bytes": 0, "stored_bytes": 0, "decompressed": 0}
+snapshot_stats_lock = threading.Lock()
+
+SNAPSHOT_SECTIONS = ("roles", "categories", "channels")
+
+# 每個伺服器最新世代與目前基底的摘要：
+# guild_id -> {"snapshot_id", "struct_hash", "base_id", "base_hashes": {(section, key): digest} or None, "base_created_at"}
+snapshot_heads = {}
+snapshot_head_locks = {}
+# 凍結前最後一個世代：guild_id -> snapshot_id（0 表示下次寫入時取當時的最新世代）。
+# 攻擊後連續寫入的世代再多，也不會把它修剪掉；下次凍結時才換成新的世代。
+snapshot_pins = {}
+
+
+def encode_snapshot(data: dict):
+    """序列化並壓縮快照，回傳 (format_version, blob, raw_size)。"""
+    raw = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if SNAPSHOT_CODEC == "zstd" and zstandard is not None:
+        blob = zstandard.ZstdCompressor(level=SNAPSHOT_COMPRESS_LEVEL).compress(raw)
+        return SNAPSHOT_FORMAT_ZSTD, blob, len(raw)
+    return SNAPSHOT_FORMAT_ZLIB, zlib.compress(raw, SNAPSHOT_COMPRESS_LEVEL), len(raw)
+
+
+def decode_snapshot(format_version: int, blob, snapshot_json=None) -> dict:
+    if format_version == SNAPSHOT_FORMAT_JSON:
+        return json.loads(snapshot_json)
+    if format_version == SNAPSHOT_FORMAT_ZLIB:
+        raw = zlib.decompress(blob)
+    elif format_version == SNAPSHOT_FORMAT_ZSTD:
+        if zstandard is None:
+            raise ValueError("快照以 zstd 壓縮，但未安裝 zstandard")
+        raw = zstandard.ZstdDecompressor().decompress(blob)
+    else:
+        raise ValueError(f"未知的快照格式版本 {format_version}")
+    return json.loads(raw.decode("utf-8"))
+
+
+def snapshot_item_key(entry: dict, index: int) -> str:
+    """以 role / channel ID 作為增量比對的 key；舊快照沒有 id 時退回使用順序。"""
+    item_id = entry.get("id")
+    return str(item_id) if item_id is not None else f"#{index}"
+
+
+def snapshot_item_hashes(data: dict) -> dict:
+    """逐項計算 blake2b 摘要：{(section, key): digest}。"""
+    hashes = {}
+    for section in SNAPSHOT_SECTIONS:
+        for index, entry in enumerate(data.get(section, [])):
+            digest = hashlib.blake2b(repr(entry).encode("utf-8"), digest_size=8).hexdigest()
+            hashes[(section, snapshot_item_key(entry, index))] = digest
+    return hashes
+
+
+def snapshot_struct_hash(item_hashes: dict) -> str:
+    """整個伺服器結構的摘要（不含 timestamp），結構沒變時可直接略過寫入。"""
+    h = hashlib.blake2b(digest_size=16)
+    for (section, key), digest in sorted(item_hashes.items()):
+        h.update(f"{section}:{key}:{digest};".encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_snapshot_delta(data: dict, item_hashes: dict, base_hashes: dict) -> dict:
+    """只記錄相對於基底新增/變更與刪除的項目。"""
+    changed = defaultdict(dict)
+    for section in SNAPSHOT_SECTIONS:
+        for index, entry in enumerate(data.get(section, [])):
+            key = snapshot_item_key(entry, index)
+            if base_hashes.get((section, key)) != item_hashes[(section, key)]:
+                changed[section][key] = entry
+    removed = defaultdict(list)
+    for section, key in base_hashes:
+        if (section, key) not in item_hashes:
+            removed[section].append(key)
+    return {"timestamp": data.get("timestamp", time.time()), "changed": dict(changed), "removed": dict(removed)}
+
+
+def snapshot_delta_size(delta: dict) -> int:
+    return sum(len(v) for v in delta["changed"].values()) + sum(len(v) for v in delta["removed"].values())
+
+
+def apply_snapshot_delta(base: dict, delta: dict) -> dict:
+    """把增量套用到基底上，還原成與完整快照相同的結構。"""
+    result = {"timestamp": delta.get("timestamp", base.get("timestamp", 0))}
+    for section in SNAPSHOT_SECTIONS:
+        changed = delta.get("changed", {}).get(section, {})
+        removed = set(delta.get("removed", {}).get(section, []))
+        entries = []
+        seen = set()
+        for index, entry in enumerate(base.get(section, [])):
+            key = snapshot_item_key(entry, index)
+            if key in removed:
+                continue
+            if key in changed:
+                entries.append(changed[key])
+                seen.add(key)
+            else:
+                entries.append(entry)
+        entries.extend(entry for key, entry in changed.items() if key not in seen)
+        result[section] = entries
+    return result
+
+
+class StoredSnapshot(Mapping):
+    """
+    從儲存後端讀出的快照世代。只有在真正讀取內容時才解壓縮；
+    timestamp 直接取自資料列的 created_at，因此 snapshot_is_valid 不會觸發解壓縮。
+    """
+
+    def __init__(self, guild_id: int, row: dict):
+        self.guild_id = guild_id
+        self.snapshot_id = row.get("id")
+        self.base_id = row.get("base_id")
+        self._base = row.get("base")
+        self.format_version = int(row.get("format_version") or 0)
+        self._blob = row.get("snapshot_data")
+        self._json = row.get("snapshot_json")
+        self.created_at = float(row["created_at"]) if row.get("created_at") is not None else 0
+        stored = row.get("stored_size")
+        if stored is None:
+            stored = len(self._blob) if self._blob is not None else len((self._json or "").encode("utf-8"))
+        self.stored_size = int(stored)
+        self.raw_size = int(row["raw_size"]) if row.get("raw_size") is not None else self.stored_size
+        self._data = None
+
+    def _load(self) -> dict:
+        if self._data is None:
+            data = decode_snapshot(self.format_version, self._blob, self._json)
+            if self.base_id is not None:
+                base = self._base
+                data = apply_snapshot_delta(
+                    decode_snapshot(int(base.get("format_version") or 0), base.get("snapshot_data"), base.get("snapshot_json")),
+                    data,
+                )
+            self._data = data
+            self._blob = self._json = self._base = None
+            with snapshot_stats_lock:
+                snapshot_stats["decompressed"] += 1
+        return self._data
+
+    def __getitem__(self, key):
+        if key == "timestamp" and self._data is None and self.created_at:
+            return self.created_at
+        return self._load()[key]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def __bool__(self):
+        return True
+
+
+def save_snapshot_file(guild_id: int, data: dict):
+    """
+    將 snapshot 壓縮後存成新的快照世代（內容結構與原 JSON 檔相同）。
+    較舊的世代會保留，每個伺服器最多 SNAPSHOT_GENERATIONS 個，
+    避免攻擊後再次建立的快照覆蓋掉攻擊前的好快照。
+
+    結構摘要與最新世代相同時只更新其時間；否則盡量只存相對於基底的增量。
+    """
+    created_at = data.get("timestamp", time.time())
+    item_hashes = snapshot_item_hashes(data)
+    struct_hash = snapshot_struct_hash(item_hashes)
+    lock = snapshot_head_locks.setdefault(guild_id, threading.Lock())
+    with lock:
+        try:
+            head = snapshot_heads.get(guild_id)
+            if head is None:
+                meta = storage.latest_snapshot_meta(guild_id)
+                if meta:
+                    # 重啟後沒有基底的逐項摘要，下一次有變動時會存新的完整基底
+                    head = {"snapshot_id": meta["id"], "struct_hash": meta["struct_hash"], "base_id": None,
+                            "base_hashes": None, "base_created_at": 0}
+            pinned = snapshot_pins.get(guild_id)
+            if pinned == 0 and head:
+                pinned = snapshot_pins[guild_id] = head["snapshot_id"]
+            if head and head["struct_hash"] == struct_hash:
+                storage.touch_snapshot(head["snapshot_id"], created_at)
+                snapshot_heads[guild_id] = head
+                with snapshot_stats_lock:
+                    snapshot_stats["unchanged"] += 1
+                print(f"[SNAPSHOT] 伺服器 {guild_id} 結構未變更，沿用快照 #{head['snapshot_id']}")
+                return True
+
+            delta = None
+            if head and head["base_hashes"] is not None and created_at - head["base_created_at"] < SNAPSHOT_TTL_SECONDS / 2:
+                delta = build_snapshot_delta(data, item_hashes, head["base_hashes"])
+                if snapshot_delta_size(delta) > SNAPSHOT_DELTA_MAX_RATIO * max(1, len(head["base_hashes"])):
+                    delta = None
+
+            if delta is not None:
+                format_version, blob, raw_size = encode_snapshot(delta)
+                snapshot_id = storage.save_snapshot(
+                    guild_id, format_version, blob, raw_size, created_at, SNAPSHOT_GENERATIONS,
+                    base_id=head["base_id"], struct_hash=struct_hash, pinned=pinned or None,
+                )
+                snapshot_heads[guild_id] = dict(head, snapshot_id=snapshot_id, struct_hash=struct_hash)
+            else:
+                format_version, blob, raw_size = encode_snapshot(data)
+                snapshot_id = storage.save_snapshot(
+                    guild_id, format_version, blob, raw_size, created_at, SNAPSHOT_GENERATIONS,
+                    struct_hash=struct_hash, pinned=pinned or None,
+                )
+                snapshot_heads[guild_id] = {"snapshot_id": snapshot_id, "struct_hash": struct_hash, "base_id": snapshot_id,
+                                            "base_hashes": item_hashes, "base_created_at": created_at}
+            with snapshot_stats_lock:
+                snapshot_stats["saved"] += 1
+                snapshot_stats["deltas"] += 1 if delta is not None else 0
+                snapshot_stats["raw_bytes"] += raw_size
+                snapshot_stats["stored_bytes"] += len(blob)
+            kind = f"增量（基底 #{head['base_id']}）" if delta is not None else "完整"
+            print(f"[SNAPSHOT] 已將伺服器 {guild_id} {kind}快照 #{snapshot_id} 儲存至 {storage.label} ({raw_size} -> {len(blob)} bytes)")
+            return True
+        except DB_ERRORS as e:
+            snapshot_heads.pop(guild_id, None)
+            print(f"[SNAPSHOT ERROR] 儲存快照至 {storage.label} 失敗: {e}")
+            return False
+
+def load_snapshot_file(guild_id: int, snapshot_id: int = None):
+    """
+    讀取指定的快照世代（預設為最新），回傳延遲解壓縮的 StoredSnapshot。
+    若不存在則回傳 None。
+    """
+    try:
+        row = storage.load_snapshot(guild_id, snapshot_id)
+    except DB_ERRORS as e:
+        print(f"[SNAPSHOT ERROR] 從 {storage.label} 讀取快照失敗: {e}")
+        return None
+    if not row or (row.get("snapshot_data") is None and not row.get("snapshot_json")):
+        return None
+    if row.get("base_id") is not None and not row.get("base"):
+        print(f"[SNAPSHOT ERROR] 快照 #{row.get('id')} 的基底 #{row['base_id']} 已不存在")
+        return None
+    return StoredSnapshot(guild_id, row)
+
+def list_snapshot_generations(guild_id: int):
+    """回傳該伺服器所有快照世代的中繼資料（由新到舊），失敗時回傳空 list。"""
+    try:
+        return storage.list_snapshots(guild_id)
+    except DB_ERRORS as e:
+        print(f"[SNAPSHOT ERROR] 從 {storage.label} 列出快照失敗: {e}")
+        return []
+
+def snapshot_content(snapshot):
+    """解壓縮並回傳快照內容 dict；損毀時回傳 None。"""
+    try:
+        return dict(snapshot)
+    except Exception as e:
+        print(f"[SNAPSHOT ERROR] 解析快照失敗: {e}")
+        return None
+
+def snapshot_is_valid(snapshot: dict) -> bool:
+    if not snapshot:
+        return False
+    ts = snapshot.get("timestamp", 0)
+    return (time.time() - ts) <= SNAPSHOT_TTL_SECONDS
+
+def snapshot_time_remaining(snapshot: dict) -> int:
+    if not snapshot:
+        return 0
+    expires_at = snapshot.get("timestamp", 0) + SNAPSHOT_TTL_SECONDS
+    return max(0, int(expires_at - time.time()))
+
+# ========== Guild mirror：事件驅動的伺服器結構鏡像 ==========
+# 每個伺服器在記憶體中維護一份精簡的角色/分類/頻道結構，由頻道與身分組事件逐項更新，
+# 並在變動停止 MIRROR_DEBOUNCE_SECONDS 秒後寫成快照。懷疑遭受攻擊時凍結寫入，
+# 確保最新快照仍是攻擊前的狀態。
+
+MIRROR_DEBOUNCE_SECONDS = int(os.getenv("MIRROR_DEBOUNCE_SECONDS", "30"))
+MIRROR_CHECKPOINT_INTERVAL = int(os.getenv("MIRROR_CHECKPOINT_INTERVAL", "5"))
+MIRROR_CHECKPOINT_BATCH = max(1, int(os.getenv("MIRROR_CHECKPOINT_BATCH", "50")))
+MIRROR_FREEZE_SECONDS = int(os.getenv("MIRROR_FREEZE_SECONDS", "600"))
+# 短時間內刪除頻道/身分組達到門檻時視為疑似攻擊並凍結
+MIRROR_BURST_THRESHOLD = int(os.getenv("MIRROR_BURST_THRESHOLD", "3"))
+MIRROR_BURST_WINDOW = int(os.getenv("MIRROR_BURST_WINDOW", "10"))
+# 即使沒有變動，也定期刷新快照時間，讓最新快照不會過期
+MIRROR_REFRESH_SECONDS = SNAPSHOT_TTL_SECONDS // 4
+
+
+def mirror_overwrites(obj) -> list:
+    """讀取頻道/分類的權限覆寫；身分組以 ID 記錄，匯出時才換成名稱。"""
+    overwrites = []
+    for target, ow in obj.overwrites.items():
+        entry = {}
+        if isinstance(target, discord.Role):
+            entry["type"] = "role"
+            entry["role_id"] = target.id
+        elif isinstance(target, discord.Member):
+            entry["type"] = "member"
+            entry["member_id"] = target.id
+        else:
+            continue
+        try:
+            allow = int(ow.pair()[0].value) if hasattr(ow, "pair") else int(ow.read_permissions().value)
+        except Exception:
+            allow = 0
+        try:
+            deny = int(ow.pair()[1].value) if hasattr(ow, "pair") else 0
+        except Exception:
+            deny = 0
+        entry["allow"] = allow
+        entry["deny"] = deny
+        overwrites.append(entry)
+    return overwrites
+
+
+def mirror_role_entry(r: discord.Role) -> dict:
+    return {
+        "id": r.id,
+        "name": r.name,
+        "permissions": r.permissions.value,
+        "color": r.color.value if r.color else 0,
+        "hoist": r.hoist,
+        "mentionable": r.mentionable,
+        "position": r.position
+    }
+
+
+def mirror_channel_entry(ch):
+    """回傳 (section, entry)；分類放在 categories，其餘頻道放在 channels。"""
+    if isinstance(ch, discord.CategoryChannel):
+        return "categories", {
+            "id": ch.id,
+            "name": ch.name,
+            "position": ch.position,
+            "overwrites": mirror_overwrites(ch)
+        }
+    ch_type = "text" if isinstance(ch, discord.TextChannel) else ("voice" if isinstance(ch, discord.VoiceChannel) else "other")
+    ch_info = {
+        "id": ch.id,
+        "name": ch.name,
+        "type": ch_type,
+        "position": getattr(ch, "position", 0),
+        "parent_id": ch.category_id if hasattr(ch, "category_id") else (ch.category.id if ch.category else None),
+        "overwrites": mirror_overwrites(ch)
+    }
+    if isinstance(ch, discord.TextChannel):
+        ch_info.update({
+            "topic": ch.topic,
+            "nsfw": ch.nsfw,
+            "slowmode": ch.slowmode_delay if hasattr(ch, "slowmode_delay") else getattr(ch, "slowmode", 0)
+        })
+    if isinstance(ch, discord.VoiceChannel):
+        ch_info.update({
+            "bitrate": ch.bitrate,
+            "user_limit": ch.user_limit
+        })
+    return "channels", ch_info
+
+
+class GuildMirror:
+    """單一伺服器的結構鏡像，只在 event loop 中修改。"""
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.roles = {}
+        self.role_names = {}
+        self.categories = {}
+        self.channels = {}
+        self.loaded = False
+        self.dirty = False
+        self.last_change = 0.0
+        self.last_checkpoint = 0.0
+        self.frozen_until = 0.0
+        self.deletes = deque()
+
+    def load(self, guild: discord.Guild):
+        self.roles.clear()
+        self.role_names.clear()
+        self.categories.clear()
+        self.channels.clear()
+        for r in guild.roles:
+            self.set_role(r, touch=False)
+        for ch in guild.channels:
+            self.set_channel(ch, touch=False)
+        self.loaded = True
+        self.last_checkpoint = time.time()
+        self.touch()
+
+    def touch(self):
+        self.dirty = True
+        self.last_change = time.time()
+
+    def set_role(self, role: discord.Role, touch=True):
+        self.role_names[role.id] = role.name
+        if not role.is_default():
+            self.roles[role.id] = mirror_role_entry(role)
+        if touch:
+            self.touch()
+
+    def remove_role(self, role_id: int):
+        self.role_names.pop(role_id, None)
+        self.roles.pop(role_id, None)
+        self.touch()
+
+    def set_channel(self, ch, touch=True):
+        section, entry = mirror_channel_entry(ch)
+        getattr(self, section)[ch.id] = entry
+        if touch:
+            self.touch()
+
+    def remove_channel(self, channel_id: int):
+        self.categories.pop(channel_id, None)
+        self.channels.pop(channel_id, None)
+        self.touch()
+
+    def note_delete(self) -> bool:
+        """記錄一次刪除，短時間內刪除過多時凍結並回傳 True。"""
+        now = time.time()
+        self.deletes.append(now)
+        while self.deletes and now - self.deletes[0] > MIRROR_BURST_WINDOW:
+            self.deletes.popleft()
+        if len(self.deletes) >= MIRROR_BURST_THRESHOLD and not self.is_frozen():
+            self.freeze()
+            return True
+        return False
+
+    def freeze(self, seconds: int = None):
+        if not self.is_frozen():
+            head = snapshot_heads.get(self.guild_id)
+            snapshot_pins[self.guild_id] = head["snapshot_id"] if head else 0
+        self.frozen_until = max(self.frozen_until, time.time() + (seconds or MIRROR_FREEZE_SECONDS))
+
+    def is_frozen(self) -> bool:
+        return time.time() < self.frozen_until
+
+    def needs_checkpoint(self, now: float) -> bool:
+        if not self.loaded or self.is_frozen():
+            return False
+        if self.dirty and now - self.last_change >= MIRROR_DEBOUNCE_SECONDS:
+            return True
+        return now - self.last_checkpoint >= MIRROR_REFRESH_SECONDS
+
+    def _export_overwrites(self, overwrites: list) -> list:
+        exported = []
+        for ow in overwrites:
+            if ow["type"] == "role":
+                name = self.role_names.get(ow["role_id"])
+                if name is None:
+                    continue
+                ow = dict(ow, role_name=name)
+            exported.append(ow)
+        return exported
+
+    def export(self) -> dict:
+        """輸出與 create_snapshot 相同結構的快照 dict。"""
+        data = {"timestamp": time.time(), "roles": [], "categories": [], "channels": []}
+        data["roles"] = sorted(self.roles.values(), key=lambda r: r["position"])
+        for c in sorted(self.categories.values(), key=lambda c: c["position"]):
+            data["categories"].append(dict(c, overwrites=self._export_overwrites(c["overwrites"])))
+        for ch in sorted(self.channels.values(), key=lambda ch: ch["position"]):
+            parent = self.categories.get(ch["parent_id"])
+            data["channels"].append(dict(ch, parent=parent["name"] if parent else None, overwrites=self._export_overwrites(ch["overwrites"])))
+        return data
+
+    def mark_checkpointed(self, exported_at: float):
+        # 匯出後又有新變動時保持 dirty，等下一次 debounce
+        if self.last_change <= exported_at:
+            self.dirty = False
+        self.last_checkpoint = exported_at
+
+
+guild_mirrors = {}
+
+
+def get_guild_mirror(guild: discord.Guild) -> GuildMirror:
+    mirror = guild_mirrors.get(guild.id)
+    if mirror is None:
+        mirror = GuildMirror(guild.id)
+        guild_mirrors[guild.id] = mirror
+    if not mirror.loaded:
+        mirror.load(guild)
+    return mirror
+
+
+def freeze_guild_mirror(guild: discord.Guild, reason: str):
+    mirror = get_guild_mirror(guild)
+    if not mirror.is_frozen():
+        print(f"[MIRROR] 凍結伺服器 {guild.name} 的快照寫入 {MIRROR_FREEZE_SECONDS} 秒: {reason}")
+    mirror.freeze()
+
+
+async def checkpoint_guild_mirror(mirror: GuildMirror) -> bool:
+    data = mirror.export()
+    ok = await run_db(save_snapshot_file, mirror.guild_id, data)
+    if ok:
+        mirror.mark_checkpointed(data["timestamp"])
+    return ok
+
+
+@tasks.loop(seconds=MIRROR_CHECKPOINT_INTERVAL)
+async def mirror_checkpoint_loop():
+    now = time.time()
+    due = [m for m in guild_mirrors.values() if m.needs_checkpoint(now)]
+    due.sort(key=lambda m: m.last_checkpoint)
+    for mirror in due[:MIRROR_CHECKPOINT_BATCH]:
+        try:
+            await checkpoint_guild_mirror(mirror)
+        except Exception as e:
+            print(f"[MIRROR ERROR] 伺服器 {mirror.guild_id} 快照寫入失敗: {e}")
+
+
+@bot.listen("on_ready")
+async def mirror_on_ready():
+    for guild in bot.guilds:
+        get_guild_mirror(guild).load(guild)
+        await asyncio.sleep(0)
+    if not mirror_checkpoint_loop.is_running():
+        mirror_checkpoint_loop.start()
+    print(f"[MIRROR] 已建立 {len(guild_mirrors)} 個伺服器的結構鏡像 (debounce {MIRROR_DEBOUNCE_SECONDS} 秒)")
+
+
+@bot.listen("on_guild_join")
+async def mirror_on_guild_join(guild):
+    get_guild_mirror(guild)
+
+
+@bot.listen("on_guild_remove")
+async def mirror_on_guild_remove(guild):
+    guild_mirrors.pop(guild.id, None)
+    snapshot_pins.pop(guild.id, None)
+
+
+@bot.listen("on_guild_channel_create")
+async def mirror_on_channel_create(channel):
+    get_guild_mirror(channel.guild).set_channel(channel)
+
+
+@bot.listen("on_guild_channel_update")
+async def mirror_on_channel_update(before, after):
+    get_guild_mirror(after.guild).set_channel(after)
+
+
+@bot.listen("on_guild_channel_delete")
+async def mirror_on_channel_delete(channel):
+    mirror = get_guild_mirror(channel.guild)
+    mirror.remove_channel(channel.id)
+    if mirror.note_delete():
+        print(f"[MIRROR] {channel.guild.name} 短時間內大量刪除，已凍結快照寫入")
+
+
+@bot.listen("on_guild_role_create")
+async def mirror_on_role_create(role):
+    get_guild_mirror(role.guild).set_role(role)
+
+
+@bot.listen("on_guild_role_update")
+async def mirror_on_role_update(before, after):
+    get_guild_mirror(after.guild).set_role(after)
+
+
+@bot.listen("on_guild_role_delete")
+async def mirror_on_role_delete(role):
+    mirror = get_guild_mirror(role.guild)
+    mirror.remove_role(role.id)
+    if mirror.note_delete():
+        print(f"[MIRROR] {role.guild.name} 短時間內大量刪除，已凍結快照寫入")
+
+
+async def create_snapshot(guild: discord.Guild):
+    """立即把結構鏡像寫成快照（鏡像凍結時略過，避免寫入攻擊中的狀態）。"""
+    try:
+        mirror = get_guild_mirror(guild)
+        if mirror.is_frozen():
+            print(f"[SNAPSHOT] {guild.name} 疑似遭受攻擊，快照寫入已凍結，略過")
+            return False
+        print(f"[SNAPSHOT] 建立快照: {guild.name} ({guild.id})")
+        return await checkpoint_guild_mirror(mirror)
+    except Exception as e:
+        print(f"[SNAPSHOT ERROR] 建立快照失敗: {e}")
+        return False
+
+# ========== Restore plan & scheduler ==========
+# 還原分成兩步：先由規劃器比對快照與現存結構，產生明確的操作清單與相依關係（RestorePlan），
+# 再交給排程器並行執行。每種 API 路由各有並行上限（對應 Discord 的 rate-limit bucket），
+# 實際的 429 等待交給 discord.py 的 HTTP client 處理，不再使用固定 sleep。
+
+RESTORE_MAX_CONCURRENCY = max(1, int(os.getenv("RESTORE_MAX_CONCURRENCY", "8")))
+RESTORE_ROUTE_LIMITS = {
+    "channel_delete": 4,   # DELETE /channels/{id}：每個頻道各自一個 bucket
+    "channel_edit": 4,     # PATCH /channels/{id}
+    "channel_create": 2,   # POST /guilds/{id}/channels：整個伺服器共用
+    "role_delete": 2,      # DELETE /guilds/{id}/roles/{id}：整個伺服器共用
+    "role_create": 2,      # POST /guilds/{id}/roles
+    "role_edit": 2,        # PATCH /guilds/{id}/roles/{id}
+    "role_positions": 1,   # PATCH /guilds/{id}/roles
+    "channel_positions": 1,  # PATCH /guilds/{id}/channels
+}
+# 估算耗時用：各路由的 (請求數, 秒) bucket 經驗值，以及單次請求的平均往返時間
+RESTORE_ROUTE_RATES = {
+    "channel_delete": (50, 1.0),   # 每個頻道各自的 bucket，只受全域 50 次/秒限制
+    "channel_edit": (50, 1.0),
+    "channel_create": (5, 5.0),
+    "role_delete": (5, 5.0),
+    "role_create": (5, 5.0),
+    "role_edit": (5, 5.0),
+    "role_positions": (1, 1.0),
+    "channel_positions": (1, 1.0),
+}
+RESTORE_REQUEST_LATENCY = max(0.05, float(os.getenv("RESTORE_REQUEST_LATENCY", "0.35")))
+RESTORE_ACTION_NAMES = {"create": "建立", "edit": "修改", "delete": "刪除", "reorder": "調整順位"}
+
+# 還原進度以操作紀錄（restore_oplog）保存，程序中斷後以同一個 plan_id 接續，已完成的操作不會重做
+restores_in_progress = set()
+restore_resume_checked = False
+
+
+def load_restore_run(guild_id: int):
+    try:
+        runs = storage.load_restore_runs(guild_id)
+        return runs[0] if runs else None
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 載入還原進度失敗: {e}")
+        return None
+
+
+def start_restore_run(plan) -> bool:
+    try:
+        storage.start_restore_run(plan.guild.id, plan.plan_id, plan.snapshot_id, plan.mode, time.time())
+        return True
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 登記還原進度失敗，本次還原無法中斷後接續: {e}")
+        return False
+
+
+def record_restore_op(guild_id: int, plan_id: str, op_key: str, result_id):
+    try:
+        storage.record_restore_ops(guild_id, plan_id, [(op_key, result_id, time.time())])
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 寫入還原進度失敗 ({op_key}): {e}")
+
+
+def finish_restore_run(guild_id: int, plan_id: str):
+    try:
+        storage.finish_restore_run(guild_id, plan_id)
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 清除還原進度失敗: {e}")
+
+
+class RestoreOp:
+    """
+    單一還原操作。deps 可以是其他操作的 key，或 "group:<名稱>" 表示等待整組操作完成；
+    相依的操作失敗時仍會執行（例如找不到身分組時只略過該權限覆寫）。
+    requests 是這個操作預估會送出的 API 請求數（上限），只用於試算。
+    run 可回傳建立出的物件 ID 寫入操作紀錄；接續還原時以 link(ID) 把它重新連回 RestoreContext，
+    回傳 False 代表物件已不存在、需要重做。
+    """
+
+    def __init__(self, key: str, route: str, action: str, label: str, run, deps=(), group: str = None, requests: int = 1,
+                 link=None):
+        self.key = key
+        self.route = route
+        self.action = action
+        self.label = label
+        self.run = run
+        self.deps = list(deps)
+        self.group = group or route
+        self.requests = requests
+        self.link = link
+
+
+class RestorePlan:
+    """
+    規劃器的產出：有序的操作清單與相依圖。不會呼叫任何 Discord API，
+    因此可以先試算（dry-run）給管理員看，再交給 RestoreScheduler 執行。
+    """
+
+    def __init__(self, guild: discord.Guild, ctx, mode: str, plan_id: str = None, snapshot_id: int = None, completed: dict = None):
+        self.guild = guild
+        self.ctx = ctx
+        self.mode = mode
+        self.plan_id = plan_id
+        self.snapshot_id = snapshot_id
+        # 接續還原時：上次已完成的 {op_key: result_id}
+        self.completed = completed or {}
+        self.resumed = completed is not None
+        self.created_ids = {int(v) for v in self.completed.values() if v is not None}
+        self.ops = {}
+        self.skipped = []
+
+    def add(self, op: RestoreOp):
+        if op.key in self.completed:
+            result_id = self.completed[op.key]
+            if op.link is None or op.link(int(result_id) if result_id is not None else None):
+                self.skipped.append(op)
+                return op
+        self.ops[op.key] = op
+        return op
+
+    def __len__(self):
+        return len(self.ops)
+
+    def dependencies(self, op: RestoreOp) -> list:
+        """把 op.deps 展開成實際的操作 key（群組相依展開為群組內所有操作）。"""
+        keys = []
+        for dep in op.deps:
+            if dep.startswith("group:"):
+                group = dep[len("group:"):]
+                keys.extend(other.key for other in self.ops.values() if other.group == group and other.key != op.key)
+            elif dep in self.ops:
+                keys.append(dep)
+        return keys
+
+    def stages(self) -> list:
+        """依相依深度分層：同一層的操作彼此沒有相依，可以同時執行。"""
+        depth = {}
+        visiting = set()
+
+        def resolve(op):
+            if op.key in depth:
+                return depth[op.key]
+            if op.key in visiting:
+                raise ValueError(f"還原計畫有循環相依: {op.key}")
+            visiting.add(op.key)
+            deps = self.dependencies(op)
+            depth[op.key] = 1 + max((resolve(self.ops[key]) for key in deps), default=-1)
+            visiting.discard(op.key)
+            return depth[op.key]
+
+        layers = defaultdict(list)
+        for op in self.ops.values():
+            layers[resolve(op)].append(op)
+        return [layers[level] for level in sorted(layers)]
+
+    def estimate(self, max_concurrency: int = RESTORE_MAX_CONCURRENCY) -> dict:
+        """
+        依各路由的並行上限與 rate-limit bucket 估算請求數與耗時：
+        每一層的耗時取最慢的路由，各層依序相加。
+        """
+        by_action = defaultdict(int)
+        by_route = defaultdict(int)
+        seconds = 0.0
+        stages = self.stages()
+        for ops in stages:
+            route_requests = defaultdict(int)
+            for op in ops:
+                by_action[op.action] += 1
+                by_route[op.route] += op.requests
+                route_requests[op.route] += op.requests
+            total = sum(route_requests.values())
+            if not total:
+                continue
+            slowest = total * RESTORE_REQUEST_LATENCY / max_concurrency
+            for route, count in route_requests.items():
+                limit, per = RESTORE_ROUTE_RATES.get(route, (5, 5.0))
+                throughput = min(RESTORE_ROUTE_LIMITS.get(route, 2) / RESTORE_REQUEST_LATENCY, limit / per)
+                slowest = max(slowest, count / throughput)
+            seconds += max(slowest, RESTORE_REQUEST_LATENCY)
+        return {
+            "ops": len(self.ops),
+            "requests": sum(by_route.values()),
+            "seconds": seconds,
+            "stages": len(stages),
+            "by_action": dict(by_action),
+            "by_route": dict(by_route),
+        }
+
+    def describe(self, limit: int = 15) -> list:
+        """每層列出操作，供 dry-run 顯示；超過 limit 的部分只顯示數量。"""
+        lines = []
+        shown = 0
+        for level, ops in enumerate(self.stages(), start=1):
+            counts = defaultdict(int)
+            for op in ops:
+                counts[op.action] += 1
+            lines.append(f"**階段 {level}**：" + "、".join(
+                f"{RESTORE_ACTION_NAMES.get(action, action)} {count}" for action, count in counts.items()
+            ))
+            for op in ops:
+                if shown >= limit:
+                    break
+                lines.append(f"• {op.label}")
+                shown += 1
+        if shown < len(self.ops):
+            lines.append(f"…另有 {len(self.ops) - shown} 個操作")
+        return lines
+
+
+class RestoreScheduler:
+    def __init__(self, plan: RestorePlan, max_concurrency: int = RESTORE_MAX_CONCURRENCY):
+        self.plan = plan
+        self.guild = plan.guild
+        self.ops = plan.ops
+        self.max_concurrency = max_concurrency
+
+    async def run(self) -> dict:
+        done = {key: asyncio.Event() for key in self.ops}
+        group_remaining = defaultdict(int)
+        for op in self.ops.values():
+            group_remaining[op.group] += 1
+        group_done = defaultdict(asyncio.Event)
+        global_sem = asyncio.Semaphore(self.max_concurrency)
+        route_sems = {}
+        stats = {
+            "total": len(self.ops),
+            "ok": 0,
+            "failed": 0,
+            "skipped": len(self.plan.skipped),
+            "routes": defaultdict(lambda: {"count": 0, "failed": 0, "seconds": 0.0}),
+        }
+        started = time.monotonic()
+        # 被取消（例如程序關閉）時不要放行相依的操作，讓未完成的部分留給下次接續
+        aborted = False
+
+        async def wait_for(dep: str):
+            if dep.startswith("group:"):
+                group = dep[len("group:"):]
+                if group_remaining.get(group, 0) > 0:
+                    await group_done[group].wait()
+            elif dep in done:
+                await done[dep].wait()
+
+        async def execute(op: RestoreOp):
+            nonlocal aborted
+            try:
+                for dep in op.deps:
+                    await wait_for(dep)
+                if aborted:
+                    return
+                route_sem = route_sems.get(op.route)
+                if route_sem is None:
+                    route_sem = route_sems[op.route] = asyncio.Semaphore(RESTORE_ROUTE_LIMITS.get(op.route, 2))
+                async with global_sem, route_sem:
+                    op_started = time.monotonic()
+                    route_stats = stats["routes"][op.route]
+                    route_stats["count"] += 1
+                    try:
+                        result = await op.run()
+                        stats["ok"] += 1
+                        if self.plan.plan_id:
+                            await run_db(
+                                record_restore_op, self.guild.id, self.plan.plan_id, op.key,
+                                result if isinstance(result, int) else None,
+                            )
+                    except discord.Forbidden:
+                        stats["failed"] += 1
+                        route_stats["failed"] += 1
+                        print(f"[RESTORE] 權限不足，無法{op.label}")
+                    except Exception as e:
+                        stats["failed"] += 1
+                        route_stats["failed"] += 1
+                        print(f"[RESTORE] {op.label}失敗: {e}")
+                    finally:
+                        route_stats["seconds"] += time.monotonic() - op_started
+            except BaseException:
+                aborted = True
+                raise
+            finally:
+                done[op.key].set()
+                group_remaining[op.group] -= 1
+                if group_remaining[op.group] == 0:
+                    group_done[op.group].set()
+
+        await asyncio.gather(*(execute(op) for op in self.ops.values()))
+        stats["elapsed"] = time.monotonic() - started
+        stats["rate"] = stats["total"] / stats["elapsed"] if stats["elapsed"] > 0 else 0.0
+        stats["routes"] = dict(stats["routes"])
+        return stats
+
+
+def restore_stats_summary(stats: dict) -> str:
+    skipped = f"，略過上次已完成的 {stats['skipped']} 個" if stats.get("skipped") else ""
+    return (
+        f"共 {stats['total']} 個還原操作（成功 {stats['ok']}，失敗 {stats['failed']}{skipped}），"
+        f"耗時 {stats['elapsed']:.1f} 秒（{stats['rate']:.1f} 次/秒）"
+    )
+
+
+def snowflake_timestamp(snowflake: int) -> float:
+    """Discord snowflake 內含的建立時間（Unix 秒）。"""
+    return ((int(snowflake) >> 22) + 1420070400000) / 1000
+
+
+def live_channel_type(ch) -> str:
+    return "text" if isinstance(ch, discord.TextChannel) else ("voice" if isinstance(ch, discord.VoiceChannel) else "other")
+
+
+def match_snapshot_items(entries: list, live: list, kind_of=None):
+    """
+    將快照項目與現存物件配對：先比 ID，再比名稱，最後比同類型的位置。
+    回傳 (matches: [(entry, obj)], missing: [entry], extra: [obj])。
+    """
+    kind_of = kind_of or (lambda x: None)
+    remaining = {obj.id: obj for obj in live}
+    matches = []
+    unmatched = []
+    for entry in entries:
+        obj = remaining.pop(entry["id"], None) if entry.get("id") is not None else None
+        if obj is not None:
+            matches.append((entry, obj))
+        else:
+            unmatched.append(entry)
+
+    by_name = defaultdict(list)
+    for obj in sorted(remaining.values(), key=lambda o: getattr(o, "position", 0)):
+        by_name[(obj.name, kind_of(obj))].append(obj)
+    still_unmatched = []
+    for entry in unmatched:
+        candidates = by_name.get((entry.get("name"), entry.get("type")))
+        if candidates:
+            obj = candidates.pop(0)
+            del remaining[obj.id]
+            matches.append((entry, obj))
+        else:
+            still_unmatched.append(entry)
+
+    by_position = {}
+    for obj in remaining.values():
+        by_position.setdefault((getattr(obj, "position", 0), kind_of(obj)), obj)
+    missing = []
+    for entry in still_unmatched:
+        obj = by_position.pop((entry.get("position", 0), entry.get("type")), None)
+        if obj is not None and obj.id in remaining:
+            del remaining[obj.id]
+            matches.append((entry, obj))
+        else:
+            missing.append(entry)
+    return matches, missing, list(remaining.values())
+
+
+class RestoreContext:
+    """一次還原共用的狀態：快照 ID / 名稱對應到的現存身分組與分類，以及建立後需要調整順位的頻道。"""
+
+    def __init__(self, guild: discord.Guild, snapshot: dict):
+        self.guild = guild
+        self.me = guild.me
+        self.snapshot = snapshot
+        self.snapshot_time = snapshot.get("timestamp", 0)
+        self.bot_top_pos = self.me.top_role.position if self.me and self.me.top_role else -1
+        self.role_map = {}
+        self.role_links = {}
+        self.category_map = {}
+        self.category_links = {}
+        # 現存物件 ID -> (物件, 快照中的順位)，調整順位時直接查表
+        self.role_positions = {}
+        self.channel_positions = {}
+        self.created_roles = 0
+        self.created_channels = 0
+        self.edited = 0
+        self.deleted = 0
+
+    def link_role(self, rdata: dict, role: discord.Role):
+        self.role_map[rdata.get("name")] = role
+        self.role_positions[role.id] = (role, rdata.get("position", 0))
+        if rdata.get("id") is not None:
+            self.role_links[rdata["id"]] = role
+
+    def place_channel(self, chdata: dict, ch):
+        self.channel_positions[ch.id] = (ch, chdata.get("position", 0))
+
+    def link_category(self, cdata: dict, category):
+        self.category_map[cdata.get("name")] = category
+        if cdata.get("id") is not None:
+            self.category_links[cdata["id"]] = category
+
+    def resolve_role(self, ow: dict):
+        role_id = ow.get("role_id")
+        if role_id == self.guild.id or ow.get("role_name") == "@everyone":
+            return self.guild.default_role
+        if role_id is not None and role_id in self.role_links:
+            return self.role_links[role_id]
+        return self.role_map.get(ow.get("role_name"))
+
+    def resolve_parent(self, chdata: dict):
+        parent_id = chdata.get("parent_id")
+        if parent_id is not None and parent_id in self.category_links:
+            return self.category_links[parent_id]
+        parent_name = chdata.get("parent")
+        return self.category_map.get(parent_name) if parent_name else None
+
+    def overwrites(self, entries: list) -> dict:
+        overwrites = {}
+        for ow in entries:
+            if ow.get("type") == "role":
+                target = self.resolve_role(ow)
+            elif ow.get("type") == "member":
+                target = self.guild.get_member(ow.get("member_id"))
+            else:
+                target = None
+            if target:
+                allow = discord.Permissions(ow.get("allow", 0))
+                deny = discord.Permissions(ow.get("deny", 0))
+                overwrites[target] = discord.PermissionOverwrite.from_pair(allow, deny)
+        return overwrites
+
+    def overwrites_differ(self, entries: list, live_obj) -> bool:
+        wanted = {(target.id, ow.pair()[0].value, ow.pair()[1].value) for target, ow in self.overwrites(entries).items()}
+        current = {
+            (ow["role_id"] if ow["type"] == "role" else ow["member_id"], ow["allow"], ow["deny"])
+            for ow in mirror_overwrites(live_obj)
+        }
+        return wanted != current
+
+    def resume_role(self, rdata: dict, role_id: int) -> bool:
+        role = self.guild.get_role(role_id) if role_id else None
+        if role is None:
+            return False
+        self.link_role(rdata, role)
+        return True
+
+    def resume_category(self, cdata: dict, category_id: int) -> bool:
+        category = self.guild.get_channel(category_id) if category_id else None
+        if category is None:
+            return False
+        self.link_category(cdata, category)
+        return True
+
+    def resume_channel(self, chdata: dict, channel_id: int) -> bool:
+        ch = self.guild.get_channel(channel_id) if channel_id else None
+        if ch is None:
+            return False
+        self.place_channel(chdata, ch)
+        return True
+
+    def can_manage_role(self, role: discord.Role) -> bool:
+        return not role.is_default() and not role.managed and role.position < self.bot_top_pos
+
+    def created_after_snapshot(self, obj) -> bool:
+        return snowflake_timestamp(obj.id) > self.snapshot_time
+
+
+def restore_role_fields(rdata: dict) -> dict:
+    color_val = rdata.get("color", 0)
+    return {
+        "name": rdata.get("name", "unnamed"),
+        "permissions": discord.Permissions(rdata.get("permissions", 0)),
+        "colour": discord.Colour(color_val) if color_val else discord.Colour.default(),
+        "hoist": rdata.get("hoist", False),
+        "mentionable": rdata.get("mentionable", False),
+    }
+
+
+def restore_channel_fields(ctx: RestoreContext, chdata: dict) -> dict:
+    fields = {"category": ctx.resolve_parent(chdata), "overwrites": ctx.overwrites(chdata.get("overwrites", []))}
+    if chdata.get("type") == "text":
+        fields.update({
+            "topic": chdata.get("topic"),
+            "nsfw": chdata.get("nsfw", False),
+            "slowmode_delay": chdata.get("slowmode", 0) or 0,
+        })
+    elif chdata.get("type") == "voice":
+        if chdata.get("bitrate"):
+            fields["bitrate"] = chdata["bitrate"]
+        if chdata.get("user_limit") is not None:
+            fields["user_limit"] = chdata["user_limit"]
+    return fields
+
+
+def role_differs(rdata: dict, role: discord.Role) -> bool:
+    return (
+        role.name != rdata.get("name")
+        or role.permissions.value != rdata.get("permissions", 0)
+        or (role.color.value if role.color else 0) != rdata.get("color", 0)
+        or role.hoist != rdata.get("hoist", False)
+        or role.mentionable != rdata.get("mentionable", False)
+    )
+
+
+def channel_differs(ctx: RestoreContext, chdata: dict, ch) -> bool:
+    parent = ctx.resolve_parent(chdata)
+    if ch.name != chdata.get("name") or getattr(ch, "category_id", None) != (parent.id if parent else None):
+        return True
+    if chdata.get("type") == "text":
+        slowmode = ch.slowmode_delay if hasattr(ch, "slowmode_delay") else getattr(ch, "slowmode", 0)
+        if ch.topic != chdata.get("topic") or ch.nsfw != chdata.get("nsfw", False) or slowmode != (chdata.get("slowmode", 0) or 0):
+            return True
+    elif chdata.get("type") == "voice":
+        if (chdata.get("bitrate") and ch.bitrate != chdata["bitrate"]) or ch.user_limit != chdata.get("user_limit", ch.user_limit):
+            return True
+    return ctx.overwrites_differ(chdata.get("overwrites", []), ch)
+
+
+def add_role_position_op(plan: RestorePlan, ctx: RestoreContext):
+    def wanted_positions():
+        wanted = sorted(
+            (item for item in ctx.role_positions.values() if ctx.can_manage_role(item[0])),
+            key=lambda item: item[1],
+        )
+        current = sorted((role for role, _ in wanted), key=lambda r: r.position)
+        if [role.id for role, _ in wanted] == [role.id for role in current]:
+            return None
+        return wanted
+
+    # 沒有身分組要建立或修改時，規劃時就能判斷順位是否需要調整
+    if not any(op.group in ("role_create", "role_edit") for op in plan.ops.values()) and wanted_positions() is None:
+        return
+
+    async def reorder_roles():
+        wanted = wanted_positions()
+        if wanted is None:
+            return
+        try:
+            await ctx.guild.edit_role_positions({role: pos for role, pos in wanted})
+        except AttributeError:
+            print("[RESTORE] guild.edit_role_positions 不可用，跳過批次設定順位")
+
+    plan.add(RestoreOp(
+        "role_positions", "role_positions", "reorder", "調整身分組順位",
+        reorder_roles, deps=["group:role_create", "group:role_edit"],
+    ))
+
+
+def add_full_restore_ops(plan: RestorePlan, ctx: RestoreContext):
+    """完整模式：先刪除所有可刪除的頻道與身分組，再依快照全部重建。"""
+    guild, me, snapshot = ctx.guild, ctx.me, ctx.snapshot
+    print(f"[RESTORE] 規劃完整重建（先清除可刪除的頻道與身分組）: {guild.name}")
+    # 接續還原時，上次還原建立的頻道與身分組不能再被清除
+    for ch in list(guild.channels):
+        if ch.id in plan.created_ids:
+            continue
+        if not ch.permissions_for(me).manage_channels:
+            print(f"[RESTORE] 無法刪除頻道 (權限不足): {ch.name}")
+            continue
+
+        async def delete_channel(ch=ch):
+            await ch.delete(reason="AntiNuke360: 還原前清除現有頻道")
+            ctx.deleted += 1
+        plan.add(RestoreOp(f"channel_delete:{ch.id}", "channel_delete", "delete", f"刪除頻道 {ch.name}", delete_channel))
+
+    for role in guild.roles:
+        if role == guild.default_role or role.id in plan.created_ids:
+            continue
+        if role.position >= ctx.bot_top_pos:
+            print(f"[RESTORE] 跳過刪除身分組 (位置高於或等於 Bot): {role.name}")
+            continue
+
+        async def delete_role(role=role):
+            await role.delete(reason="AntiNuke360: 還原前清除身分組")
+            ctx.deleted += 1
+        plan.add(RestoreOp(f"role_delete:{role.id}", "role_delete", "delete", f"刪除身分組 {role.name}", delete_role))
+
+    roles_data = sorted(snapshot.get("roles", []), key=lambda r: r.get("position", 0))
+    for index, rdata in enumerate(roles_data):
+        name = rdata.get("name", "unnamed")
+
+        async def create_role(rdata=rdata, name=name):
+            existing = discord.utils.get(guild.roles, name=name)
+            if existing:
+                ctx.link_role(rdata, existing)
+                return existing.id
+            role = await guild.create_role(reason="AntiNuke360: 還原快照", **restore_role_fields(rdata))
+            ctx.link_role(rdata, role)
+            ctx.created_roles += 1
+            return role.id
+
+        plan.add(RestoreOp(
+            f"role_create:{rdata.get('id', index)}", "role_create", "create", f"建立身分組 {name}",
+            create_role, deps=["group:role_delete"], link=functools.partial(ctx.resume_role, rdata),
+        ))
+    add_role_position_op(plan, ctx)
+
+    category_keys = {}
+    for index, cdata in enumerate(sorted(snapshot.get("categories", []), key=lambda c: c.get("position", 0))):
+        name = cdata.get("name", "category")
+
+        async def create_category(cdata=cdata, name=name):
+            existing = discord.utils.get(guild.categories, name=name)
+            if existing:
+                ctx.link_category(cdata, existing)
+                return existing.id
+            overwrites = ctx.overwrites(cdata.get("overwrites", []))
+            category = await guild.create_category(name, overwrites=overwrites, reason="AntiNuke360: 還原快照")
+            ctx.link_category(cdata, category)
+            ctx.created_channels += 1
+            return category.id
+
+        key = f"category_create:{cdata.get('id', index)}"
+        category_keys[name] = key
+        plan.add(RestoreOp(
+            key, "channel_create", "create", f"建立分類 {name}",
+            create_category, deps=["group:role_create", "group:channel_delete"], group="category_create",
+            link=functools.partial(ctx.resume_category, cdata),
+        ))
+
+    for index, chdata in enumerate(sorted(snapshot.get("channels", []), key=lambda c: c.get("position", 0))):
+        op = restore_create_channel_op(ctx, chdata, index)
+        if op is None:
+            continue
+        op.deps = ["group:role_create", "group:channel_delete"]
+        if chdata.get("parent") in category_keys:
+            op.deps.append(category_keys[chdata["parent"]])
+        plan.add(op)
+
+
+def restore_create_channel_op(ctx: RestoreContext, chdata: dict, index: int):
+    name = chdata.get("name", "channel")
+    ch_type = chdata.get("type", "text")
+    if ch_type not in ("text", "voice"):
+        return None
+
+    async def create_channel():
+        fields = restore_channel_fields(ctx, chdata)
+        if ch_type == "text":
+            ch = await ctx.guild.create_text_channel(name, reason="AntiNuke360: 還原快照", **fields)
+        else:
+            ch = await ctx.guild.create_voice_channel(name, reason="AntiNuke360: 還原快照", **fields)
+        ctx.created_channels += 1
+        ctx.place_channel(chdata, ch)
+        return ch.id
+
+    label = f"建立{'文字' if ch_type == 'text' else '語音'}頻道 {name}"
+    return RestoreOp(
+        f"channel_create:{chdata.get('id', index)}", "channel_create", "create", label, create_channel,
+        link=functools.partial(ctx.resume_channel, chdata),
+    )
+
+
+def add_reconcile_restore_ops(plan: RestorePlan, ctx: RestoreContext):
+    """
+    差異模式：依 ID、名稱、位置把快照與現存結構配對，
+    只重建缺少的、只修改被改過的、只刪除快照之後才建立的（攻擊者建立的）物件。
+    """
+    guild, me, snapshot = ctx.guild, ctx.me, ctx.snapshot
+    print(f"[RESTORE] 規劃差異還原，比對快照與現存結構: {guild.name}")
+
+    # 身分組
+    roles_data = sorted(snapshot.get("roles", []), key=lambda r: r.get("position", 0))
+    live_roles = [r for r in guild.roles if not r.is_default()]
+    matches, missing, extra = match_snapshot_items(roles_data, live_roles)
+    for rdata, role in matches:
+        ctx.link_role(rdata, role)
+        if role_differs(rdata, role) and ctx.can_manage_role(role):
+            async def edit_role(rdata=rdata, role=role):
+                await role.edit(reason="AntiNuke360: 還原快照", **restore_role_fields(rdata))
+                ctx.edited += 1
+            plan.add(RestoreOp(f"role_edit:{role.id}", "role_edit", "edit", f"修改身分組 {role.name}", edit_role))
+    for index, rdata in enumerate(missing):
+        async def create_role(rdata=rdata):
+            role = await guild.create_role(reason="AntiNuke360: 還原快照", **restore_role_fields(rdata))
+            ctx.link_role(rdata, role)
+            ctx.created_roles += 1
+            return role.id
+        plan.add(RestoreOp(
+            f"role_create:{rdata.get('id', index)}", "role_create", "create", f"建立身分組 {rdata.get('name')}", create_role,
+            link=functools.partial(ctx.resume_role, rdata),
+        ))
+    for role in extra:
+        if role.id not in plan.created_ids and ctx.created_after_snapshot(role) and ctx.can_manage_role(role):
+            async def delete_role(role=role):
+                await role.delete(reason="AntiNuke360: 刪除攻擊後建立的身分組")
+                ctx.deleted += 1
+            plan.add(RestoreOp(f"role_delete:{role.id}", "role_delete", "delete", f"刪除身分組 {role.name}", delete_role))
+    add_role_position_op(plan, ctx)
+
+    # 分類
+    # 有身分組要重建時，權限覆寫只能在建立後才比較；否則規劃時就能略過沒變的項目
+    roles_pending = any(op.group == "role_create" for op in plan.ops.values())
+    categories_data = sorted(snapshot.get("categories", []), key=lambda c: c.get("position", 0))
+    matches, missing, extra = match_snapshot_items(categories_data, list(guild.categories))
+    for cdata, cat in matches:
+        ctx.link_category(cdata, cat)
+        if not roles_pending and cat.name == cdata.get("name") and not ctx.overwrites_differ(cdata.get("overwrites", []), cat):
+            continue
+
+        async def edit_category(cdata=cdata, cat=cat):
+            if cat.name == cdata.get("name") and not ctx.overwrites_differ(cdata.get("overwrites", []), cat):
+                return
+            await cat.edit(name=cdata.get("name"), overwrites=ctx.overwrites(cdata.get("overwrites", [])), reason="AntiNuke360: 還原快照")
+            ctx.edited += 1
+        # 權限覆寫要等身分組建立後才能比較
+        plan.add(RestoreOp(
+            f"category_edit:{cat.id}", "channel_edit", "edit", f"修改分類 {cat.name}", edit_category,
+            deps=["group:role_create"], group="category_create",
+        ))
+    for index, cdata in enumerate(missing):
+        async def create_category(cdata=cdata):
+            overwrites = ctx.overwrites(cdata.get("overwrites", []))
+            category = await guild.create_category(cdata.get("name", "category"), overwrites=overwrites, reason="AntiNuke360: 還原快照")
+            ctx.link_category(cdata, category)
+            ctx.created_channels += 1
+            return category.id
+        plan.add(RestoreOp(
+            f"category_create:{cdata.get('id', index)}", "channel_create", "create", f"建立分類 {cdata.get('name')}",
+            create_category, deps=["group:role_create"], group="category_create",
+            link=functools.partial(ctx.resume_category, cdata),
+        ))
+
+    # 頻道
+    categories_pending = any(op.key.startswith("category_create:") for op in plan.ops.values())
+    channels_data = sorted(snapshot.get("channels", []), key=lambda c: c.get("position", 0))
+    live_channels = [ch for ch in guild.channels if not isinstance(ch, discord.CategoryChannel)]
+    matches, missing, extra_channels = match_snapshot_items(channels_data, live_channels, kind_of=live_channel_type)
+    for chdata, ch in matches:
+        if chdata.get("type") not in ("text", "voice"):
+            continue
+        if not (roles_pending or categories_pending) and not channel_differs(ctx, chdata, ch):
+            ctx.place_channel(chdata, ch)
+            continue
+
+        async def edit_channel(chdata=chdata, ch=ch):
+            ctx.place_channel(chdata, ch)
+            if not channel_differs(ctx, chdata, ch):
+                return
+            await ch.edit(name=chdata.get("name"), reason="AntiNuke360: 還原快照", **restore_channel_fields(ctx, chdata))
+            ctx.edited += 1
+        plan.add(RestoreOp(
+            f"channel_edit:{ch.id}", "channel_edit", "edit", f"修改頻道 {ch.name}", edit_channel,
+            deps=["group:role_create", "group:category_create"],
+            link=lambda _, chdata=chdata, ch=ch: ctx.resume_channel(chdata, ch.id),
+        ))
+    for index, chdata in enumerate(missing):
+        op = restore_create_channel_op(ctx, chdata, index)
+        if op is not None:
+            op.deps = ["group:role_create", "group:category_create"]
+            plan.add(op)
+
+    for obj in extra + extra_channels:
+        if obj.id in plan.created_ids or not ctx.created_after_snapshot(obj) or not obj.permissions_for(me).manage_channels:
+            continue
+
+        async def delete_channel(obj=obj):
+            await obj.delete(reason="AntiNuke360: 刪除攻擊後建立的頻道")
+            ctx.deleted += 1
+        # 分類要等子頻道移回原分類後才刪除
+        deps = ["group:channel_edit", "group:channel_create"] if isinstance(obj, discord.CategoryChannel) else []
+        plan.add(RestoreOp(f"channel_delete:{obj.id}", "channel_delete", "delete", f"刪除頻道 {obj.name}", delete_channel, deps=deps))
+
+
+def channel_positions_changed(entries: list) -> list:
+    """只保留同一分類中順序與快照不同的頻道。"""
+    groups = defaultdict(list)
+    for ch, pos in entries:
+        groups[getattr(ch, "category_id", None)].append((ch, pos))
+    changed = []
+    for items in groups.values():
+        wanted = [ch.id for ch, _ in sorted(items, key=lambda item: item[1])]
+        current = [ch.id for ch, _ in sorted(items, key=lambda item: item[0].position)]
+        if wanted != current:
+            changed.extend(items)
+    return changed
+
+
+def add_channel_position_op(plan: RestorePlan, ctx: RestoreContext):
+    """
+    頻道順位要等全部建立、修改完才知道，排在最後一步；
+    所有順序有變的頻道以一次 PATCH /guilds/{id}/channels 批次更新。
+    """
+    pending = any(op.key.startswith(("channel_create:", "channel_edit:")) for op in plan.ops.values())
+    if not pending and not channel_positions_changed(ctx.channel_positions.values()):
+        return
+
+    async def reorder_channels():
+        changed = channel_positions_changed(ctx.channel_positions.values())
+        if not changed:
+            return
+        payload = [{"id": ch.id, "position": pos} for ch, pos in changed]
+        try:
+            await bot.http.bulk_channel_update(ctx.guild.id, payload, reason="AntiNuke360: 還原快照")
+        except AttributeError:
+            print("[RESTORE] bulk_channel_update 不可用，改為逐一設定頻道順位")
+            for ch, pos in changed:
+                await ch.edit(position=pos)
+
+    plan.add(RestoreOp(
+        "channel_positions", "channel_positions", "reorder", "調整頻道順位", reorder_channels,
+        deps=["group:channel_create", "group:channel_edit", "group:category_create"],
+    ))
+
+
+def build_restore_plan(guild: discord.Guild, snapshot: dict, mode: str = "reconcile", snapshot_id: int = None,
+                       resume: dict = None) -> RestorePlan:
+    """
+    只讀取現存結構並產生還原計畫，不呼叫任何 Discord API。
+    resume 為上次未完成的還原紀錄時沿用其 plan_id，已完成的操作不再排入。
+    """
+    ctx = RestoreContext(guild, snapshot)
+    if resume:
+        plan = RestorePlan(guild, ctx, mode, resume["plan_id"], snapshot_id, resume["ops"])
+    else:
+        plan = RestorePlan(guild, ctx, mode, f"{snapshot_id}-{mode}-{int(time.time() * 1000)}", snapshot_id)
+    if mode == "full":
+        add_full_restore_ops(plan, ctx)
+    else:
+        add_reconcile_restore_ops(plan, ctx)
+    add_channel_position_op(plan, ctx)
+    plan.stages()  # 提早發現循環相依
+    return plan
+
+
+async def prepare_restore_plan(guild: discord.Guild, snapshot_id: int = None, mode: str = "reconcile"):
+    """載入快照並產生還原計畫，回傳 (plan, 錯誤訊息)。"""
+    snapshot = await run_db(load_snapshot_file, guild.id, snapshot_id)
+    if not snapshot or not snapshot_is_valid(snapshot):
+        return None, "沒有有效的快照可用。"
+    snapshot_id = snapshot.snapshot_id
+    # 同一份快照、同一模式的還原若上次沒跑完，就從中斷處接續
+    run = await run_db(load_restore_run, guild.id)
+    resume = run if run and run["snapshot_id"] == snapshot_id and run["mode"] == mode else None
+    # 解壓縮放在 DB 執行緒池，避免大型快照卡住 event loop
+    snapshot = await run_db(snapshot_content, snapshot)
+    if snapshot is None:
+        return None, "快照資料損毀，無法解壓縮。"
+
+    me = guild.me
+    if not me:
+        return None, "無法取得 Bot 的成員資料。"
+    if not (me.guild_permissions.manage_roles and me.guild_permissions.manage_channels):
+        return None, "權限不足：需要 Manage Roles 與 Manage Channels 權限來還原快照。"
+    try:
+        return build_restore_plan(guild, snapshot, mode, snapshot_id, resume), None
+    except Exception as e:
+        print(f"[RESTORE ERROR] 規劃還原失敗: {e}")
+        return None, f"規劃還原時發生錯誤: {e}"
+
+
+def restore_estimate_summary(estimate: dict) -> str:
+    actions = "、".join(
+        f"{RESTORE_ACTION_NAMES.get(action, action)} {count}" for action, count in estimate["by_action"].items()
+    ) or "無"
+    return (
+        f"共 {estimate['ops']} 個操作（{actions}），分 {estimate['stages']} 個階段，"
+        f"預估 {estimate['requests']} 次 API 請求、約 {estimate['seconds']:.1f} 秒"
+    )
+
+
+async def perform_restore(guild: discord.Guild, ctx_sender=None, snapshot_id: int = None, mode: str = "reconcile"):
+    if guild.id in restores_in_progress:
+        return False, "此伺服器已有還原正在進行。"
+    restores_in_progress.add(guild.id)
+    try:
+        return await _perform_restore(guild, snapshot_id, mode)
+    finally:
+        restores_in_progress.discard(guild.id)
+
+
+async def _perform_restore(guild: discord.Guild, snapshot_id: int, mode: str):
+    # 還原過程中的結構是半成品，不要寫成快照
+    freeze_guild_mirror(guild, "還原快照中")
+    plan, error = await prepare_restore_plan(guild, snapshot_id, mode)
+    if plan is None:
+        return False, error
+
+    try:
+        ctx = plan.ctx
+        if plan.resumed:
+            print(f"[RESTORE] {guild.name} 接續上次未完成的還原 {plan.plan_id}（已完成 {len(plan.completed)} 個操作）")
+        elif not await run_db(start_restore_run, plan):
+            plan.plan_id = None
+        print(f"[RESTORE] {guild.name} 還原計畫：{restore_estimate_summary(plan.estimate())}")
+        stats = await RestoreScheduler(plan).run()
+        # 有操作失敗時保留進度，下次以同一快照還原只會重試失敗的部分
+        if plan.plan_id and not stats["failed"]:
+            await run_db(finish_restore_run, guild.id, plan.plan_id)
+
+        summary = restore_stats_summary(stats)
+        print(f"[RESTORE] {guild.name} 還原完成（{'完整' if mode == 'full' else '差異'}模式）：{summary}")
+        return True, (
+            f"已嘗試還原伺服器結構。建立身分組: {ctx.created_roles}，建立頻道: {ctx.created_channels}，"
+            f"修改: {ctx.edited}，刪除: {ctx.deleted}。{summary}"
+        )
+    except discord.Forbidden as e:
+        print(f"[RESTORE ERROR] 還原失敗: {e}")
+        return False, f"還原失敗: 權限不足 ({e})"
+    except Exception as e:
+        print(f"[RESTORE ERROR] 還原失敗: {e}")
+        return False, f"還原過程中發生錯誤: {e}"
+
+@bot.listen("on_ready")
+async def resume_restores_on_ready():
+    """程序重啟後接續上次中斷的還原；只在第一次 on_ready 檢查，斷線重連不會重跑。"""
+    global restore_resume_checked
+    if restore_resume_checked:
+        return
+    restore_resume_checked = True
+    try:
+        runs = await run_db(storage.load_restore_runs)
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 載入未完成的還原失敗: {e}")
+        return
+    for run in runs:
+        guild = bot.get_guild(int(run["guild_id"]))
+        if guild is None or guild.id in restores_in_progress:
+            continue
+        print(f"[RESTORE] 發現 {guild.name} 有未完成的還原（快照 #{run['snapshot_id']}），自動接續")
+        ok, msg = await perform_restore(guild, snapshot_id=run["snapshot_id"], mode=run["mode"])
+        if not ok:
+            # 快照已過期或權限不足：放棄這次還原的進度
+            print(f"[RESTORE] 無法接續 {guild.name} 的還原: {msg}")
+            await run_db(finish_restore_run, guild.id, run["plan_id"])
+
+
+async def prompt_restore_on_suspect(guild: discord.Guild):
+    freeze_guild_mirror(guild, "偵測到疑似攻擊")
+    now = time.time()
+    if now - restore_prompted[guild.id] < 600:
+        return
+    restore_prompted[guild.id] = now
+    
+    snapshot = await run_db(load_snapshot_file, guild.id)
+    if not snapshot or not snapshot_is_valid(snapshot):
+        return
+    
+    remaining = snapshot_time_remaining(snapshot)
+    owner = guild.owner
+    message_text = (
+        f"AntiNuke360 偵測到你的伺服器可能遭受大規模破壞攻擊。\n"
+        f"AntiNuke360 偵測到一個快照可用，剩餘有效時間: {remaining//3600} 小時 {(remaining%3600)//60} 分鐘。\n"
+        "回覆 `Y` 以自動還原伺服器結構（只修復被改動的部分，並刪除攻擊後建立的身分組與頻道），或回覆 `N` 以略過。\n"
+        "您也可以稍後使用斜線指令 `/restore-snapshot` 手動還原；"
+        "若最新快照已是被破壞後的狀態，可用 `/snapshot-list` 查看較早的快照並指定 `snapshot_id` 還原。"
+    )
+    sent_location = None
+    try:
+        if owner:
+            dm = await owner.create_dm()
+            try:
+                await dm.send(message_text + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
+                sent_location = ("dm", owner.id)
+            except Exception:
+                sent_location = None
+    except Exception:
+        sent_location = None
+    
+    if not sent_location:
+        welcome_ch_id = get_welcome_channel_id(guild.id)
+        target_ch = None
+        if welcome_ch_id:
+            target_ch = guild.get_channel(welcome_ch_id)
+        if not target_ch:
+            target_ch = guild.system_channel
+        if not target_ch:
+            for ch in guild.text_channels:
+                if ch.permissions_for(guild.me).send_messages:
+                    target_ch = ch
+                    break
+        if target_ch:
+            try:
                 await target_ch.send(message_text)
                 sent_location = ("channel", target_ch.id)
             except Exception:
@@ -958,341 +3283,1789 @@ async def prompt_restore_on_suspect(guild: discord.Guild):
         print(f"[PROMPT] 無法通知伺服器擁有者或任何頻道來詢問還原: {guild.name}")
         return
     
-    def check(m: discord.Message):
+    def check(m: discord.Message):
+        try:
+            if sent_location[0] == "dm":
+                return m.author.id == owner.id and isinstance(m.channel, discord.DMChannel) and m.content.strip().upper() in ("Y", "N")
+            else:
+                return m.author.id == owner.id and m.channel.id == sent_location[1] and m.content.strip().upper() in ("Y", "N")
+        except Exception:
+            return False
+    
+    try:
+        resp = await bot.wait_for("message", timeout=300.0, check=check)
+        if resp.content.strip().upper() == "Y":
+            ok, msg = await perform_restore(guild)
+            notify = f"還原結果: {'成功' if ok else '失敗'}。{msg}"
+            try:
+                if sent_location[0] == "dm":
+                    await resp.channel.send(notify + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
+                else:
+                    ch = guild.get_channel(sent_location[1])
+                    if ch:
+                        await ch.send(notify)
+            except Exception:
+                pass
+        else:
+            notify = (
+                "已選擇不還原。\n"
+                "您可以使用斜線指令 `/restore-snapshot` 來手動還原。\n"
+                f"目前快照剩餘有效時間: {remaining//3600} 小時 {(remaining%3600)//60} 分鐘。"
+            )
+            try:
+                if sent_location[0] == "dm":
+                    await resp.channel.send(notify + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
+                else:
+                    ch = guild.get_channel(sent_location[1])
+                    if ch:
+                        await ch.send(notify)
+            except Exception:
+                pass
+    except asyncio.TimeoutError:
+        notify = (
+            "未在 5 分鐘內收到回覆，已取消自動還原操作。\n"
+            "如需還原，請使用斜線指令 `/restore-snapshot`。\n"
+            f"目前快照剩餘有效時間: {remaining//3600} 小時 {(remaining%3600)//60} 分鐘。"
+        )
+        try:
+            if sent_location and sent_location[0] == "dm" and owner:
+                dm = await owner.create_dm()
+                await dm.send(notify + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
+            elif sent_location:
+                ch = guild.get_channel(sent_location[1])
+                if ch:
+                    await ch.send(notify)
+        except Exception:
+            pass
+
+async def scan_and_ban_blacklist(guild):
+    print(f"[SCAN] 開始掃描伺服器 {guild.name} 中的黑名單成員")
+    banned_count = 0
+    scan_count = 0
+    pending = []  # (member, ban_reason)；停權一邊掃描一邊排入處置排程，由 worker 依路由並行度同時執行
+    futures = []
+    try:
+        async for member in guild.fetch_members(limit=None):
+            scan_count += 1
+            if is_globally_blacklisted(member.id):
+                user_id_str = str(member.id)
+                try:
+                    anti_kick = server_whitelists[guild.id]["anti_kick"]
+                    if member.id in anti_kick:
+                        print(f"[SCAN] {member} 在伺服器防踢白名單中，跳過停權")
+                        try:
+                            embed = discord.Embed(title="[AntiNuke360 記錄 - 防踢白名單生效]", color=discord.Color.orange())
+                            embed.description = (
+                                f"被列入全域黑名單的使用者/機器人 `{member}` (ID: `{member.id}`) 在伺服器 `{guild.name}` 中被跳過停權，"
+                                "因為其已被加入本伺服器的防踢白名單。\n\n"
+                                "若您要讓黑名單用戶在此伺服器中不被自動停權，可使用 `/add-server-anti-kick` 將目標 ID 加入防踢白名單。"
+                            )
+                            embed.set_footer(text="AntiNuke360 v1.3.0")
+                            await send_log(guild, embed=embed)
+                        except Exception:
+                            pass
+                        continue
+
+                    if member.id not in banned_in_session[guild.id]:
+                        blacklist_info = bot_blacklist[user_id_str]
+                        ban_reason = blacklist_info.get('reason', '黑名單機器人')
+                        futures.append(mitigation_scheduler.submit(
+                            MITIGATION_BLACKLIST, f"ban:{guild.id}", guild.ban, member, reason=f"AntiNuke360: {ban_reason}"
+                        ))
+                        pending.append((member, ban_reason))
+                except Exception as e:
+                    print(f"[SCAN ERROR] 無法停權 {member}: {e}")
+    except Exception as e:
+        print(f"[SCAN ERROR] 掃描伺服器失敗: {e}")
+
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    for (member, ban_reason), result in zip(pending, results):
+        if isinstance(result, Exception):
+            print(f"[SCAN ERROR] 無法停權 {member}: {result}")
+            continue
+        banned_in_session[guild.id].add(member.id)
+        banned_count += 1
+        print(f"[SCAN] 已停權黑名單成員: {member} (ID: {member.id})")
+
+        try:
+            embed = discord.Embed(title="[AntiNuke360 黑名單停權]", color=discord.Color.red())
+            embed.description = (
+                f"使用者/機器人 `{member}` (ID: `{member.id}`) 已因黑名單紀錄在伺服器 `{guild.name}` 被自動停權。\n\n"
+                f"黑名單原因: {ban_reason}\n\n"
+                "如果您確定此帳號在本伺服器是安全的、並希望未來不要再被自動停權，\n"
+                "伺服器擁有者可以使用 `/add-server-anti-kick` 指令將其加入本伺服器的防踢白名單。"
+            )
+            embed.set_footer(text="AntiNuke360 v1.3.0")
+            await send_log(guild, embed=embed)
+        except Exception:
+            pass
+    print(f"[SCAN] 掃描完成 - 掃描 {scan_count} 人，停權 {banned_count} 人")
+    return scan_count, banned_count
+
+async def check_permission_errors(guild):
+    gid = guild.id
+    now = time.time()
+    while permission_errors[gid] and now - permission_errors[gid][0] > 60:
+        permission_errors[gid].popleft()
+    if len(permission_errors[gid]) >= 10:
+        print(f"[PERMISSION] 伺服器 {guild.name} 1 分鐘內出現 10 次權限錯誤，準備離開")
+        try:
+            embed = discord.Embed(title="身份組權限設錯警告", color=discord.Color.red())
+            embed.description = f"""AntiNuke360 在伺服器 '{guild.name}' 中 1 分鐘內遇到 10 次權限不足錯誤 (403 Forbidden)。
+
+請確保 Bot 的身份組具有以下權限：
+- 封禁成員 (Ban Members)
+- 踢出成員 (Kick Members)
+- 管理頻道 (Manage Channels)
+- 管理身分組 (Manage Roles)
+- 檢視審核日誌 (View Audit Log)
+
+權限不足會導致無法正常防護伺服器，Bot 將自動離開此伺服器。"""
+            embed.set_footer(text="AntiNuke360 v1.3.0")
+            try:
+                await send_log(guild, embed=embed)
+                print(f"[PERMISSION] 已向伺服器所有者/記錄頻道發送通知")
+            except Exception as e:
+                print(f"[PERMISSION ERROR] 無法發送通知: {e}")
+        except Exception as e:
+            print(f"[PERMISSION ERROR] 構建嵌入訊息失敗: {e}")
+        try:
+            await guild.leave()
+            print(f"[PERMISSION] 已自動離開伺服器: {guild.name}")
+        except Exception as e:
+            print(f"[PERMISSION ERROR] 無法離開伺服器: {e}")
+        permission_errors[gid].clear()
+
+# 每個伺服器的信任索引：user_id -> 旗標，由 server_whitelists 建立，名單變動時丟棄、下次查詢再重建
+trust_indexes = {}
+
+
+class GuildTrustIndex:
+    """
+    單一伺服器各名單合成的 user_id -> 旗標。
+    臨時白名單的到期時間放在 min-heap，查詢時只需看堆頂是否到期，不必每次掃描整個 dict。
+    """
+
+    __slots__ = ("guild_id", "flags", "expiries")
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        entry = server_whitelists[guild_id]
+        flags = {}
+        for list_type, flag in (("permanent", TRUST_PERMANENT), ("anti_kick", TRUST_ANTI_KICK), ("temporary", TRUST_TEMPORARY)):
+            for uid in entry[list_type]:
+                flags[uid] = flags.get(uid, 0) | flag
+        for uid in whitelisted_users.get(guild_id, ()):
+            flags[uid] = flags.get(uid, 0) | TRUST_LOCAL
+        self.flags = flags
+        self.expiries = [(expiry, uid) for uid, expiry in entry["temporary"].items()]
+        heapq.heapify(self.expiries)
+
+    def expire(self, now: float):
+        expiries = self.expiries
+        if not expiries or expiries[0][0] > now:
+            return
+        temp = server_whitelists[self.guild_id]["temporary"]
+        while expiries and expiries[0][0] <= now:
+            expiry, uid = heapq.heappop(expiries)
+            if temp.get(uid) != expiry:
+                continue  # 已被移除或重新加入
+            del temp[uid]
+            persist_server_whitelist_entry(self.guild_id, "temporary", uid)
+            flags = self.flags.get(uid, 0) & ~TRUST_TEMPORARY
+            if flags:
+                self.flags[uid] = flags
+            else:
+                self.flags.pop(uid, None)
+
+
+def guild_trust_index(guild_id: int) -> GuildTrustIndex:
+    index = trust_indexes.get(guild_id)
+    if index is None:
+        index = trust_indexes[guild_id] = GuildTrustIndex(guild_id)
+    index.expire(time.time())
+    return index
+
+
+def invalidate_trust_index(guild_id: int):
+    trust_indexes.pop(guild_id, None)
+
+
+def trust_flags(guild, user_id: int) -> int:
+    """回傳 user_id 在此伺服器的信任旗標（伺服器名單、全域黑白名單、擁有者）。"""
+    flags = guild_trust_index(guild.id).flags.get(user_id, 0) | global_trust.get(user_id, 0)
+    if user_id == guild.owner_id:
+        flags |= TRUST_OWNER
+    return flags
+
+
+# Helper functions for server whitelist checks and management
+def purge_expired_temporary(guild_id: int):
+    guild_trust_index(guild_id)
+
+def is_permanent_whitelisted(guild_id: int, user_id: int) -> bool:
+    return bool(guild_trust_index(guild_id).flags.get(user_id, 0) & TRUST_PERMANENT)
+
+def is_temporary_whitelisted(guild_id: int, user_id: int) -> bool:
+    return bool(guild_trust_index(guild_id).flags.get(user_id, 0) & TRUST_TEMPORARY)
+
+def is_anti_kick_whitelisted(guild_id: int, user_id: int) -> bool:
+    return bool(guild_trust_index(guild_id).flags.get(user_id, 0) & TRUST_ANTI_KICK)
+
+def add_temporary_whitelist(guild_id: int, user_id: int):
+    server_whitelists[guild_id]["temporary"][user_id] = time.time() + TEMP_WHITELIST_TTL
+    invalidate_trust_index(guild_id)
+    persist_server_whitelist_entry(guild_id, "temporary", user_id)
+
+def remove_temporary_whitelist(guild_id: int, user_id: int):
+    temp = server_whitelists[guild_id]["temporary"]
+    if user_id in temp:
+        del temp[user_id]
+        invalidate_trust_index(guild_id)
+        persist_server_whitelist_entry(guild_id, "temporary", user_id)
+
+def add_permanent_whitelist(guild_id: int, user_id: int):
+    server_whitelists[guild_id]["permanent"].add(user_id)
+    invalidate_trust_index(guild_id)
+    persist_server_whitelist_entry(guild_id, "permanent", user_id)
+
+def remove_permanent_whitelist(guild_id: int, user_id: int):
+    server_whitelists[guild_id]["permanent"].discard(user_id)
+    invalidate_trust_index(guild_id)
+    persist_server_whitelist_entry(guild_id, "permanent", user_id)
+
+def add_anti_kick_whitelist(guild_id: int, user_id: int):
+    server_whitelists[guild_id]["anti_kick"].add(user_id)
+    invalidate_trust_index(guild_id)
+    persist_server_whitelist_entry(guild_id, "anti_kick", user_id)
+
+def remove_anti_kick_whitelist(guild_id: int, user_id: int):
+    server_whitelists[guild_id]["anti_kick"].discard(user_id)
+    invalidate_trust_index(guild_id)
+    persist_server_whitelist_entry(guild_id, "anti_kick", user_id)
+
+def set_log_channel_for_guild(guild_id: int, channel_id: int):
+    server_whitelists[guild_id]["log_channel"] = channel_id
+    persist_server_settings(guild_id)
+
+def get_log_channel_for_guild(guild_id: int):
+    return server_whitelists[guild_id].get("log_channel")
+
+async def send_log(guild: discord.Guild, content: str = None, embed: discord.Embed = None):
+    log_ch_id = get_log_channel_for_guild(guild.id)
+    sent = False
+    if log_ch_id:
+        ch = guild.get_channel(log_ch_id)
+        if ch and isinstance(ch, discord.TextChannel):
+            try:
+                if ch.permissions_for(guild.me).send_messages:
+                    await ch.send(content=content, embed=embed)
+                    sent = True
+                    return True
+            except Exception:
+                sent = False
+    owner = guild.owner
+    recipients = []
+    if owner:
+        recipients.append(owner)
+    admins = [m for m in guild.members if (m.guild_permissions.administrator or m.guild_permissions.manage_guild) and not m.bot]
+    status_priority = {"online": 0, "idle": 1, "dnd": 2, "offline": 3, None: 3}
+    def admin_sort_key(m):
+        st = getattr(m, "status", None)
+        pr = status_priority.get(str(st), 3)
+        joined = m.joined_at.timestamp() if m.joined_at else 0
+        return (pr, -joined)
+    admins_sorted = sorted(admins, key=admin_sort_key)
+    for a in admins_sorted:
+        if a not in recipients:
+            recipients.append(a)
+        if len(recipients) >= 6:
+            break
+    for r in recipients:
+        try:
+            dm = await r.create_dm()
+            if embed is not None:
+                if embed.footer and embed.footer.text:
+                    footer_text = embed.footer.text + " | 若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
+                else:
+                    footer_text = "若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
+                embed.set_footer(text=footer_text)
+            else:
+                if content is None:
+                    content = ""
+                suffix = "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
+                content = (content or "") + suffix
+            await dm.send(content=content, embed=embed)
+            sent = True
+        except Exception:
+            continue
+    return sent
+
+def build_announcement_embed(message: str, sender_display: str) -> discord.Embed:
+    embed = discord.Embed(
+        title="[AntiNuke360 全服公告]",
+        description=message,
+        color=discord.Color.gold()
+    )
+    embed.add_field(name="發布者", value=sender_display, inline=False)
+    embed.set_footer(text=f"AntiNuke360 {VERSION}")
+    return embed
+
+def get_admin_candidates(guild: discord.Guild):
+    candidates = []
+    seen = set()
+    owner = guild.owner
+    if owner and not owner.bot:
+        candidates.append(owner)
+        seen.add(owner.id)
+    for member in guild.members:
+        if member.bot or member.id in seen:
+            continue
+        perms = member.guild_permissions
+        if perms.administrator or perms.manage_guild:
+            candidates.append(member)
+            seen.add(member.id)
+    return candidates
+
+def member_is_online(member: discord.Member) -> bool:
+    status = getattr(member, "status", discord.Status.offline)
+    return status not in (discord.Status.offline, discord.Status.invisible, None)
+
+async def try_send_announcement_to_log(guild: discord.Guild, message: str, sender_display: str) -> bool:
+    log_ch_id = get_log_channel_for_guild(guild.id)
+    if not log_ch_id:
+        return False
+    channel = guild.get_channel(log_ch_id)
+    if not isinstance(channel, discord.TextChannel):
+        return False
+    if not channel.permissions_for(guild.me).send_messages:
+        return False
+    try:
+        await channel.send(embed=build_announcement_embed(message, sender_display))
+        print(f"[ANNOUNCE] 已在伺服器 {guild.name} 的日誌頻道發布公告")
+        return True
+    except Exception as e:
+        print(f"[ANNOUNCE ERROR] 無法在伺服器 {guild.name} 的日誌頻道發送公告: {e}")
+        return False
+
+async def dm_guild_member(member: discord.Member, message: str, sender_display: str) -> bool:
+    try:
+        dm = await member.create_dm()
+        await dm.send(embed=build_announcement_embed(message, sender_display))
+        print(f"[ANNOUNCE] 已私訊管理員 {member} 發送公告")
+        return True
+    except Exception as e:
+        print(f"[ANNOUNCE ERROR] 無法私訊管理員 {member}: {e}")
+        return False
+
+def schedule_admin_wait_task(guild_id: int, message: str, sender_display: str):
+    task = asyncio.create_task(wait_for_admin_and_dm(guild_id, message, sender_display))
+    pending_announcement_tasks.add(task)
+    task.add_done_callback(lambda t: pending_announcement_tasks.discard(t))
+
+async def wait_for_admin_and_dm(guild_id: int, message: str, sender_display: str):
+    deadline = time.time() + ANNOUNCEMENT_WAIT_TIMEOUT
+    while time.time() < deadline:
+        guild = bot.get_guild(guild_id)
+        if not guild:
+            return
+        admins = get_admin_candidates(guild)
+        if not admins:
+            return
+        for admin in admins:
+            if member_is_online(admin):
+                if await dm_guild_member(admin, message, sender_display):
+                    return
+        await asyncio.sleep(ANNOUNCEMENT_CHECK_INTERVAL)
+    print(f"[ANNOUNCE] 伺服器 {guild_id} 在 12 小時內沒有管理員上線，已取消公告")
+
+async def dispatch_global_announcement(guild: discord.Guild, message: str, sender_display: str) -> str:
+    if await try_send_announcement_to_log(guild, message, sender_display):
+        return "log"
+    admins = get_admin_candidates(guild)
+    if not admins:
+        print(f"[ANNOUNCE] 伺服器 {guild.name} 無可聯絡管理員，跳過")
+        return "no_admin"
+    online_admins = [m for m in admins if member_is_online(m)]
+    for admin in online_admins:
+        if await dm_guild_member(admin, message, sender_display):
+            return "dm"
+    schedule_admin_wait_task(guild.id, message, sender_display)
+    print(f"[ANNOUNCE] 伺服器 {guild.name} 無上線管理員，已排程等待")
+    return "scheduled"
+
+class ActionCounter:
+    """
+    固定大小的環形緩衝區，只記住最近 capacity 次動作的時間。
+    判斷「window 秒內超過 max_count 次」只需要看倒數第 max_count + 1 次是否仍在時間窗內。
+    """
+
+    __slots__ = ("times", "head", "size")
+
+    def __init__(self, capacity: int):
+        self.times = array("d", bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+
+    @property
+    def last(self) -> float:
+        return self.times[self.head - 1] if self.size else 0.0
+
+    def hit(self, now: float, window: float, max_count: int) -> bool:
+        capacity = len(self.times)
+        self.times[self.head] = now
+        self.head = (self.head + 1) % capacity
+        if self.size < capacity:
+            self.size += 1
+        if max_count >= capacity or self.size <= max_count:
+            return False
+        return now - self.times[(self.head - max_count - 1) % capacity] <= window
+
+
+class ThreatScore:
+    """單一執行者跨所有操作類型的威脅分數：只存目前分數與最後更新時間，取用時才套用衰減。"""
+
+    __slots__ = ("value", "updated")
+
+    def __init__(self):
+        self.value = 0.0
+        self.updated = 0.0
+
+    def current(self, now: float) -> float:
+        return self.value * 0.5 ** ((now - self.updated) / THREAT_SCORE_HALF_LIFE)
+
+    def add(self, now: float, weight: float) -> float:
+        self.value = self.current(now) + weight
+        self.updated = now
+        return self.value
+
+
+def score_action(guild, user, action_type: str):
+    """把一次操作計入執行者的威脅分數；超過上限時回傳分數，否則回傳 None。"""
+    weight = THREAT_WEIGHTS.get(action_type)
+    if not weight or THREAT_SCORE_LIMIT <= 0 or guild is None or user is None:
+        return None
+    flags = trust_flags(guild, user.id)
+    if flags & TRUST_EXEMPT:
+        return None
+    limit = THREAT_SCORE_LIMIT
+    if flags & TRUST_TEMPORARY:
+        limit *= TEMP_WHITELIST_MAX / PROTECTION_CONFIG["max_actions"]
+    scores = threat_scores[guild.id]
+    score = scores.get(user.id)
+    if score is None:
+        score = scores[user.id] = ThreatScore()
+    value = score.add(time.time(), weight)
+    return value if value > limit else None
+
+
+def evict_idle_threat_scores(now: float = None) -> int:
+    """刪除已衰減到可忽略的威脅分數，回傳刪除數量。"""
+    now = now or time.time()
+    removed = 0
+    for guild_id in list(threat_scores):
+        scores = threat_scores[guild_id]
+        idle = [uid for uid, score in scores.items() if score.current(now) < 0.05]
+        for uid in idle:
+            del scores[uid]
+        removed += len(idle)
+        if not scores:
+            del threat_scores[guild_id]
+    return removed
+
+
+def action_counter_capacity() -> int:
+    # 一般與臨時白名單兩種門檻共用同一個計數器，容量取較大者 + 1
+    return max(PROTECTION_CONFIG["max_actions"], TEMP_WHITELIST_MAX) + 1
+
+
+def evict_idle_action_counters(now: float = None) -> int:
+    """刪除超過最長時間窗都沒有動作的計數器，回傳刪除數量。"""
+    now = now or time.time()
+    cutoff = now - max(PROTECTION_CONFIG["window_seconds"], TEMP_WHITELIST_WINDOW)
+    removed = 0
+    for guild_id in list(user_actions):
+        counters = user_actions[guild_id]
+        idle = [key for key, counter in counters.items() if counter.last < cutoff]
+        for key in idle:
+            del counters[key]
+        removed += len(idle)
+        if not counters:
+            del user_actions[guild_id]
+    return removed
+
+
+@tasks.loop(seconds=ACTION_COUNTER_GC_INTERVAL)
+async def action_counter_gc_loop():
+    """清除閒置的行為計數器、威脅分數與反被盜帳時間窗。"""
+    removed = evict_idle_action_counters() + evict_idle_threat_scores()
+    if removed:
+        print(f"[TRACK] 已清除 {removed} 個閒置的行為計數器與威脅分數（剩 {sum(len(c) for c in user_actions.values())} 個計數器）")
+    removed = evict_idle_hijack_windows()
+    if removed:
+        print(f"[ANTI HIJACK] 已清除 {removed} 個閒置的訊息時間窗（剩 {sum(len(w) for w in hijack_tracker.values())} 個）")
+
+
+def message_fingerprint(content: str) -> int:
+    return int.from_bytes(hashlib.blake2b(content.encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+
+
+def message_minhash(content: str):
+    """回傳訊息的 bottom-k MinHash 草圖（排序後的 tuple）；訊息太短時回傳 None（改用完全相同比對）。
+
+    兩則訊息字元 shingle 集合的 Jaccard 相似度越高，草圖重疊的雜湊越多。shingle 雜湊使用行程內的
+    hash()，草圖只存在記憶體中，不需跨行程穩定。
+    """
+    text = " ".join(content.casefold().split())[:HIJACK_MINHASH_MAX_CHARS]
+    if len(text) < HIJACK_MINHASH_MIN_CHARS:
+        return None
+    size = HIJACK_SHINGLE_SIZE
+    shingles = set(map(hash, [text[i:i + size] for i in range(len(text) - size + 1)]))
+    return tuple(sorted(shingles)[:HIJACK_MINHASH_SIZE])
+
+
+class HijackWindow:
+    """單一使用者最近 HIJACK_WINDOW_SECONDS 秒內的訊息：(時間, 指紋, 頻道 ID)，長度有上限。"""
+
+    __slots__ = ("entries",)
+
+    def __init__(self):
+        self.entries = deque(maxlen=HIJACK_MAX_ENTRIES)
+
+    @property
+    def last(self) -> float:
+        return self.entries[-1][0] if self.entries else 0.0
+
+    def hit(self, now: float, fingerprint, channel_id: int, match: int = 0) -> bool:
+        """加入一則訊息，回傳相同訊息是否已在足夠多的頻道中重複出現。
+
+        fingerprint 為 64-bit 指紋，或 message_minhash() 的草圖；match > 0 時，草圖至少重疊
+        match 個雜湊的訊息也算相同。時間窗長度有上限，所以每則訊息最多比對 HIJACK_MAX_ENTRIES 次。
+        """
+        entries = self.entries
+        while entries and now - entries[0][0] > HIJACK_WINDOW_SECONDS:
+            entries.popleft()
+        entries.append((now, fingerprint, channel_id))
+        if len(entries) < HIJACK_MIN_MESSAGES:
+            return False
+        sketch = frozenset(fingerprint) if match else None
+        count = 0
+        channels = set()
+        for _, fp, cid in entries:
+            if fp == fingerprint or (match and type(fp) is tuple and len(sketch.intersection(fp)) >= match):
+                count += 1
+                channels.add(cid)
+        return count >= HIJACK_MIN_MESSAGES and len(channels) >= HIJACK_MIN_CHANNELS
+
+
+def evict_idle_hijack_windows(now: float = None) -> int:
+    cutoff = (now or time.time()) - HIJACK_WINDOW_SECONDS
+    removed = 0
+    for guild_id in list(hijack_tracker):
+        windows = hijack_tracker[guild_id]
+        idle = [uid for uid, window in windows.items() if window.last < cutoff]
+        for uid in idle:
+            del windows[uid]
+        removed += len(idle)
+        if not windows:
+            del hijack_tracker[guild_id]
+    return removed
+
+
+def is_tracking_exempt(guild, user) -> bool:
+    """伺服器擁有者與各種白名單不計入異常行為。"""
+    if guild is None or user is None:
+        return True
+    return bool(trust_flags(guild, user.id) & TRUST_EXEMPT)
+
+
+async def track_action(guild, user, action_type):
+    if guild is None or user is None:
+        return False
+    flags = trust_flags(guild, user.id)
+    if flags & TRUST_EXEMPT:
+        return False
+
+    now = time.time()
+    if action_type in SENSITIVE_ACTIONS and flags & TRUST_TEMPORARY:
+        max_count = TEMP_WHITELIST_MAX
+        window = TEMP_WHITELIST_WINDOW
+    else:
+        max_count = PROTECTION_CONFIG["max_actions"]
+        window = PROTECTION_CONFIG["window_seconds"]
+
+    counters = user_actions[guild.id]
+    counter = counters.get((user.id, action_type))
+    if counter is None:
+        counter = counters[(user.id, action_type)] = ActionCounter(action_counter_capacity())
+    return counter.hit(now, window, max_count)
+
+# ========== Mitigation scheduler ==========
+# 封鎖與踢出依優先順序排隊：正在攻擊的帳號最先，其次是黑名單掃描，最後是被盜帳號的踢出。
+# 每個路由（動作 + 伺服器，對應 Discord 的 rate limit bucket）限制同時請求數；
+# discord.py 自己重試後仍回 429 時，依 retry_after 暫停該路由並把工作重新排隊，不佔住 worker。
+MITIGATION_NUKER = 0
+MITIGATION_BLACKLIST = 1
+MITIGATION_HIJACK = 2
+MITIGATION_CLASS_NAMES = {
+    MITIGATION_NUKER: "攻擊者封鎖",
+    MITIGATION_BLACKLIST: "黑名單掃描",
+    MITIGATION_HIJACK: "被盜帳踢出",
+}
+MITIGATION_WORKERS = max(1, int(os.getenv("MITIGATION_WORKERS", "4")))
+MITIGATION_ROUTE_CONCURRENCY = max(1, int(os.getenv("MITIGATION_ROUTE_CONCURRENCY", "2")))
+MITIGATION_RETRIES = max(0, int(os.getenv("MITIGATION_RETRIES", "3")))
+MITIGATION_LATENCY_SAMPLES = 200  # 每個優先等級保留最近幾筆「判定 -> 完成」延遲
+
+
+def rate_limit_delay(error: Exception):
+    """429 錯誤應等待的秒數；不是 rate limit 錯誤時回傳 None。"""
+    if isinstance(error, discord.RateLimited):
+        return error.retry_after
+    if isinstance(error, discord.HTTPException) and error.status == 429:
+        try:
+            return float(error.response.headers.get("Retry-After", 1))
+        except Exception:
+            return 1.0
+    return None
+
+
+class MitigationJob:
+    __slots__ = ("priority", "seq", "route", "call", "args", "kwargs", "future", "decided_at", "attempts")
+
+    def __init__(self, priority: int, seq: int, route: str, call, args: tuple, kwargs: dict, future, decided_at: float):
+        self.priority = priority
+        self.seq = seq  # 同一優先等級內依排入順序執行
+        self.route = route
+        self.call = call
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.decided_at = decided_at
+        self.attempts = 0
+
+
+class MitigationScheduler:
+    """
+    worker 只取出路由還有空位的工作：路由已滿的工作暫存在 parked，等該路由有工作完成再放回佇列，
+    因此單一路由的大量工作不會佔住所有 worker，其他伺服器的高優先工作仍能立即執行。
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.workers = []
+        self.seq = 0
+        self.route_active = defaultdict(int)
+        self.parked = defaultdict(deque)    # route -> 等待路由空位的工作
+        self.route_blocked_until = {}
+        self.latency = {priority: deque(maxlen=MITIGATION_LATENCY_SAMPLES) for priority in MITIGATION_CLASS_NAMES}
+        self.stats = {"done": 0, "failed": 0, "rate_limited": 0}
+
+    def submit(self, priority: int, route: str, call, *args, decided_at: float = None, **kwargs):
+        """排入一個處置動作，回傳完成時帶有結果（或例外）的 future。decided_at 為判定時間（time.monotonic()）。"""
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+        # 補足被取消而結束的 worker
+        self.workers = [worker for worker in self.workers if not worker.done()]
+        while len(self.workers) < MITIGATION_WORKERS:
+            self.workers.append(asyncio.create_task(self._worker()))
+        self.seq += 1
+        future = asyncio.get_running_loop().create_future()
+        self._put(MitigationJob(priority, self.seq, route, call, args, kwargs, future, decided_at or time.monotonic()))
+        return future
+
+    def _put(self, job: MitigationJob):
+        self.queue.put_nowait((job.priority, job.seq, job))
+
+    def _finish(self, job: MitigationJob, result=None, error: Exception = None):
+        if error is None:
+            self.stats["done"] += 1
+            self.latency[job.priority].append(time.monotonic() - job.decided_at)
+        else:
+            self.stats["failed"] += 1
+        if not job.future.done():
+            if error is None:
+                job.future.set_result(result)
+            else:
+                job.future.set_exception(error)
+
+    def _release(self, route: str):
+        self.route_active[route] -= 1
+        if self.route_active[route] <= 0:
+            del self.route_active[route]
+        parked = self.parked.pop(route, None)
+        if parked:
+            for job in parked:
+                self._put(job)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self.queue.get()
+            if job.future.done():
+                continue  # 等待結果的一方已取消
+            blocked = self.route_blocked_until.get(job.route, 0) - time.monotonic()
+            if blocked > 0:
+                loop.call_later(blocked, self._put, job)
+                continue
+            if self.route_active[job.route] >= MITIGATION_ROUTE_CONCURRENCY:
+                self.parked[job.route].append(job)
+                continue
+            self.route_active[job.route] += 1
+            try:
+                result = await job.call(*job.args, **job.kwargs)
+            except Exception as e:
+                delay = rate_limit_delay(e)
+                if delay is not None and job.attempts < MITIGATION_RETRIES:
+                    job.attempts += 1
+                    self.stats["rate_limited"] += 1
+                    self.route_blocked_until[job.route] = time.monotonic() + delay
+                    print(f"[MITIGATION] {job.route} 遭到速率限制，{delay:.1f} 秒後重試（第 {job.attempts} 次）")
+                    loop.call_later(delay, self._put, job)
+                else:
+                    self._finish(job, error=e)
+            except BaseException:
+                # 取消（例如程序關閉）：讓等待結果的一方也收到取消，再結束這個 worker
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            else:
+                self._finish(job, result)
+            finally:
+                self._release(job.route)
+
+    def summary(self) -> str:
+        lines = [
+            f"排隊 {(self.queue.qsize() if self.queue else 0) + sum(len(q) for q in self.parked.values())} 筆，"
+            f"完成 {self.stats['done']}，"
+            f"失敗 {self.stats['failed']}，429 重試 {self.stats['rate_limited']}"
+        ]
+        for priority, name in MITIGATION_CLASS_NAMES.items():
+            samples = sorted(self.latency[priority])
+            if samples:
+                p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+                lines.append(
+                    f"{name}：平均 {sum(samples) / len(samples):.2f} 秒，p95 {p95:.2f} 秒，最大 {samples[-1]:.2f} 秒"
+                )
+        return "\n".join(lines)
+
+
+mitigation_scheduler = MitigationScheduler()
+
+
+async def take_action(guild, user, reason, priority: int = MITIGATION_NUKER):
+    global bot_blacklist, notified_bans
+    gid = guild.id
+    uid = user.id
+    decided_at = time.monotonic()
+
+    if uid in banned_in_session[guild.id]:
+        return
+
+    print(f"[ACTION] 開始處理 {user} (ID: {uid})")
+    freeze_guild_mirror(guild, f"處理 {user} ({reason})")
+    try:
+        await mitigation_scheduler.submit(
+            priority, f"ban:{gid}", guild.ban, user, reason=f"AntiNuke360: {reason}", decided_at=decided_at
+        )
+        banned_in_session[guild.id].add(uid)
+        print(f"[BAN] 成功封鎖 {user}")
+
+        if user.bot:
+            user_id_str = str(uid)
+            if user_id_str not in bot_blacklist:
+                bot_blacklist[user_id_str] = {
+                    "name": str(user),
+                    "reason": reason,
+                    "timestamp": time.time(),
+                    "guilds_detected": [gid]
+                }
+                persist_blacklist(user_id_str)
+                refresh_global_trust(user_id_str)
+            else:
+                guilds_detected = bot_blacklist[user_id_str]["guilds_detected"]
+                if gid not in guilds_detected:
+                    guilds_detected.append(gid)
+                    persist_blacklist(user_id_str)
+            print(f"[BLACKLIST] 已將 {user} 加入全域黑名單")
+            # 在背景掃描，不佔住此伺服器的偵測 worker；同一波攻擊的多個 bot 只會觸發一次掃描
+            request_blacklist_scan()
+
+        if uid not in notified_bans[gid] and guild.owner:
+            notified_bans[gid].add(uid)
+            embed = discord.Embed(title="[AntiNuke360 警報]", color=discord.Color.red())
+            embed.description = (
+                f"使用者 `{user}` (ID: `{uid}`) 已在伺服器 `{guild.name}` 被自動封鎖。\n\n"
+                f"原因: {reason}\n\n"
+                "若此帳號在本伺服器是被允許的，伺服器擁有者可以使用 `/add-server-anti-kick` 指令\n"
+                "將其加入本伺服器的防踢白名單，以避免未來再度因黑名單或異常行為被自動封鎖。"
+            )
+            embed.add_field(name="伺服器", value=guild.name, inline=True)
+            embed.add_field(name="伺服器 ID", value=str(gid), inline=True)
+            embed.set_footer(text="AntiNuke360 v1.3.0")
+            try:
+                await send_log(guild, embed=embed)
+            except Exception:
+                pass
+    except discord.Forbidden as e:
+        print(f"[BAN ERROR] 權限不足: {e}")
+        permission_errors[gid].append(time.time())
+        await check_permission_errors(guild)
+    except Exception as e:
+        print(f"[BAN ERROR] 封鎖失敗: {e}")
+
+BLACKLIST_SCAN_GUILD_CONCURRENCY = max(1, int(os.getenv("BLACKLIST_SCAN_GUILD_CONCURRENCY", "4")))  # 同時掃描的伺服器數
+
+
+async def scan_blacklist_all_guilds():
+    """各伺服器的封鎖走各自的 ban:{guild_id} 路由，因此同時掃描；以 semaphore 限制同時進行的 fetch_members 數量。"""
+    print("[SCAN] 開始在所有伺服器中掃描黑名單成員")
+    semaphore = asyncio.Semaphore(BLACKLIST_SCAN_GUILD_CONCURRENCY)
+
+    async def scan(guild):
+        async with semaphore:
+            return await scan_and_ban_blacklist(guild)
+
+    guilds = list(bot.guilds)
+    results = await asyncio.gather(*(scan(guild) for guild in guilds), return_exceptions=True)
+    total_scanned = 0
+    total_banned = 0
+    for guild, result in zip(guilds, results):
+        if isinstance(result, Exception):
+            print(f"[SCAN ERROR] 無法掃描伺服器 {guild.name}: {result}")
+            continue
+        scan_count, banned_count = result
+        total_scanned += scan_count
+        total_banned += banned_count
+    print(f"[SCAN] 全部伺服器掃描完成 - 共掃描 {total_scanned} 人，停權 {total_banned} 人")
+
+
+BLACKLIST_SCAN_DEBOUNCE = max(0.0, float(os.getenv("BLACKLIST_SCAN_DEBOUNCE", "5")))  # 秒
+blacklist_scan_task = None
+blacklist_scan_pending = False
+
+
+def request_blacklist_scan():
+    """
+    在背景排程一次全伺服器黑名單掃描。
+    等待 BLACKLIST_SCAN_DEBOUNCE 秒內的要求合併成一次；掃描進行中又有要求時，結束後再補掃一次。
+    """
+    global blacklist_scan_task, blacklist_scan_pending
+    blacklist_scan_pending = True
+    if blacklist_scan_task is None or blacklist_scan_task.done():
+        blacklist_scan_task = asyncio.create_task(run_pending_blacklist_scans())
+
+
+async def run_pending_blacklist_scans():
+    global blacklist_scan_pending
+    while blacklist_scan_pending:
+        await asyncio.sleep(BLACKLIST_SCAN_DEBOUNCE)
+        blacklist_scan_pending = False
+        await scan_blacklist_all_guilds()
+
+async def send_welcome_message(guild):
+    try:
+        if not guild.me.guild_permissions.manage_channels:
+            print(f"[WELCOME] 無法創建頻道: 權限不足")
+            return
+        
+        overwrites = {
+            guild.default_role: discord.PermissionOverwrite(send_messages=False),
+            guild.me: discord.PermissionOverwrite(send_messages=True)
+        }
+        
+        channel = await guild.create_text_channel(
+            "antinuke360-welcome",
+            overwrites=overwrites,
+            reason="AntiNuke360 自動設置"
+        )
+        
+        set_welcome_channel(guild.id, channel.id)
+        
+        embed = discord.Embed(
+            title="歡迎使用 AntiNuke360",
+            description="感謝你將 AntiNuke360 加入此伺服器！",
+            color=discord.Color.blurple()
+        )
+        embed.add_field(
+            name="功能介紹",
+            value="""AntiNuke360 是一個強大的伺服器防護機器人，提供以下功能：
+
+自動 Nuke 攻擊防護
+- 偵測大量刪除頻道
+- 偵測大量發送訊息
+- 偵測大量建立 Webhook
+- 偵測大量踢出成員
+- 偵測大量建立角色
+
+全域黑名單系統
+- 自動識別已知的惡意機器人
+- 在試圖加入時立即封鎖
+- 支援手動掃描並停權黑名單成員
+
+本地白名單系統 (新增)
+- 分為：防踢白名單 / 臨時白名單 / 永久白名單
+- 防踢白名單：允許被列入全域黑名單的帳號/機器人加入此伺服器（僅限伺服器擁有者管理）
+- 臨時白名單：在 1 小時內對敏感操作放寬至 15 次 / 15 秒（管理員可增刪）
+- 永久白名單：對敏感操作完全免疫，無時間限制（僅限伺服器擁有者管理）
+
+固定防護參數
+- 最優的靈敏度設置
+- 無法調整(確保一致性)
+
+進階保護 (v1.2.3)
+- 黑名單訊息即時屏蔽（非防踢白名單）
+- 反外部應用程式刷屏（5 秒內 3 則相同訊息，支援禁言設定）
+- 反被盜帳（5 秒內在不同頻道發送 3 次相同訊息，DM 邀請 + 踢出/只刪訊息）""",
+            inline=False
+        )
+        
+        embed.add_field(
+            name="使用指南",
+            value="""管理員指令:
+/status - 查看防護狀態
+/add-server-temp [ID] - 將成員或機器人加入本伺服器臨時白名單 (管理員，可移除)
+/remove-server-temp [ID]
+/set-log-channel [#channel] - 指定記錄頻道 (管理員)
+/toggle-anti-hijack [on/off] [similarity] - 開啟或關閉反被盜帳功能，可選擇偵測近似內容 (管理員)
+
+伺服器擁有者指令:
+/add-server-anti-kick [ID] - 防踢白名單 (僅擁有者)
+/remove-server-anti-kick [ID]
+/add-server-perm [ID] - 永久白名單 (僅擁有者)
+/remove-server-perm [ID]
+
+開發者指令:
+/add-black [ID] [原因] - 加入全域黑名單
+/remove-black [ID] - 移除全域黑名單
+/add-white [ID] [原因] - 加入全域白名單
+/remove-white [ID] - 移除全域白名單
+/blacklist - 查看全域黑名單
+/whitelist-list - 查看全域白名單
+/scan-all-guilds - 在所有伺服器掃描並停權黑名單成員
+
+還原快照:
+/snapshot-list - 列出本伺服器保留的快照世代 (管理員)
+/restore-snapshot [快照 ID] [dry_run] - 還原伺服器快照，預設為最新；dry_run 只試算計畫 (管理員)""",
+            inline=False
+        )
+        
+        embed.add_field(
+            name="防護參數 (固定)",
+            value=f"""最大動作次數: {PROTECTION_CONFIG['max_actions']}
+時間窗口: {PROTECTION_CONFIG['window_seconds']} 秒
+狀態: 啟用
+
+參數已優化，無法調整""",
+            inline=False
+        )
+        
+        embed.add_field(
+            name="遇到問題？",
+            value="如有任何問題或建議，請聯繫伺服器管理員或機器人開發者。",
+            inline=False
+        )
+        
+        embed.set_footer(text="AntiNuke360 v1.3.0 | 伺服器防護專家（Snapshot 已存於 MySQL）")
+        
+        await channel.send(embed=embed)
+        print(f"[WELCOME] 已在伺服器 {guild.name} 創建歡迎頻道")
+        
+    except Exception as e:
+        print(f"[WELCOME ERROR] 創建歡迎訊息失敗: {e}")
+
+@bot.event
+async def on_guild_join(guild):
+    print(f"[JOIN] 已加入新伺服器: {guild.name} (ID: {guild.id})")
+    add_to_guilds_data(guild.id)
+    if guild.id not in server_whitelists:
+        server_whitelists[guild.id] = {"anti_kick": set(), "temporary": {}, "permanent": set(), "log_channel": None}
+        invalidate_trust_index(guild.id)
+    await send_welcome_message(guild)
+
+    async def delayed_admin_check(g: discord.Guild):
+        try:
+            await asyncio.sleep(600)
+            if g not in bot.guilds:
+                return
+            me = g.me
+            if not me or not me.guild_permissions.administrator:
+                print(f"[PERMISSION CHECK] 在伺服器 {g.name} 中 10 分鐘後仍沒有 Administrator 權限，將通知並自動離開")
+
+                recipients = []
+                owner = g.owner
+                if owner:
+                    recipients.append(owner)
+
+                admins = [m for m in g.members if m.guild_permissions.administrator and not m.bot]
+
+                status_priority = {"online": 0, "idle": 1, "dnd": 2, "offline": 3, None: 3}
+                def admin_sort_key(m):
+                    st = getattr(m, "status", None)
+                    pr = status_priority.get(str(st), 3)
+                    joined = m.joined_at.timestamp() if m.joined_at else 0
+                    return (pr, -joined)
+
+                admins_sorted = sorted(admins, key=admin_sort_key)
+
+                for a in admins_sorted:
+                    if a not in recipients:
+                        recipients.append(a)
+                    if len(recipients) >= 6:
+                        break
+
+                text = (
+                    f"您好，這裡是 **AntiNuke360 {VERSION}**。\n\n"
+                    "機器人需要 **Administrator** 權限才能正常運作，包含偵測與阻止 nuke 攻擊、封鎖黑名單機器人，"
+                    "以及在伺服器遭受破壞時進行自動還原等功能。\n\n"
+                    "目前我在此伺服器中沒有 **Administrator** 權限，因此將自動離開。\n"
+                    "請在重新邀請本機器人時，勾選 **Administrator** 權限。\n\n"
+                    "若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
+                )
+
+                for r in recipients:
+                    try:
+                        dm = await r.create_dm()
+                        await dm.send(text)
+                    except Exception:
+                        continue
+
+                try:
+                    await g.leave()
+                    print(f"[PERMISSION CHECK] 已因缺少 Administrator 權限離開伺服器: {g.name}")
+                except Exception as e:
+                    print(f"[PERMISSION CHECK ERROR] 無法離開伺服器 {g.name}: {e}")
+        except Exception as e:
+            print(f"[PERMISSION CHECK ERROR] 在 on_guild_join 延遲檢查 Administrator 權限時發生錯誤: {e}")
+
+    asyncio.create_task(delayed_admin_check(guild))
+
+    async def retry_welcome_channel(g: discord.Guild):
+        try:
+            while True:
+                if g not in bot.guilds:
+                    print(f"[WELCOME RETRY] Bot 已不在伺服器 {g.name} 中，停止重試創建歡迎頻道")
+                    return
+
+                welcome_id = get_welcome_channel_id(g.id)
+                has_welcome = False
+                if welcome_id:
+                    ch = g.get_channel(welcome_id)
+                    if isinstance(ch, discord.TextChannel):
+                        has_welcome = True
+
+                if has_welcome:
+                    print(f"[WELCOME RETRY] 已確認伺服器 {g.name} 擁有歡迎頻道，停止重試")
+                    return
+
+                print(f"[WELCOME RETRY] 伺服器 {g.name} 尚未成功建立歡迎頻道，嘗試重新建立...")
+                await send_welcome_message(g)
+
+                welcome_id = get_welcome_channel_id(g.id)
+                has_welcome = False
+                if welcome_id:
+                    ch = g.get_channel(welcome_id)
+                    if isinstance(ch, discord.TextChannel):
+                        has_welcome = True
+
+                if has_welcome:
+                    print(f"[WELCOME RETRY] 已在伺服器 {g.name} 成功建立歡迎頻道 (重試)")
+                    return
+
+                await asyncio.sleep(60)
+        except Exception as e:
+            print(f"[WELCOME RETRY ERROR] 在重試建立歡迎頻道時發生錯誤 (伺服器: {g.name}): {e}")
+
+    asyncio.create_task(retry_welcome_channel(guild))
+
+@bot.event
+async def on_guild_remove(guild):
+    print(f"[LEAVE] 已從伺服器移除: {guild.name} (ID: {guild.id})")
+    remove_from_guilds_data(guild.id)
+    if guild.id in server_whitelists:
+        del server_whitelists[guild.id]
+    persist_server_guild_delete(guild.id)
+    if guild.id in permission_errors:
+        del permission_errors[guild.id]
+    user_actions.pop(guild.id, None)
+    threat_scores.pop(guild.id, None)
+    trust_indexes.pop(guild.id, None)
+    hijack_tracker.pop(guild.id, None)
+
+@bot.event
+async def on_member_join(member):
+    guild = member.guild
+    flags = trust_flags(guild, member.id)
+    
+    if member.bot:
         try:
-            if sent_location[0] == "dm":
-                return m.author.id == owner.id and isinstance(m.channel, discord.DMChannel) and m.content.strip().upper() in ("Y", "N")
-            else:
-                return m.author.id == owner.id and m.channel.id == sent_location[1] and m.content.strip().upper() in ("Y", "N")
-        except Exception:
-            return False
+            await create_snapshot(guild)
+        except Exception as e:
+            print(f"[SNAPSHOT ERROR] 建立快照時發生錯誤: {e}")
     
-    try:
-        resp = await bot.wait_for("message", timeout=300.0, check=check)
-        if resp.content.strip().upper() == "Y":
-            ok, msg = await perform_restore(guild)
-            notify = f"還原結果: {'成功' if ok else '失敗'}。{msg}"
-            try:
-                if sent_location[0] == "dm":
-                    await resp.channel.send(notify + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
-                else:
-                    ch = guild.get_channel(sent_location[1])
-                    if ch:
-                        await ch.send(notify)
-            except Exception:
-                pass
-        else:
-            notify = (
-                "已選擇不還原。\n"
-                "您可以使用斜線指令 `/restore-snapshot` 來手動還原。\n"
-                f"目前快照剩餘有效時間: {remaining//3600} 小時 {(remaining%3600)//60} 分鐘。"
+    if flags & TRUST_GLOBAL_BLACK:
+        if flags & TRUST_ANTI_KICK:
+            print(f"[JOIN] {member} (全域黑名單但在伺服器防踢白名單) 加入伺服器 {guild.name}，允許")
+            embed = discord.Embed(title="[AntiNuke360 記錄]", color=discord.Color.orange())
+            embed.description = (
+                f"被列入全域黑名單的使用者/機器人 `{member}` (ID: `{member.id}`) 被允許加入此伺服器，"
+                "因為其在本伺服器的防踢白名單中。\n\n"
+                "若您要讓特定黑名單用戶在本伺服器中不被自動停權，可以使用 `/add-server-anti-kick` 將其加入防踢白名單。"
             )
+            embed.add_field(name="伺服器", value=guild.name, inline=True)
+            embed.set_footer(text="AntiNuke360 v1.3.0")
             try:
-                if sent_location[0] == "dm":
-                    await resp.channel.send(notify + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
-                else:
-                    ch = guild.get_channel(sent_location[1])
-                    if ch:
-                        await ch.send(notify)
+                await send_log(guild, embed=embed)
             except Exception:
                 pass
-    except asyncio.TimeoutError:
-        notify = (
-            "未在 5 分鐘內收到回覆，已取消自動還原操作。\n"
-            "如需還原，請使用斜線指令 `/restore-snapshot`。\n"
-            f"目前快照剩餘有效時間: {remaining//3600} 小時 {(remaining%3600)//60} 分鐘。"
-        )
+            return
+        print(f"[JOIN] {member} (黑名單機器人) 試圖加入伺服器 {guild.name}，立即封鎖")
         try:
-            if sent_location and sent_location[0] == "dm" and owner:
-                dm = await owner.create_dm()
-                await dm.send(notify + "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。")
-            elif sent_location:
-                ch = guild.get_channel(sent_location[1])
-                if ch:
-                    await ch.send(notify)
-        except Exception:
-            pass
-
-async def scan_and_ban_blacklist(guild):
-    print(f"[SCAN] 開始掃描伺服器 {guild.name} 中的黑名單成員")
-    banned_count = 0
-    scan_count = 0
-    try:
-        async for member in guild.fetch_members(limit=None):
-            scan_count += 1
-            user_id_str = str(member.id)
-            if user_id_str in bot_blacklist:
+            blacklist_info = bot_blacklist[str(member.id)]
+            ban_reason = blacklist_info.get('reason', '在其他伺服器進行 Nuke 攻擊')
+            await mitigation_scheduler.submit(
+                MITIGATION_BLACKLIST, f"ban:{guild.id}", guild.ban, member, reason=f"AntiNuke360: 黑名單機器人 - {ban_reason}"
+            )
+            print(f"[BAN] 已封鎖黑名單機器人 {member}")
+            
+            if member.id not in notified_bans[guild.id]:
+                notified_bans[guild.id].add(member.id)
+                embed = discord.Embed(title="[AntiNuke360 警報]", color=discord.Color.red())
+                embed.description = (
+                    f"黑名單機器人 `{member}` (ID: `{member.id}`) 試圖加入伺服器被自動封鎖。\n\n"
+                    f"被列入黑名單的原因: {ban_reason}\n\n"
+                    "如果您確定此機器人在本伺服器是被允許的，伺服器擁有者可以使用 `/add-server-anti-kick`，\n"
+                    "將其加入本伺服器的防踢白名單，以避免未來再度被自動封鎖。"
+                )
+                embed.add_field(name="伺服器", value=guild.name, inline=True)
+                embed.set_footer(text="AntiNuke360 v1.3.0")
                 try:
-                    anti_kick = server_whitelists[guild.id]["anti_kick"]
-                    if member.id in anti_kick:
-                        print(f"[SCAN] {member} 在伺服器防踢白名單中，跳過停權")
-                        try:
-                            embed = discord.Embed(title="[AntiNuke360 記錄 - 防踢白名單生效]", color=discord.Color.orange())
-                            embed.description = (
-                                f"被列入全域黑名單的使用者/機器人 `{member}` (ID: `{member.id}`) 在伺服器 `{guild.name}` 中被跳過停權，"
-                                "因為其已被加入本伺服器的防踢白名單。\n\n"
-                                "若您要讓黑名單用戶在此伺服器中不被自動停權，可使用 `/add-server-anti-kick` 將目標 ID 加入防踢白名單。"
-                            )
-                            embed.set_footer(text="AntiNuke360 v1.3.0")
-                            await send_log(guild, embed=embed)
-                        except Exception:
-                            pass
-                        continue
+                    await send_log(guild, embed=embed)
+                except Exception:
+                    pass
+                
+                try:
+                    await member.send(embed=embed)
+                except Exception:
+                    pass
+        except Exception as e:
+            print(f"[BAN ERROR] 無法封鎖 {member}: {e}")
+    elif flags & TRUST_GLOBAL_WHITE:
+        print(f"[JOIN] {member} (全域白名單機器人) 加入伺服器 {guild.name}，允許")
+    elif flags & TRUST_PERMANENT:
+        print(f"[JOIN] {member} (本伺服器永久白名單) 加入伺服器 {guild.name}，允許")
 
-                    if member.id not in banned_in_session[guild.id]:
-                        blacklist_info = bot_blacklist[user_id_str]
-                        ban_reason = blacklist_info.get('reason', '黑名單機器人')
-                        await guild.ban(member, reason=f"AntiNuke360: {ban_reason}")
-                        banned_in_session[guild.id].add(member.id)
-                        banned_count += 1
-                        print(f"[SCAN] 已停權黑名單成員: {member} (ID: {member.id})")
+# ========== Detection event router ==========
+# 偵測事件依伺服器放進各自的有界佇列，由該伺服器專屬的 worker 依序處理（稽核日誌查詢、封鎖、通知）。
+# 單一伺服器被洗版時只會塞住自己的佇列，不會拖慢其他伺服器的封鎖。
+DETECTION_QUEUE_SIZE = max(10, int(os.getenv("DETECTION_QUEUE_SIZE", "1000")))          # 每個伺服器佇列上限
+DETECTION_LOW_VALUE_POLICY = os.getenv("DETECTION_LOW_VALUE_POLICY", "merge").lower()  # merge / drop
+DETECTION_WORKER_IDLE = max(5, int(os.getenv("DETECTION_WORKER_IDLE", "60")))           # worker 閒置多久後結束（秒）
+# 低價值事件：同一使用者尚未處理的事件可合併，佇列滿時優先捨棄
+DETECTION_LOW_VALUE_EVENTS = {"message_send"}
 
-                        try:
-                            embed = discord.Embed(title="[AntiNuke360 黑名單停權]", color=discord.Color.red())
-                            embed.description = (
-                                f"使用者/機器人 `{member}` (ID: `{member.id}`) 已因黑名單紀錄在伺服器 `{guild.name}` 被自動停權。\n\n"
-                                f"黑名單原因: {ban_reason}\n\n"
-                                "如果您確定此帳號在本伺服器是安全的、並希望未來不要再被自動停權，\n"
-                                "伺服器擁有者可以使用 `/add-server-anti-kick` 指令將其加入本伺服器的防踢白名單。"
-                            )
-                            embed.set_footer(text="AntiNuke360 v1.3.0")
-                            await send_log(guild, embed=embed)
-                        except Exception:
-                            pass
+# guild_id -> GuildEventQueue
+detection_queues = {}
+detection_stats = {"queued": 0, "processed": 0, "merged": 0, "dropped": 0, "blocked": 0, "errors": 0}
+
+
+class DetectionEvent:
+    __slots__ = ("kind", "handler", "args", "key", "queued_at", "count")
+
+    def __init__(self, kind: str, handler, args: tuple, key=None):
+        self.kind = kind
+        self.handler = handler
+        self.args = args
+        self.key = key
+        self.queued_at = time.time()
+        self.count = 1  # 合併進來的事件數
+
+    @property
+    def low_value(self) -> bool:
+        return self.kind in DETECTION_LOW_VALUE_EVENTS
+
+    def run(self):
+        if self.count > 1:
+            return self.handler(*self.args, count=self.count)
+        return self.handler(*self.args)
+
+
+class GuildEventQueue:
+    """單一伺服器的偵測事件佇列與 worker。
+
+    低價值事件與其他事件分開排隊，worker 先處理其他事件（封鎖、稽核日誌），兩邊各自以 DETECTION_QUEUE_SIZE 為上限：
+    低價值事件滿了就捨棄（merge 策略下會先合併到同一 key 尚未處理的事件），其他事件滿了則等待空位，
+    只有這個伺服器的事件處理會被擋住。
+    """
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.urgent = deque()
+        self.bulk = deque()     # 低價值事件
+        self.pending = {}       # key -> 尚未處理、可合併的低價值事件
+        self.ready = asyncio.Event()
+        self.space = asyncio.Event()
+        self.space.set()
+        self.worker = None
+        self.peak = 0
+        self.processed = 0
+        self.merged = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self):
+        return len(self.urgent) + len(self.bulk)
+
+    @property
+    def lag(self) -> float:
+        """最久的排隊事件已等待的秒數。"""
+        oldest = min((q[0].queued_at for q in (self.urgent, self.bulk) if q), default=None)
+        return time.time() - oldest if oldest is not None else 0.0
+
+    def ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+
+    def _queued(self):
+        self.peak = max(self.peak, len(self))
+        detection_stats["queued"] += 1
+        self.ready.set()
+
+    async def put(self, event: DetectionEvent):
+        if event.low_value:
+            queued = self.pending.get(event.key) if event.key is not None else None
+            if queued is not None:
+                queued.count += 1
+                self.merged += 1
+                detection_stats["merged"] += 1
+            elif len(self.bulk) >= DETECTION_QUEUE_SIZE:
+                self.dropped += 1
+                detection_stats["dropped"] += 1
+            else:
+                self.bulk.append(event)
+                if event.key is not None and DETECTION_LOW_VALUE_POLICY == "merge":
+                    self.pending[event.key] = event
+                self._queued()
+            return
+        while len(self.urgent) >= DETECTION_QUEUE_SIZE:
+            detection_stats["blocked"] += 1
+            self.space.clear()
+            await self.space.wait()
+        self.urgent.append(event)
+        self._queued()
+
+    def _next(self) -> DetectionEvent:
+        if self.urgent:
+            event = self.urgent.popleft()
+            self.space.set()
+            return event
+        event = self.bulk.popleft()
+        if event.key is not None and self.pending.get(event.key) is event:
+            del self.pending[event.key]
+        return event
+
+    async def run(self):
+        try:
+            while True:
+                if not self.urgent and not self.bulk:
+                    self.ready.clear()
+                    try:
+                        await asyncio.wait_for(self.ready.wait(), DETECTION_WORKER_IDLE)
+                    except asyncio.TimeoutError:
+                        if not self.urgent and not self.bulk:
+                            return
+                    continue
+                event = self._next()
+                self.last_lag = time.time() - event.queued_at
+                self.max_lag = max(self.max_lag, self.last_lag)
+                try:
+                    await event.run()
                 except Exception as e:
-                    print(f"[SCAN ERROR] 無法停權 {member}: {e}")
-    except Exception as e:
-        print(f"[SCAN ERROR] 掃描伺服器失敗: {e}")
-    print(f"[SCAN] 掃描完成 - 掃描 {scan_count} 人，停權 {banned_count} 人")
-    return scan_count, banned_count
+                    detection_stats["errors"] += 1
+                    print(f"[QUEUE] 伺服器 {self.guild_id} 處理 {event.kind} 事件失敗: {e}")
+                self.processed += 1
+                detection_stats["processed"] += 1
+        finally:
+            # 閒置結束：移除佇列釋放記憶體，下一個事件會重新建立
+            if detection_queues.get(self.guild_id) is self and not len(self):
+                del detection_queues[self.guild_id]
 
-async def check_permission_errors(guild):
-    gid = guild.id
-    now = time.time()
-    while permission_errors[gid] and now - permission_errors[gid][0] > 60:
-        permission_errors[gid].popleft()
-    if len(permission_errors[gid]) >= 10:
-        print(f"[PERMISSION] 伺服器 {guild.name} 1 分鐘內出現 10 次權限錯誤，準備離開")
+
+async def route_detection_event(guild: discord.Guild, kind: str, handler, *args, key=None):
+    """把偵測事件交給該伺服器的 worker；handler 是之後以 *args 呼叫的協程函式。"""
+    queue = detection_queues.get(guild.id)
+    if queue is None:
+        queue = detection_queues[guild.id] = GuildEventQueue(guild.id)
+    queue.ensure_worker()
+    await queue.put(DetectionEvent(kind, handler, args, key))
+
+
+def detection_queue_summary(guild_id: int = None) -> str:
+    queues = list(detection_queues.values())
+    text = (
+        f"使用中佇列 {len(queues)} 個，排隊 {sum(len(q) for q in queues)} 筆，"
+        f"最久等待 {max((q.lag for q in queues), default=0.0):.2f} 秒\n"
+        f"累計處理 {detection_stats['processed']}，合併 {detection_stats['merged']}，"
+        f"捨棄 {detection_stats['dropped']}，等待空位 {detection_stats['blocked']}，錯誤 {detection_stats['errors']}"
+    )
+    queue = detection_queues.get(guild_id)
+    if queue is not None:
+        text += (
+            f"\n本伺服器：排隊 {len(queue)}（峰值 {queue.peak}），"
+            f"延遲 {queue.last_lag:.2f} 秒（最大 {queue.max_lag:.2f} 秒）"
+        )
+    return text
+
+
+@bot.listen("on_guild_remove")
+async def detection_queue_on_guild_remove(guild):
+    queue = detection_queues.pop(guild.id, None)
+    if queue is not None and queue.worker is not None:
+        queue.worker.cancel()
+
+
+# ========== Audit log reader ==========
+# 偵測主要由 gateway 的 on_audit_log_entry_create 驅動：事件本身就帶有執行者、動作與目標，不需要額外的 HTTP 請求。
+# 該伺服器最近 AUDIT_GATEWAY_STALE_SECONDS 秒內沒有收到該事件時（例如剛連線、缺少 intent 或權限），才退回由結構事件查詢稽核日誌：每個伺服器一個讀取器，同一時間只送一個請求，
+# 事件發生後才開始的請求結果由所有事件共用，並以 after=<上次看到的 ID> 增量讀取。
+# 兩條路徑以稽核日誌項目 ID 去重，同一筆項目只會計算一次。
+
+AUDIT_LOG_MAX_AGE = max(5, int(os.getenv("AUDIT_LOG_MAX_AGE", "60")))            # 快取保留多久內的項目（秒）
+AUDIT_LOG_PAGE_LIMIT = 100                                                       # 單次請求的上限（Discord 最多 100）
+AUDIT_LOG_MAX_PAGES = max(1, int(os.getenv("AUDIT_LOG_MAX_PAGES", "3")))          # 每次更新最多讀幾頁
+AUDIT_LOG_RETRY_DELAY = max(0.0, float(os.getenv("AUDIT_LOG_RETRY_DELAY", "0.5")))  # 找不到項目時等待稽核日誌寫入的秒數
+AUDIT_LOG_RETRIES = max(0, int(os.getenv("AUDIT_LOG_RETRIES", "2")))
+AUDIT_LOG_PROCESSED_LIMIT = 1000                                                 # 每個伺服器記住多少筆已處理的項目 ID
+AUDIT_GATEWAY_STALE_SECONDS = max(1, int(os.getenv("AUDIT_GATEWAY_STALE_SECONDS", "300")))  # 多久沒收到 gateway 事件就退回查詢
+
+audit_log_stats = {"lookups": 0, "requests": 0, "gateway": 0}
+# guild_id -> 最近一次收到 gateway 稽核日誌事件的時間（time.monotonic()）；
+# 在 AUDIT_GATEWAY_STALE_SECONDS 內收到過的伺服器，結構事件就不再自行查詢稽核日誌
+audit_gateway_seen = {}
+
+
+def audit_gateway_active(guild_id: int) -> bool:
+    seen = audit_gateway_seen.get(guild_id)
+    return seen is not None and time.monotonic() - seen < AUDIT_GATEWAY_STALE_SECONDS
+
+# 會計入異常行為的稽核日誌動作：action -> (track_action 的類型, 封鎖原因)
+AUDIT_DETECTION_RULES = {
+    discord.AuditLogAction.channel_create: ("channel_create", "行為異常：短時間內大量建立頻道"),
+    discord.AuditLogAction.channel_delete: ("channel_delete", "行為異常：短時間內大量刪除頻道"),
+    discord.AuditLogAction.kick: ("member_kick", "行為異常：短時間內大量踢出成員"),
+    discord.AuditLogAction.ban: ("member_ban", "行為異常：短時間內大量停權成員"),
+    discord.AuditLogAction.role_create: ("role_create", "行為異常：短時間內大量建立身分組"),
+    discord.AuditLogAction.webhook_create: ("webhook_create", "行為異常：短時間內大量建立 Webhook"),
+}
+
+
+def snowflake_from_time(ts: float) -> int:
+    """把 Unix 秒換成同時間的 Discord snowflake（用於 after= 分頁）。"""
+    return max(0, int(ts * 1000) - 1420070400000) << 22
+
+
+class AuditLogReader:
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.entries = deque()
+        self.last_id = None
+        self.fetched_at = 0.0      # 最近一次完成的請求「開始」的時間（monotonic）
+        self._task = None
+        self._task_started = 0.0
+        self.processed = set()
+        self.processed_order = deque()
+
+    def claim(self, entry_id: int) -> bool:
+        """第一次看到這筆項目時回傳 True；gateway 與查詢兩條路徑共用，避免重複計算。"""
+        if entry_id in self.processed:
+            return False
+        self.processed.add(entry_id)
+        self.processed_order.append(entry_id)
+        if len(self.processed_order) > AUDIT_LOG_PROCESSED_LIMIT:
+            self.processed.discard(self.processed_order.popleft())
+        return True
+
+    def _prune(self):
+        cutoff = time.time() - AUDIT_LOG_MAX_AGE
+        while self.entries and snowflake_timestamp(self.entries[0].id) < cutoff:
+            self.entries.popleft()
+
+    async def _fetch(self, guild: discord.Guild):
+        if self.last_id is None:
+            self.last_id = snowflake_from_time(time.time() - AUDIT_LOG_MAX_AGE)
+        for _ in range(AUDIT_LOG_MAX_PAGES):
+            audit_log_stats["requests"] += 1
+            count = 0
+            async for entry in guild.audit_logs(limit=AUDIT_LOG_PAGE_LIMIT, after=discord.Object(id=self.last_id)):
+                count += 1
+                if entry.id > self.last_id:
+                    self.entries.append(entry)
+                    self.last_id = entry.id
+            if count < AUDIT_LOG_PAGE_LIMIT:
+                break
+        self._prune()
+
+    async def refresh(self, guild: discord.Guild, not_before: float):
+        """確保快取至少包含 not_before（monotonic）之後才開始讀取的結果；進行中的請求若夠新就直接共用。"""
+        while self.fetched_at < not_before:
+            if self._task is None:
+                self._task_started = time.monotonic()
+                self._task = asyncio.ensure_future(self._fetch(guild))
+                self._task.add_done_callback(self._fetch_done)
+            started = self._task_started
+            await asyncio.shield(self._task)
+            if started >= not_before:
+                return
+
+    def _fetch_done(self, task):
+        self._task = None
+        if not task.cancelled() and task.exception() is None:
+            self.fetched_at = self._task_started
+        elif not task.cancelled():
+            print(f"[AUDIT] 讀取伺服器 {self.guild_id} 的稽核日誌失敗: {task.exception()}")
+
+    def find(self, action, target_id: int = None):
+        """由新到舊找出第一筆符合 action（與 target）的項目。"""
+        for entry in reversed(self.entries):
+            if entry.action != action:
+                continue
+            if target_id is not None and getattr(entry.target, "id", None) != target_id:
+                continue
+            return entry
+        return None
+
+
+audit_log_readers = {}
+
+
+def get_audit_log_reader(guild: discord.Guild) -> AuditLogReader:
+    reader = audit_log_readers.get(guild.id)
+    if reader is None:
+        reader = audit_log_readers[guild.id] = AuditLogReader(guild.id)
+    return reader
+
+
+async def find_audit_entry(guild: discord.Guild, action, target_id: int = None):
+    """
+    取得觸發事件對應的稽核日誌項目。項目可能比 gateway 事件晚一點才寫入，
+    找不到時等待 AUDIT_LOG_RETRY_DELAY 秒後再讀一次（同樣和其他事件共用請求）。
+    """
+    audit_log_stats["lookups"] += 1
+    reader = get_audit_log_reader(guild)
+    event_time = time.monotonic()
+    for attempt in range(AUDIT_LOG_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(AUDIT_LOG_RETRY_DELAY)
         try:
-            embed = discord.Embed(title="身份組權限設錯警告", color=discord.Color.red())
-            embed.description = f"""AntiNuke360 在伺服器 '{guild.name}' 中 1 分鐘內遇到 10 次權限不足錯誤 (403 Forbidden)。
+            await reader.refresh(guild, event_time if not attempt else time.monotonic())
+        except Exception:
+            return None
+        entry = reader.find(action, target_id)
+        if entry is not None:
+            return entry
+    return None
 
-請確保 Bot 的身份組具有以下權限：
-- 封禁成員 (Ban Members)
-- 踢出成員 (Kick Members)
-- 管理頻道 (Manage Channels)
-- 管理身分組 (Manage Roles)
-- 檢視審核日誌 (View Audit Log)
 
-權限不足會導致無法正常防護伺服器，Bot 將自動離開此伺服器。"""
-            embed.set_footer(text="AntiNuke360 v1.3.0")
-            try:
-                await send_log(guild, embed=embed)
-                print(f"[PERMISSION] 已向伺服器所有者/記錄頻道發送通知")
-            except Exception as e:
-                print(f"[PERMISSION ERROR] 無法發送通知: {e}")
-        except Exception as e:
-            print(f"[PERMISSION ERROR] 構建嵌入訊息失敗: {e}")
+async def handle_audit_actor(guild: discord.Guild, actor, action_type: str, reason: str):
+    """稽核日誌項目的執行者：黑名單直接封鎖，白名單略過，其餘計入異常行為。"""
+    if bot.user and actor.id == bot.user.id:
+        return
+    flags = trust_flags(guild, actor.id)
+
+    if flags & TRUST_GLOBAL_BLACK:
+        await take_action(guild, actor, "黑名單機器人")
+        return
+
+    if flags & (TRUST_GLOBAL_WHITE | TRUST_PERMANENT):
+        return
+    
+    over_limit = await track_action(guild, actor, action_type)
+    score = score_action(guild, actor, action_type)
+    if over_limit or score is not None:
+        if not over_limit:
+            reason = f"行為異常：短時間內混合多種破壞性操作（威脅分數 {score:.1f}）"
+        asyncio.create_task(prompt_restore_on_suspect(guild))
+        await take_action(guild, actor, reason)
+
+
+def audit_gateway_state(guild_id: int) -> str:
+    seen = audit_gateway_seen.get(guild_id)
+    if seen is None:
+        return "尚未收到，使用退回查詢"
+    age = int(time.monotonic() - seen)
+    if age >= AUDIT_GATEWAY_STALE_SECONDS:
+        return f"{age} 秒未收到，使用退回查詢"
+    return f"使用中，{age} 秒前收到"
+
+
+async def poll_audit_actor(guild: discord.Guild, action, target_id: int = None):
+    """退回路徑：交給該伺服器的 worker 查詢稽核日誌找出執行者。gateway 事件正常運作時不做任何請求。"""
+    if audit_gateway_active(guild.id):
+        return
+    await route_detection_event(guild, "audit_poll", resolve_audit_actor, guild, action, target_id)
+
+
+async def resolve_audit_actor(guild: discord.Guild, action, target_id: int = None):
+    if audit_gateway_active(guild.id):
+        return
+    entry = await find_audit_entry(guild, action, target_id)
+    if entry is None or entry.user is None or not get_audit_log_reader(guild).claim(entry.id):
+        return
+    action_type, reason = AUDIT_DETECTION_RULES[action]
+    await handle_audit_actor(guild, entry.user, action_type, reason)
+
+
+@bot.event
+async def on_audit_log_entry_create(entry):
+    guild = entry.guild
+    audit_gateway_seen[guild.id] = time.monotonic()
+    rule = AUDIT_DETECTION_RULES.get(entry.action)
+    if rule is None:
+        return
+    if not get_audit_log_reader(guild).claim(entry.id):
+        return
+    audit_log_stats["gateway"] += 1
+    # 本 Bot 封鎖黑名單成員時產生的停權紀錄不計入
+    if entry.action == discord.AuditLogAction.ban and is_globally_blacklisted(getattr(entry.target, "id", 0)):
+        return
+    await route_detection_event(guild, "audit_entry", process_audit_entry, entry, rule)
+
+
+async def process_audit_entry(entry, rule):
+    actor = entry.user or bot.get_user(entry.user_id)
+    if actor is None:
         try:
-            await guild.leave()
-            print(f"[PERMISSION] 已自動離開伺服器: {guild.name}")
-        except Exception as e:
-            print(f"[PERMISSION ERROR] 無法離開伺服器: {e}")
-        permission_errors[gid].clear()
+            actor = await bot.fetch_user(entry.user_id)
+        except Exception:
+            return
+    try:
+        await handle_audit_actor(entry.guild, actor, *rule)
+    except Exception as e:
+        print(f"[AUDIT] 處理稽核日誌項目 {entry.id} 失敗: {e}")
 
-# Helper functions for server whitelist checks and management
-def purge_expired_temporary(guild_id: int):
-    now = time.time()
-    temp = server_whitelists[guild_id]["temporary"]
-    remove = [uid for uid, expiry in temp.items() if expiry <= now]
-    for uid in remove:
-        del temp[uid]
 
-def is_permanent_whitelisted(guild_id: int, user_id: int) -> bool:
-    return user_id in server_whitelists[guild_id]["permanent"]
+@bot.listen("on_guild_remove")
+async def audit_log_on_guild_remove(guild):
+    audit_log_readers.pop(guild.id, None)
+    audit_gateway_seen.pop(guild.id, None)
 
-def is_temporary_whitelisted(guild_id: int, user_id: int) -> bool:
-    purge_expired_temporary(guild_id)
-    return user_id in server_whitelists[guild_id]["temporary"]
 
-def is_anti_kick_whitelisted(guild_id: int, user_id: int) -> bool:
-    return user_id in server_whitelists[guild_id]["anti_kick"]
+@bot.event
+async def on_webhook_update(channel):
+    guild = channel.guild
+    print(f"[EVENT] {guild.name} 中偵測到 Webhook 操作")
+    try:
+        await poll_audit_actor(guild, discord.AuditLogAction.webhook_create)
+    except Exception:
+        pass
 
-def add_temporary_whitelist(guild_id: int, user_id: int):
-    server_whitelists[guild_id]["temporary"][user_id] = time.time() + TEMP_WHITELIST_TTL
-    save_server_whitelist()
+async def handle_anti_hijack(message: discord.Message):
+    guild = message.guild
+    user = message.author
+    gid = guild.id
+    uid = user.id
+    content = message.content
 
-def remove_temporary_whitelist(guild_id: int, user_id: int):
-    temp = server_whitelists[guild_id]["temporary"]
-    if user_id in temp:
-        del temp[user_id]
-        save_server_whitelist()
+    settings = anti_hijack_settings[gid]
+    if not settings["enabled"]:
+        return
 
-def add_permanent_whitelist(guild_id: int, user_id: int):
-    server_whitelists[guild_id]["permanent"].add(user_id)
-    save_server_whitelist()
+    if is_permanent_whitelisted(gid, uid):
+        mode = "whitelisted"
+    else:
+        mode = "normal"
 
-def remove_permanent_whitelist(guild_id: int, user_id: int):
-    server_whitelists[guild_id]["permanent"].discard(user_id)
-    save_server_whitelist()
+    if not content:
+        return
 
-def add_anti_kick_whitelist(guild_id: int, user_id: int):
-    server_whitelists[guild_id]["anti_kick"].add(user_id)
-    save_server_whitelist()
+    windows = hijack_tracker[gid]
+    window = windows.get(uid)
+    if window is None:
+        window = windows[uid] = HijackWindow()
 
-def remove_anti_kick_whitelist(guild_id: int, user_id: int):
-    server_whitelists[guild_id]["anti_kick"].discard(user_id)
-    save_server_whitelist()
+    fingerprint = message_minhash(content) if settings["similarity"] else None
+    if fingerprint is None:
+        fingerprint, match = message_fingerprint(content), 0
+    else:
+        match = HIJACK_MINHASH_MATCH
 
-def set_log_channel_for_guild(guild_id: int, channel_id: int):
-    server_whitelists[guild_id]["log_channel"] = channel_id
-    save_server_whitelist()
+    if window.hit(time.time(), fingerprint, message.channel.id, match):
+        await route_detection_event(guild, "anti_hijack", respond_to_hijack, message, mode, time.monotonic())
 
-def get_log_channel_for_guild(guild_id: int):
-    return server_whitelists[guild_id].get("log_channel")
 
-async def send_log(guild: discord.Guild, content: str = None, embed: discord.Embed = None):
-    log_ch_id = get_log_channel_for_guild(guild.id)
-    sent = False
-    if log_ch_id:
-        ch = guild.get_channel(log_ch_id)
-        if ch and isinstance(ch, discord.TextChannel):
-            try:
-                if ch.permissions_for(guild.me).send_messages:
-                    await ch.send(content=content, embed=embed)
-                    sent = True
-                    return True
-            except Exception:
-                sent = False
-    owner = guild.owner
-    recipients = []
-    if owner:
-        recipients.append(owner)
-    admins = [m for m in guild.members if (m.guild_permissions.administrator or m.guild_permissions.manage_guild) and not m.bot]
-    status_priority = {"online": 0, "idle": 1, "dnd": 2, "offline": 3, None: 3}
-    def admin_sort_key(m):
-        st = getattr(m, "status", None)
-        pr = status_priority.get(str(st), 3)
-        joined = m.joined_at.timestamp() if m.joined_at else 0
-        return (pr, -joined)
-    admins_sorted = sorted(admins, key=admin_sort_key)
-    for a in admins_sorted:
-        if a not in recipients:
-            recipients.append(a)
-        if len(recipients) >= 6:
-            break
-    for r in recipients:
-        try:
-            dm = await r.create_dm()
-            if embed is not None:
-                if embed.footer and embed.footer.text:
-                    footer_text = embed.footer.text + " | 若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
-                else:
-                    footer_text = "若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
-                embed.set_footer(text=footer_text)
-            else:
-                if content is None:
-                    content = ""
-                suffix = "\n\n若您是在私訊中看到此訊息，代表本伺服器尚未設定 AntiNuke360 的日誌頻道。"
-                content = (content or "") + suffix
-            await dm.send(content=content, embed=embed)
-            sent = True
-        except Exception:
-            continue
-    return sent
+async def respond_to_hijack(message: discord.Message, mode: str, decided_at: float):
+    """刪除疑似被盜帳號的訊息、發送回復邀請並從各伺服器踢出（永久白名單僅刪除與通知）。"""
+    guild = message.guild
+    user = message.author
+    uid = user.id
+    content = message.content
 
-def build_announcement_embed(message: str, sender_display: str) -> discord.Embed:
-    embed = discord.Embed(
-        title="[AntiNuke360 全服公告]",
-        description=message,
-        color=discord.Color.gold()
-    )
-    embed.add_field(name="發布者", value=sender_display, inline=False)
-    embed.set_footer(text=f"AntiNuke360 {VERSION}")
-    return embed
+    try:
+        await message.delete()
+    except Exception:
+        pass
 
-def get_admin_candidates(guild: discord.Guild):
-    candidates = []
-    seen = set()
-    owner = guild.owner
-    if owner and not owner.bot:
-        candidates.append(owner)
-        seen.add(owner.id)
-    for member in guild.members:
-        if member.bot or member.id in seen:
+    mutual_guilds = [g for g in bot.guilds if g.get_member(uid)]
+
+    invite_links = []
+    for g in mutual_guilds:
+        target_channel = g.system_channel
+        if not target_channel:
+            for ch in g.text_channels:
+                if ch.permissions_for(g.me).create_instant_invite:
+                    target_channel = ch
+                    break
+        if not target_channel:
+            continue
+        try:
+            invite = await target_channel.create_invite(max_age=7 * 24 * 3600, max_uses=1, reason="AntiNuke360: 被盜帳回復用邀請")
+            invite_links.append((g.name, str(invite)))
+        except Exception as e:
+            print(f"[ANTI HIJACK] 無法在伺服器 {g.name} 建立邀請: {e}")
             continue
-        perms = member.guild_permissions
-        if perms.administrator or perms.manage_guild:
-            candidates.append(member)
-            seen.add(member.id)
-    return candidates
 
-def member_is_online(member: discord.Member) -> bool:
-    status = getattr(member, "status", discord.Status.offline)
-    return status not in (discord.Status.offline, discord.Status.invisible, None)
+    dm_text_lines = [
+        "您好，這裡是 AntiNuke360。",
+        "",
+        "我們偵測到您的帳號在短時間內於多個頻道發送相同訊息，疑似 **被盜帳號或被利用發送詐騙訊息**。",
+        "為了保護伺服器安全，您的帳號已被從相關伺服器中踢出或暫時限制。",
+    ]
+    if invite_links:
+        dm_text_lines.append("")
+        dm_text_lines.append("以下是您曾加入、並安裝 AntiNuke360 的伺服器 7 天一次性邀請連結：")
+        for name, link in invite_links:
+            dm_text_lines.append(f"- {name}: {link}")
+        dm_text_lines.append("")
+        dm_text_lines.append("請在完成安全檢查、更改密碼與二階段驗證後，再透過上述連結重新加入伺服器。")
+    else:
+        dm_text_lines.append("")
+        dm_text_lines.append("目前無法自動為您建立回到各伺服器的邀請連結，請自行聯繫伺服器管理員協助。")
 
-async def try_send_announcement_to_log(guild: discord.Guild, message: str, sender_display: str) -> bool:
-    log_ch_id = get_log_channel_for_guild(guild.id)
-    if not log_ch_id:
-        return False
-    channel = guild.get_channel(log_ch_id)
-    if not isinstance(channel, discord.TextChannel):
-        return False
-    if not channel.permissions_for(guild.me).send_messages:
-        return False
     try:
-        await channel.send(embed=build_announcement_embed(message, sender_display))
-        print(f"[ANNOUNCE] 已在伺服器 {guild.name} 的日誌頻道發布公告")
-        return True
+        dm = await user.create_dm()
+        dm_text_lines.append("")
+        dm_text_lines.append("若您是在私訊中看到此訊息，代表部份伺服器尚未設定 AntiNuke360 的日誌頻道。")
+        await dm.send("\n".join(dm_text_lines))
     except Exception as e:
-        print(f"[ANNOUNCE ERROR] 無法在伺服器 {guild.name} 的日誌頻道發送公告: {e}")
-        return False
+        print(f"[ANTI HIJACK] 無法 DM 使用者 {user}: {e}")
 
-async def dm_guild_member(member: discord.Member, message: str, sender_display: str) -> bool:
+    embed = discord.Embed(title="[AntiNuke360 - 反被盜帳偵測]", color=discord.Color.red())
+    embed.description = (
+        f"使用者 `{user}` (ID: `{uid}`) 在 5 秒內於多個頻道發送相同訊息，疑似被盜帳號或發送詐騙訊息。\n\n"
+        f"本頻道: {message.channel.mention}\n"
+        f"訊息內容: ```{content[:1500]}```"
+    )
+    embed.set_footer(text="AntiNuke360 v1.3.0")
     try:
-        dm = await member.create_dm()
-        await dm.send(embed=build_announcement_embed(message, sender_display))
-        print(f"[ANNOUNCE] 已私訊管理員 {member} 發送公告")
-        return True
-    except Exception as e:
-        print(f"[ANNOUNCE ERROR] 無法私訊管理員 {member}: {e}")
-        return False
+        await send_log(guild, embed=embed)
+    except Exception:
+        pass
 
-def schedule_admin_wait_task(guild_id: int, message: str, sender_display: str):
-    task = asyncio.create_task(wait_for_admin_and_dm(guild_id, message, sender_display))
-    pending_announcement_tasks.add(task)
-    task.add_done_callback(lambda t: pending_announcement_tasks.discard(t))
+    if mode == "whitelisted":
+        print(f"[ANTI HIJACK] {user} 為永久白名單，僅刪除訊息與通知。")
+        return
 
-async def wait_for_admin_and_dm(guild_id: int, message: str, sender_display: str):
-    deadline = time.time() + ANNOUNCEMENT_WAIT_TIMEOUT
-    while time.time() < deadline:
-        guild = bot.get_guild(guild_id)
-        if not guild:
+    # 各伺服器的踢出同時排入處置排程（優先順序低於封鎖攻擊者與黑名單）
+    targets = [(g, g.get_member(uid)) for g in mutual_guilds]
+    targets = [(g, member) for g, member in targets if member]
+    results = await asyncio.gather(
+        *(
+            mitigation_scheduler.submit(
+                MITIGATION_HIJACK, f"kick:{g.id}", g.kick, member,
+                reason="AntiNuke360: 疑似被盜帳號 / 詐騙訊息", decided_at=decided_at,
+            )
+            for g, member in targets
+        ),
+        return_exceptions=True,
+    )
+    for (g, member), result in zip(targets, results):
+        if isinstance(result, Exception):
+            print(f"[ANTI HIJACK] 無法從伺服器 {g.name} 踢出 {member}: {result}")
+        else:
+            print(f"[ANTI HIJACK] 已從伺服器 {g.name} 踢出 {member}")
+
+@bot.event
+async def on_message(message):
+    if not message.guild:
+        return
+
+    guild = message.guild
+    user = message.author
+    uid = user.id
+    flags = trust_flags(guild, uid)
+
+    if flags & TRUST_GLOBAL_BLACK and not flags & TRUST_ANTI_KICK:
+        try:
+            await message.delete()
+            print(f"[BLACKLIST MSG] 已刪除黑名單成員 {user} 的訊息")
+        except Exception as e:
+            print(f"[BLACKLIST MSG] 刪除黑名單訊息失敗: {e}")
+        return
+
+    if user.bot:
+        return
+
+    await handle_anti_hijack(message)
+
+    if flags & (TRUST_GLOBAL_BLACK | TRUST_GLOBAL_WHITE | TRUST_PERMANENT):
+        return
+
+    await route_detection_event(guild, "message_send", handle_message_activity, guild, user, key=uid)
+
+    await bot.process_commands(message)
+
+
+async def handle_message_activity(guild: discord.Guild, user, count: int = 1):
+    """計入 count 則訊息（合併後的事件一次計入多則），超過門檻即封鎖。"""
+    for _ in range(count):
+        if await track_action(guild, user, "message_send"):
+            asyncio.create_task(prompt_restore_on_suspect(guild))
+            await take_action(guild, user, "行為異常短時間內大量發送訊息")
             return
-        admins = get_admin_candidates(guild)
-        if not admins:
+
+@bot.event
+async def on_guild_channel_create(channel):
+    guild = channel.guild
+    print(f"[EVENT] {guild.name} 中創建了頻道: {channel.name}")
+    try:
+        await poll_audit_actor(guild, discord.AuditLogAction.channel_create, channel.id)
+    except Exception:
+        pass
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    guild = channel.guild
+    try:
+        await poll_audit_actor(guild, discord.AuditLogAction.channel_delete, channel.id)
+    except Exception:
+        pass
+
+@bot.event
+async def on_member_remove(member):
+    guild = member.guild
+    try:
+        await poll_audit_actor(guild, discord.AuditLogAction.kick, member.id)
+    except Exception:
+        pass
+
+@bot.event
+async def on_member_ban(guild, user):
+    try:
+        if is_globally_blacklisted(user.id):
             return
-        for admin in admins:
-            if member_is_online(admin):
-                if await dm_guild_member(admin, message, sender_display):
-                    return
-        await asyncio.sleep(ANNOUNCEMENT_CHECK_INTERVAL)
-    print(f"[ANNOUNCE] 伺服器 {guild_id} 在 12 小時內沒有管理員上線，已取消公告")
+        
+        await poll_audit_actor(guild, discord.AuditLogAction.ban, user.id)
+    except Exception:
+        pass
 
-async def dispatch_global_announcement(guild: discord.Guild, message: str, sender_display: str) -> str:
-    if await try_send_announcement_to_log(guild, message, sender_display):
-        return "log"
-    admins = get_admin_candidates(guild)
-    if not admins:
-        print(f"[ANNOUNCE] 伺服器 {guild.name} 無可聯絡管理員，跳過")
-        return "no_admin"
-    online_admins = [m for m in admins if member_is_online(m)]
-    for admin in online_admins:
-        if await dm_guild_member(admin, message, sender_display):
-            return "dm"
-    schedule_admin_wait_task(guild.id, message, sender_display)
-    print(f"[ANNOUNCE] 伺服器 {guild.name} 無上線管理員，已排程等待")
-    return "scheduled"
+@bot.event
+async def on_guild_role_create(role):
+    guild = role.guild
+    try:
+        await poll_audit_actor(guild, discord.AuditLogAction.role_create, role.id)
+    except Exception:
+        pass
 
 # Slash commands
 
@@ -1312,12 +5085,87 @@ async def status(interaction: discord.Interaction):
     embed.add_field(name="伺服器防踢白名單人數", value=str(anti_count), inline=False)
     embed.add_field(name="伺服器臨時白名單人數", value=str(temp_count), inline=False)
     embed.add_field(name="伺服器永久白名單人數", value=str(perm_count), inline=False)
-    has_snapshot = snapshot_is_valid(load_snapshot_file(interaction.guild.id))
+    snapshot = await run_db(load_snapshot_file, interaction.guild.id)
+    has_snapshot = snapshot_is_valid(snapshot)
     embed.add_field(name="伺服器快照", value=f"{'有有效快照' if has_snapshot else '無有效快照'}", inline=False)
+    mirror = guild_mirrors.get(gid)
+    if mirror:
+        if mirror.is_frozen():
+            mirror_state = f"已凍結（剩 {int(mirror.frozen_until - time.time())} 秒）"
+        elif mirror.dirty:
+            mirror_state = "有尚未寫入快照的變更"
+        else:
+            mirror_state = "已同步"
+        embed.add_field(
+            name="結構鏡像",
+            value=f"{mirror_state}，身分組 {len(mirror.roles)}，分類 {len(mirror.categories)}，頻道 {len(mirror.channels)}",
+            inline=False
+        )
+    if audit_log_stats["lookups"] or audit_log_stats["gateway"]:
+        embed.add_field(
+            name="稽核日誌讀取",
+            value=(
+                f"Gateway 事件 {audit_log_stats['gateway']} 筆（本伺服器{audit_gateway_state(gid)}）；"
+                f"退回查詢 {audit_log_stats['lookups']} 次，共送出 {audit_log_stats['requests']} 次請求"
+            ),
+            inline=False
+        )
+    if detection_stats["queued"]:
+        embed.add_field(name="偵測佇列", value=detection_queue_summary(gid), inline=False)
+    if mitigation_scheduler.workers:
+        embed.add_field(name="處置排程", value=mitigation_scheduler.summary(), inline=False)
+    if snapshot:
+        embed.add_field(
+            name="快照大小",
+            value=f"{snapshot.raw_size:,} -> {snapshot.stored_size:,} bytes（格式 v{snapshot.format_version}）",
+            inline=False
+        )
+    with snapshot_stats_lock:
+        session_saved = snapshot_stats["raw_bytes"] - snapshot_stats["stored_bytes"]
+        session_deltas = snapshot_stats["deltas"]
+        session_unchanged = snapshot_stats["unchanged"]
+    try:
+        totals = await run_db(storage.snapshot_totals)
+        embed.add_field(
+            name="快照壓縮節省",
+            value=(
+                f"共 {totals['raw_size'] - totals['stored_size']:,} bytes（{totals['count']} 份快照），本次啟動 {session_saved:,} bytes；"
+                f"增量快照 {session_deltas} 份，結構未變略過 {session_unchanged} 次"
+            ),
+            inline=False
+        )
+    except DB_ERRORS as e:
+        print(f"[DB ERROR] 讀取快照統計失敗: {e}")
     hij_settings = anti_hijack_settings[gid]
-    embed.add_field(name="反被盜帳", value="啟用" if hij_settings["enabled"] else "停用", inline=False)
+    embed.add_field(
+        name="反被盜帳",
+        value=("啟用" if hij_settings["enabled"] else "停用") + (
+            f"（相似訊息模式，門檻 {HIJACK_SIMILARITY_THRESHOLD:.0%}）" if hij_settings["similarity"] else "（完全相同比對）"
+        ),
+        inline=False
+    )
     embed.add_field(name="自訂狀態文字", value=f"已啟用 ({len(STATUS_MESSAGES)} 個，每 10 秒輪流)", inline=False)
-    embed.set_footer(text=f"AntiNuke360 {VERSION} | 防護參數已固定 & Snapshot in MySQL")
+    if storage.name == "mysql":
+        embed.add_field(
+            name="資料庫連線池",
+            value=(
+                f"使用中 {db_pool_stats['in_use']}/{MYSQL_POOL_SIZE}，峰值 {db_pool_stats['peak_in_use']}，"
+                f"累計借出 {db_pool_stats['checkouts']}，重連 {db_pool_stats['reconnects']}，錯誤 {db_pool_stats['errors']}"
+            ),
+            inline=False
+        )
+    else:
+        embed.add_field(name="儲存後端", value=f"{storage.label} (WAL)：{SQLITE_PATH}", inline=False)
+    pst = persist_queue.stats
+    embed.add_field(
+        name="Write-behind 佇列",
+        value=(
+            f"待寫入 {len(persist_queue.pending)}，已合併 {pst['coalesced']}，"
+            f"已寫入 {pst['flushed']} ({pst['flushes']} 批，上次 {pst['last_flush_ms']:.0f} ms)，失敗 {pst['failures']}"
+        ),
+        inline=False
+    )
+    embed.set_footer(text=f"AntiNuke360 {VERSION} | 防護參數已固定 & Snapshot in {storage.label}")
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
 @app_commands.checks.has_permissions(administrator=True)
@@ -1471,8 +5319,8 @@ async def set_log_channel(interaction: discord.Interaction, channel: discord.Tex
 
 @app_commands.checks.has_permissions(administrator=True)
 @bot.tree.command(name="toggle-anti-hijack", description="開啟或關閉反被盜帳功能 (管理員)")
-@app_commands.describe(mode="輸入 on 或 off")
-async def toggle_anti_hijack(interaction: discord.Interaction, mode: str):
+@app_commands.describe(mode="輸入 on 或 off", similarity="是否也偵測近似內容（改字、加尾碼的洗版訊息）")
+async def toggle_anti_hijack(interaction: discord.Interaction, mode: str, similarity: bool = None):
     gid = interaction.guild.id
     mode_lower = mode.lower()
     if mode_lower not in ("on", "off", "true", "false", "enable", "disable"):
@@ -1480,7 +5328,12 @@ async def toggle_anti_hijack(interaction: discord.Interaction, mode: str):
         return
     enabled = mode_lower in ("on", "true", "enable")
     anti_hijack_settings[gid]["enabled"] = enabled
-    await interaction.response.send_message(f"反被盜帳功能已{'啟用' if enabled else '關閉'}。", ephemeral=True)
+    if similarity is not None:
+        anti_hijack_settings[gid]["similarity"] = similarity
+    match_mode = "相似訊息" if anti_hijack_settings[gid]["similarity"] else "完全相同"
+    await interaction.response.send_message(
+        f"反被盜帳功能已{'啟用' if enabled else '關閉'}（比對模式：{match_mode}）。", ephemeral=True
+    )
 
 @bot.tree.command(name="add-black", description="將機器人加入全域黑名單 (開發者)")
 @app_commands.describe(bot_id="機器人 ID", reason="原因")
@@ -1493,7 +5346,8 @@ async def add_black(interaction: discord.Interaction, bot_id: str, reason: str =
         await interaction.response.send_message("該機器人已在黑名單中", ephemeral=True)
         return
     bot_blacklist[bot_id] = {"name": bot_id, "reason": reason, "timestamp": time.time(), "guilds_detected": []}
-    save_blacklist(bot_blacklist)
+    persist_blacklist(bot_id)
+    refresh_global_trust(bot_id)
     await interaction.response.defer()
     embed = discord.Embed(title="已加入黑名單", color=discord.Color.red())
     embed.description = (
@@ -1504,7 +5358,7 @@ async def add_black(interaction: discord.Interaction, bot_id: str, reason: str =
     embed.add_field(name="原因", value=reason if reason else "無", inline=False)
     embed.set_footer(text="AntiNuke360 v1.3.0")
     await interaction.followup.send(embed=embed)
-    await scan_blacklist_all_guilds()
+    request_blacklist_scan()
 
 @bot.tree.command(name="remove-black", description="從全域黑名單移除機器人 (開發者)")
 @app_commands.describe(bot_id="機器人 ID")
@@ -1517,7 +5371,8 @@ async def remove_black(interaction: discord.Interaction, bot_id: str):
         await interaction.response.send_message("該機器人不在黑名單中", ephemeral=True)
         return
     del bot_blacklist[bot_id]
-    save_blacklist(bot_blacklist)
+    persist_blacklist(bot_id)
+    refresh_global_trust(bot_id)
     embed = discord.Embed(title="已從黑名單移除", color=discord.Color.green())
     embed.description = f"機器人 ID: `{bot_id}` 已從全域黑名單移除"
     await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -1533,7 +5388,8 @@ async def add_white(interaction: discord.Interaction, bot_id: str, reason: str =
         await interaction.response.send_message("該機器人已在白名單中", ephemeral=True)
         return
     bot_whitelist[bot_id] = {"name": bot_id, "reason": reason, "timestamp": time.time()}
-    save_whitelist(bot_whitelist)
+    persist_whitelist(bot_id)
+    refresh_global_trust(bot_id)
     embed = discord.Embed(title="已加入白名單", color=discord.Color.green())
     embed.description = f"機器人 ID: `{bot_id}` 已加入全域白名單"
     embed.add_field(name="原因", value=reason if reason else "無", inline=False)
@@ -1550,7 +5406,8 @@ async def remove_white(interaction: discord.Interaction, bot_id: str):
         await interaction.response.send_message("該機器人不在白名單中", ephemeral=True)
         return
     del bot_whitelist[bot_id]
-    save_whitelist(bot_whitelist)
+    persist_whitelist(bot_id)
+    refresh_global_trust(bot_id)
     embed = discord.Embed(title="已從白名單移除", color=discord.Color.red())
     embed.description = f"機器人 ID: `{bot_id}` 已從全域白名單移除"
     await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -1613,6 +5470,87 @@ async def scan_all_guilds_cmd(interaction: discord.Interaction):
         embed.set_footer(text="AntiNuke360 v1.3.0")
         await interaction.followup.send(embed=embed)
 
+@app_commands.checks.has_permissions(administrator=True)
+@bot.tree.command(name="snapshot-list", description="列出本伺服器保留的快照世代 (管理員)")
+async def snapshot_list_command(interaction: discord.Interaction):
+    await interaction.response.defer(ephemeral=True)
+    generations = await run_db(list_snapshot_generations, interaction.guild.id)
+    if not generations:
+        await interaction.followup.send("本伺服器目前沒有任何快照。", ephemeral=True)
+        return
+    embed = discord.Embed(title="快照世代", color=discord.Color.blue())
+    lines = []
+    now = time.time()
+    for index, row in enumerate(generations):
+        created_at = float(row["created_at"])
+        remaining = max(0, int(created_at + SNAPSHOT_TTL_SECONDS - now))
+        status = f"剩餘 {remaining//3600} 小時 {(remaining%3600)//60} 分鐘" if remaining else "已過期"
+        latest = "（最新）" if index == 0 else ""
+        if row["id"] == snapshot_pins.get(interaction.guild.id):
+            latest += "（凍結前保留）"
+        kind = f"增量（基底 #{row['base_id']}）" if row.get("base_id") is not None else "完整"
+        lines.append(f"`#{row['id']}` <t:{int(created_at)}:f>{latest} - {kind}，{status}，{int(row['stored_size'] or 0):,} bytes")
+    embed.description = "\n".join(lines)
+    embed.set_footer(text=f"使用 /restore-snapshot snapshot_id:<ID> 還原指定快照 | 每個伺服器保留 {SNAPSHOT_GENERATIONS} 個世代")
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@app_commands.checks.has_permissions(administrator=True)
+@bot.tree.command(name="restore-snapshot", description="還原本伺服器的備份快照 (管理員)")
+@app_commands.describe(
+    snapshot_id="要還原的快照 ID（見 /snapshot-list），留空則使用最新快照",
+    mode="差異還原只修復被改動的部分（預設）；完整重建會先刪除所有頻道與身分組",
+    dry_run="只顯示還原計畫與預估請求數、耗時，不實際執行"
+)
+@app_commands.choices(mode=[
+    app_commands.Choice(name="差異還原", value="reconcile"),
+    app_commands.Choice(name="完整重建", value="full"),
+])
+async def restore_snapshot_command(interaction: discord.Interaction, snapshot_id: int = None, mode: app_commands.Choice[str] = None, dry_run: bool = False):
+    await interaction.response.defer(ephemeral=True)
+    guild = interaction.guild
+    snapshot = await run_db(load_snapshot_file, guild.id, snapshot_id)
+    if not snapshot or not snapshot_is_valid(snapshot):
+        await interaction.followup.send("伺服器沒有有效的快照可供還原或已過期。", ephemeral=True)
+        return
+    remaining = snapshot_time_remaining(snapshot)
+    restore_mode = mode.value if mode else "reconcile"
+    if dry_run:
+        plan, error = await prepare_restore_plan(guild, snapshot.snapshot_id, restore_mode)
+        if plan is None:
+            await interaction.followup.send(f"無法產生還原計畫: {error}", ephemeral=True)
+            return
+        estimate = plan.estimate()
+        embed = discord.Embed(
+            title=f"還原計畫試算：快照 #{snapshot.snapshot_id}（{'完整重建' if restore_mode == 'full' else '差異還原'}）",
+            color=discord.Color.blue()
+        )
+        embed.description = "\n".join(plan.describe())[:4000] or "快照與現存結構一致，不需要任何操作。"
+        embed.add_field(name="操作數", value=str(estimate["ops"]), inline=True)
+        embed.add_field(name="預估 API 請求", value=str(estimate["requests"]), inline=True)
+        embed.add_field(name="預估耗時", value=f"約 {estimate['seconds']:.1f} 秒", inline=True)
+        if plan.resumed:
+            embed.add_field(name="接續還原", value=f"上次未完成的還原已完成 {len(plan.skipped)} 個操作，執行時會略過", inline=False)
+        routes = "\n".join(
+            f"`{route}` {count} 次（並行 {RESTORE_ROUTE_LIMITS.get(route, 2)}）"
+            for route, count in sorted(estimate["by_route"].items(), key=lambda item: -item[1])
+        )
+        if routes:
+            embed.add_field(name="各路由請求數", value=routes[:1024], inline=False)
+        embed.set_footer(text="此為試算，未做任何變更；實際耗時取決於 Discord 的 rate limit")
+        await interaction.followup.send(embed=embed, ephemeral=True)
+        return
+    await interaction.followup.send(
+        f"開始還原快照 #{snapshot.snapshot_id} (剩餘有效時間: {remaining//3600} 小時 {(remaining%3600)//60} 分鐘)。"
+        + ("這可能需要一段時間且會先嘗試刪除可刪除的現有頻道與身分組。" if restore_mode == "full"
+           else "只會重建缺少的、修改被改動的，並刪除快照之後才建立的頻道與身分組。"),
+        ephemeral=True
+    )
+    ok, msg = await perform_restore(guild, ctx_sender=interaction.user, snapshot_id=snapshot.snapshot_id, mode=restore_mode)
+    if ok:
+        await interaction.followup.send(f"還原完成: {msg}", ephemeral=True)
+    else:
+        await interaction.followup.send(f"還原失敗: {msg}", ephemeral=True)
+
 @bot.tree.command(name="announce-all", description="向所有伺服器發送全服公告 (開發者)")
 @app_commands.describe(message="公告內容")
 async def announce_all(interaction: discord.Interaction, message: str):
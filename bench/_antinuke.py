@@ -0,0 +1,31 @@
+"""
+bench 腳本共用的載入器：以暫存目錄中的 SQLite 後端載入 AntiNuke360_v1.3.1.py，不會連線 Discord。
+需要安裝 requirements.txt 的依賴（discord.py 等）。
+"""
+
+import importlib.util
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_antinuke():
+    tmp_dir = tempfile.mkdtemp(prefix="antinuke360-bench-")
+    os.environ["STORAGE_BACKEND"] = "sqlite"
+    os.environ["SQLITE_PATH"] = os.path.join(tmp_dir, "bench.db")
+    os.environ["PERSIST_JOURNAL_FILE"] = os.path.join(tmp_dir, "persist_journal.jsonl")
+    spec = importlib.util.spec_from_file_location("antinuke360", ROOT / "AntiNuke360_v1.3.1.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["antinuke360"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class Fake:
+    """只帶有指定屬性的替身物件（guild、user、稽核日誌項目等）。"""
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
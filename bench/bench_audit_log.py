@@ -0,0 +1,115 @@
+"""
+稽核日誌讀取器：模擬一次刪除 N 個頻道，比較 v1.3.0 每個事件各自查詢稽核日誌與共用的 AuditLogReader。
+
+假的稽核日誌 API 每次請求延遲 --latency 秒，並以 --limit 次/--per 秒的 bucket 模擬速率限制；
+回報送出的請求數、全部事件處理完的時間，以及每個事件從發生到找到對應項目的延遲。
+
+    python bench/bench_audit_log.py [--channels 50] [--interval 0.02] [--latency 0.05] [--limit 5] [--per 1]
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from _antinuke import Fake, load_antinuke
+
+an = load_antinuke()
+discord = an.discord
+ACTION = discord.AuditLogAction.channel_delete
+
+
+class FakeAuditLogGuild:
+    """只實作 audit_logs() 的伺服器：項目依 ID 由新到舊回傳，和 Discord 相同。"""
+
+    def __init__(self, guild_id: int, latency: float, limit: int, per: float):
+        self.id = guild_id
+        self.entries = []
+        self.requests = 0
+        self.latency = latency
+        self.limit = limit
+        self.per = per
+        self.sent = []
+        self.lock = asyncio.Lock()
+
+    async def _rate_limit(self):
+        async with self.lock:
+            now = time.monotonic()
+            self.sent = [t for t in self.sent if now - t < self.per]
+            if len(self.sent) >= self.limit:
+                await asyncio.sleep(self.per - (now - self.sent[0]))
+            self.sent.append(time.monotonic())
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+    async def audit_logs(self, limit=100, action=None, after=None):
+        await self._rate_limit()
+        entries = [e for e in self.entries if (action is None or e.action == action) and (after is None or e.id > after.id)]
+        if after is not None:
+            entries.sort(key=lambda e: e.id)  # after= 時 Discord 由舊到新回傳
+        else:
+            entries.sort(key=lambda e: e.id, reverse=True)
+        for entry in entries[:limit]:
+            yield entry
+
+
+def add_entry(guild: FakeAuditLogGuild, target_id: int):
+    entry = Fake(id=an.snowflake_from_time(time.time()) + target_id % 4096, action=ACTION,
+                 target=Fake(id=target_id), user=Fake(id=7))
+    guild.entries.append(entry)
+    return entry
+
+
+async def old_lookup(guild, target_id):
+    # v1.3.0：每個事件各自讀最新 5 筆，取第一筆當作執行者（不比對目標）
+    async for entry in guild.audit_logs(limit=5, action=ACTION):
+        return entry
+    return None
+
+
+async def new_lookup(guild, target_id):
+    return await an.find_audit_entry(guild, ACTION, target_id)
+
+
+async def wipe(lookup, channels: int, interval: float, latency: float, limit: int, per: float):
+    guild = FakeAuditLogGuild(len(an.audit_log_readers) + 1, latency, limit, per)
+    latencies = []
+    matched = 0
+
+    async def event(index: int):
+        nonlocal matched
+        await asyncio.sleep(index * interval)
+        target_id = 1000 + index
+        add_entry(guild, target_id)
+        started = time.monotonic()
+        entry = await lookup(guild, target_id)
+        latencies.append(time.monotonic() - started)
+        if entry is not None and entry.target.id == target_id:
+            matched += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(event(i) for i in range(channels)))
+    return guild.requests, time.monotonic() - started, latencies, matched
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--interval", type=float, default=0.02, help="兩次刪除間隔（秒）")
+    parser.add_argument("--latency", type=float, default=0.05, help="每次請求的延遲（秒）")
+    parser.add_argument("--limit", type=int, default=5, help="速率限制：每 --per 秒最多幾次請求")
+    parser.add_argument("--per", type=float, default=1.0)
+    args = parser.parse_args()
+
+    print(f"刪除 {args.channels} 個頻道，每 {args.interval} 秒一個；請求延遲 {args.latency} 秒，限制 {args.limit} 次/{args.per} 秒")
+    for name, lookup in (("v1.3.0", old_lookup), ("v1.3.1", new_lookup)):
+        requests, elapsed, latencies, matched = await wipe(lookup, args.channels, args.interval, args.latency, args.limit, args.per)
+        print(
+            f"  {name}：{requests} 次請求，{elapsed:.2f} 秒處理完，"
+            f"事件延遲中位數 {statistics.median(latencies):.2f} 秒、最大 {max(latencies):.2f} 秒，"
+            f"對應到正確項目 {matched}/{args.channels}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
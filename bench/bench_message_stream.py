@@ -0,0 +1,143 @@
+"""
+模擬 10k 則訊息/秒的訊息流，比較 v1.3.0 與目前的訊息計數器與反被盜帳追蹤：
+
+- 計數器：v1.3.0 的 guild -> user -> action -> deque[時間] 與 ActionCounter 環形緩衝區
+- 反被盜帳：v1.3.0 以完整訊息內容為 key 的 deque 與 HijackWindow 指紋時間窗
+
+兩種實作的判定結果逐則比對，並以 tracemalloc 量測每則訊息耗時與保留的記憶體。
+
+    python bench/bench_message_stream.py [--messages 100000] [--rate 10000] [--users 20000]
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+from collections import defaultdict, deque
+
+from _antinuke import load_antinuke
+
+an = load_antinuke()
+
+MAX_ACTIONS = an.PROTECTION_CONFIG["max_actions"]
+WINDOW = an.PROTECTION_CONFIG["window_seconds"]
+
+
+def make_stream(count: int, rate: int, users: int, guilds: int = 50, seed: int = 1):
+    """(guild_id, user_id, content, channel_id, now)：30% 為重複的洗版訊息，其餘為長度不一的一般訊息。"""
+    rng = random.Random(seed)
+    stream = []
+    for i in range(count):
+        user_id = rng.randrange(users)
+        if rng.random() < 0.3:
+            content = "spam " * rng.randint(1, 60) + str(rng.randrange(5))
+        else:
+            content = f"msg {i} " + "x" * rng.randint(0, 300)
+        stream.append((user_id % guilds, user_id, content, rng.randrange(10), i / rate))
+    return stream
+
+
+# ========== v1.3.0 ==========
+
+def old_counter():
+    user_actions = defaultdict(lambda: defaultdict(lambda: defaultdict(deque)))
+
+    def hit(guild_id, user_id, now):
+        actions = user_actions[guild_id][user_id]["message_send"]
+        actions.append(now)
+        while actions and now - actions[0] > WINDOW:
+            actions.popleft()
+        return len(actions) > MAX_ACTIONS
+
+    return user_actions, hit
+
+
+def old_hijack():
+    tracker = defaultdict(lambda: defaultdict(lambda: defaultdict(deque)))
+
+    def hit(guild_id, user_id, content, channel_id, now):
+        dq = tracker[guild_id][user_id][content]
+        dq.append((now, channel_id))
+        filtered = [(ts, cid) for (ts, cid) in dq if now - ts <= 5]
+        tracker[guild_id][user_id][content] = deque(filtered)
+        return len(filtered) >= 3 and len({cid for _, cid in filtered}) >= 3
+
+    return tracker, hit
+
+
+# ========== 目前版本 ==========
+
+def new_counter():
+    user_actions = an.user_actions
+    capacity = an.action_counter_capacity()
+
+    def hit(guild_id, user_id, now):
+        counters = user_actions[guild_id]
+        counter = counters.get((user_id, "message_send"))
+        if counter is None:
+            counter = counters[(user_id, "message_send")] = an.ActionCounter(capacity)
+        return counter.hit(now, WINDOW, MAX_ACTIONS)
+
+    return user_actions, hit
+
+
+def new_hijack():
+    tracker = an.hijack_tracker
+
+    def hit(guild_id, user_id, content, channel_id, now):
+        windows = tracker[guild_id]
+        window = windows.get(user_id)
+        if window is None:
+            window = windows[user_id] = an.HijackWindow()
+        return window.hit(now, an.message_fingerprint(content), channel_id)
+
+    return tracker, hit
+
+
+def measure(name, stream, run, evict=None):
+    tracemalloc.start()
+    started = time.perf_counter()
+    run(stream)
+    elapsed = time.perf_counter() - started
+    if evict is not None:
+        evict(stream[-1][4])
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {name:8s} {elapsed / len(stream) * 1e6:6.2f} us/msg，保留 {current / 1e6:6.1f} MB，峰值 {peak / 1e6:6.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--rate", type=int, default=10_000, help="每秒訊息數（模擬時間）")
+    parser.add_argument("--users", type=int, default=20_000)
+    args = parser.parse_args()
+
+    stream = make_stream(args.messages, args.rate, args.users)
+    print(f"{args.messages:,} 則訊息，{args.rate:,} 則/秒，{args.users:,} 位使用者")
+
+    _, old_count = old_counter()
+    _, new_count = new_counter()
+    _, old_hit = old_hijack()
+    _, new_hit = new_hijack()
+    count_mismatch = sum(old_count(g, u, now) != new_count(g, u, now) for g, u, _, _, now in stream)
+    hijack_mismatch = sum(old_hit(*msg) != new_hit(*msg) for msg in stream)
+    print(f"判定不一致：計數器 {count_mismatch}，反被盜帳 {hijack_mismatch}")
+    an.user_actions.clear()
+    an.hijack_tracker.clear()
+
+    print("訊息計數器")
+    _, old_count = old_counter()
+    measure("v1.3.0", stream, lambda s: [old_count(g, u, now) for g, u, _, _, now in s])
+    _, new_count = new_counter()
+    measure("v1.3.1", stream, lambda s: [new_count(g, u, now) for g, u, _, _, now in s], an.evict_idle_action_counters)
+
+    print("反被盜帳追蹤")
+    _, old_hit = old_hijack()
+    measure("v1.3.0", stream, lambda s: [old_hit(*msg) for msg in s])
+    _, new_hit = new_hijack()
+    measure("v1.3.1", stream, lambda s: [new_hit(*msg) for msg in s], an.evict_idle_hijack_windows)
+
+
+if __name__ == "__main__":
+    main()
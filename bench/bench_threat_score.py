@@ -0,0 +1,93 @@
+"""
+威脅分數與各操作類型獨立計數器的比較：
+
+- 以幾段事件流（攻擊與正常管理操作）比較兩者在第幾秒判定封鎖
+- 量測 track_action 與 score_action 每個事件的耗時
+
+    python bench/bench_threat_score.py [--events 20000]
+"""
+
+import argparse
+import asyncio
+import time
+
+from _antinuke import Fake, load_antinuke
+
+an = load_antinuke()
+
+# (名稱, 是否為攻擊, [(秒, 操作類型)])
+STREAMS = [
+    ("混合攻擊：刪頻道/建身分組/踢人各 6 次，10 秒", True,
+     [(i * 10 / 18, ("channel_delete", "role_create", "member_kick")[i % 3]) for i in range(18)]),
+    ("單一類型：3 秒刪 30 個頻道", True,
+     [(i * 0.1, "channel_delete") for i in range(30)]),
+    ("混合攻擊：封鎖/建 Webhook 各 5 次，5 秒", True,
+     [(i * 0.5, ("member_ban", "webhook_create")[i % 2]) for i in range(10)]),
+    ("慢速混合：3 種操作各 4 次，30 秒", False,
+     [(i * 2.5, ("channel_delete", "role_create", "member_kick")[i % 3]) for i in range(12)]),
+    ("管理員設定：20 秒建 5 個頻道與 5 個身分組", False,
+     [(i * 2, ("channel_create", "role_create")[i % 2]) for i in range(10)]),
+    ("管理員：60 秒封鎖 4 人", False,
+     [(i * 15, "member_ban") for i in range(4)]),
+]
+
+
+def first_hit_counters(stream):
+    """v1.3.0 的判定：每種操作各自一個計數器，任一種在時間窗內超過上限即封鎖。"""
+    counters = {}
+    for at, action in stream:
+        counter = counters.get(action)
+        if counter is None:
+            counter = counters[action] = an.ActionCounter(an.action_counter_capacity())
+        if counter.hit(at, an.PROTECTION_CONFIG["window_seconds"], an.PROTECTION_CONFIG["max_actions"]):
+            return at
+    return None
+
+
+def first_hit_score(stream):
+    """目前的判定：計數器或跨類型威脅分數任一超過上限即封鎖。"""
+    hits = [first_hit_counters(stream)]
+    score = an.ThreatScore()
+    for at, action in stream:
+        if score.add(at, an.THREAT_WEIGHTS.get(action, 0)) > an.THREAT_SCORE_LIMIT:
+            hits.append(at)
+            break
+    hits = [at for at in hits if at is not None]
+    return min(hits) if hits else None
+
+
+def fmt(at):
+    return "不封鎖" if at is None else f"{at:.1f} 秒封鎖"
+
+
+async def per_event_cost(events: int):
+    guild = Fake(id=1, owner_id=0)
+    users = [Fake(id=10_000 + i) for i in range(500)]
+    started = time.perf_counter()
+    for i in range(events):
+        await an.track_action(guild, users[i % len(users)], "channel_delete")
+    counters = (time.perf_counter() - started) / events * 1e6
+    started = time.perf_counter()
+    for i in range(events):
+        an.score_action(guild, users[i % len(users)], "channel_delete")
+    score = (time.perf_counter() - started) / events * 1e6
+    return counters, score
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=20_000)
+    args = parser.parse_args()
+
+    print(f"上限：每種操作 {an.PROTECTION_CONFIG['window_seconds']} 秒內 {an.PROTECTION_CONFIG['max_actions']} 次；"
+          f"威脅分數 {an.THREAT_SCORE_LIMIT}，半衰期 {an.THREAT_SCORE_HALF_LIFE} 秒")
+    for name, attack, stream in STREAMS:
+        label = "攻擊" if attack else "正常"
+        print(f"  [{label}] {name}：計數器 {fmt(first_hit_counters(stream))}，加上威脅分數 {fmt(first_hit_score(stream))}")
+
+    counters, score = asyncio.run(per_event_cost(args.events))
+    print(f"每個事件：track_action {counters:.2f} us，score_action {score:.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+訊息路徑的信任查詢：v1.3.0 的 str(id) 加多次 dict/set 查詢與目前的 trust_flags()。
+
+- 每則訊息的名單檢查（on_message 加上 track_action 內的檢查），對象不在任何名單中
+- 全域名單成員判斷：str(id) 查兩個 dict、int 查 global_trust，以及純 Python 的 3-hash Bloom 過濾器
+
+    python bench/bench_trust_lookup.py [--blacklist 3000] [--whitelist 300] [--number 200000]
+"""
+
+import argparse
+import random
+import time
+import timeit
+
+from _antinuke import Fake, load_antinuke
+
+an = load_antinuke()
+
+
+class BloomFilter:
+    """只用於比較的 3-hash Bloom 過濾器（機器人本身不使用）。"""
+
+    def __init__(self, ids, bits: int = 1 << 16):
+        self.mask = bits - 1
+        self.bits = bytearray(bits // 8)
+        for user_id in ids:
+            for pos in self._positions(user_id):
+                self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def _positions(self, x: int):
+        mask = self.mask
+        return (x * 0x9E3779B97F4A7C15) & mask, (x * 0xC2B2AE3D27D4EB4F >> 7) & mask, (x ^ (x >> 29)) & mask
+
+    def __contains__(self, x: int) -> bool:
+        bits = self.bits
+        for pos in self._positions(x):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+def setup(blacklist: int, whitelist: int, rng: random.Random):
+    for _ in range(blacklist):
+        an.bot_blacklist[str(rng.getrandbits(60))] = {"name": "bench", "reason": "", "timestamp": 0, "guilds_detected": []}
+    for _ in range(whitelist):
+        an.bot_whitelist[str(rng.getrandbits(60))] = {"name": "bench", "reason": "", "timestamp": 0}
+    an.rebuild_global_trust()
+    guild = Fake(id=1, owner_id=5)
+    lists = an.server_whitelists[guild.id]
+    for i in range(20):
+        lists["permanent"].add(i)
+        lists["anti_kick"].add(100 + i)
+    for i in range(50):
+        lists["temporary"][200 + i] = time.time() + 3600
+    an.invalidate_trust_index(guild.id)
+    return guild
+
+
+def v130_message_checks(guild, uid: int):
+    """v1.3.0 on_message 與 track_action 對每則訊息做的名單檢查。"""
+    lists = an.server_whitelists[guild.id]
+    uid_str = str(uid)
+    if uid_str in an.bot_blacklist and uid not in lists["anti_kick"]:
+        return None
+    if uid_str in an.bot_blacklist or uid_str in an.bot_whitelist:
+        return None
+    if uid in lists["permanent"]:
+        return None
+    if uid == guild.owner_id or uid in lists["permanent"]:
+        return None
+    now = time.time()
+    temporary = lists["temporary"]
+    for expired in [u for u, expiry in temporary.items() if expiry <= now]:
+        del temporary[expired]
+    if uid in an.whitelisted_users[guild.id]:
+        return None
+    if str(uid) in an.bot_whitelist:
+        return None
+    for expired in [u for u, expiry in temporary.items() if expiry <= now]:
+        del temporary[expired]
+    return uid in temporary
+
+
+def v131_message_checks(guild, uid: int):
+    flags = an.trust_flags(guild, uid)
+    if flags & an.TRUST_GLOBAL_BLACK and not flags & an.TRUST_ANTI_KICK:
+        return None
+    if flags & (an.TRUST_GLOBAL_BLACK | an.TRUST_GLOBAL_WHITE | an.TRUST_PERMANENT):
+        return None
+    flags = an.trust_flags(guild, uid)
+    if flags & an.TRUST_EXEMPT:
+        return None
+    return bool(flags & an.TRUST_TEMPORARY)
+
+
+def per_call(fn, number: int) -> float:
+    return timeit.timeit(fn, number=number) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--blacklist", type=int, default=3000)
+    parser.add_argument("--whitelist", type=int, default=300)
+    parser.add_argument("--number", type=int, default=200_000)
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    guild = setup(args.blacklist, args.whitelist, rng)
+    uid = rng.getrandbits(60)
+    print(f"全域黑名單 {args.blacklist}、白名單 {args.whitelist}，本伺服器永久/防踢各 20、臨時 50；訊息發送者不在任何名單中")
+
+    print("每則訊息的名單檢查")
+    print(f"  v1.3.0：{per_call(lambda: v130_message_checks(guild, uid), args.number):7.0f} ns")
+    print(f"  v1.3.1：{per_call(lambda: v131_message_checks(guild, uid), args.number):7.0f} ns")
+
+    bloom = BloomFilter(an.global_trust)
+    blacklist, whitelist, global_trust = an.bot_blacklist, an.bot_whitelist, an.global_trust
+    print("全域名單成員判斷")
+    print(f"  str(id) + 兩次 dict 查詢：{per_call(lambda: str(uid) in blacklist or str(uid) in whitelist, args.number * 5):5.0f} ns")
+    print(f"  global_trust.get(id)：    {per_call(lambda: global_trust.get(uid, 0), args.number * 5):5.0f} ns")
+    print(f"  Bloom 過濾器（3 hash）：  {per_call(lambda: uid in bloom, args.number * 5):5.0f} ns")
+
+
+if __name__ == "__main__":
+    main()
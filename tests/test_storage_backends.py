@@ -0,0 +1,310 @@
+"""
+儲存後端測試：每個測試都會在 SQLite 上執行；設定 ANTINUKE_TEST_MYSQL=1 與 MYSQL_* 環境變數後也會在 MySQL 上執行
+（會清空該資料庫內 AntiNuke360 的資料表，請使用獨立的測試資料庫）。
+
+    python -m pytest -q tests
+"""
+
+import importlib.util
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("discord")
+
+# 模組載入時就會連線並載入資料，先把後端與 journal 指到暫存目錄
+_tmp_dir = tempfile.mkdtemp(prefix="antinuke360-test-")
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_tmp_dir, "import.db")
+os.environ["PERSIST_JOURNAL_FILE"] = os.path.join(_tmp_dir, "persist_journal.jsonl")
+
+_spec = importlib.util.spec_from_file_location("antinuke360", Path(__file__).resolve().parent.parent / "AntiNuke360_v1.3.1.py")
+an = importlib.util.module_from_spec(_spec)
+sys.modules["antinuke360"] = an
+_spec.loader.exec_module(an)
+
+TABLES = (
+    "restore_oplog",
+    "restore_runs",
+    "snapshot_generations",
+    "guilds_data",
+    "server_settings",
+    "server_whitelist_entries",
+    "bot_whitelist",
+    "bot_blacklist",
+)
+
+BACKENDS = ["sqlite", "mysql"]
+
+
+def wipe(backend):
+    with backend.connection() as conn:
+        cursor = conn.cursor()
+        for table in TABLES:
+            cursor.execute(f"DELETE FROM {table}")
+        conn.commit()
+        cursor.close()
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        storage = an.SQLiteStorageBackend(str(tmp_path / "storage.db"))
+    else:
+        if os.getenv("ANTINUKE_TEST_MYSQL") != "1" or an.mysql is None:
+            pytest.skip("設定 ANTINUKE_TEST_MYSQL=1 與 MYSQL_* 後才會測試 MySQL")
+        storage = an.MySQLStorageBackend()
+    storage.ensure_schema()
+    wipe(storage)
+    yield storage
+    wipe(storage)
+
+
+def blacklist_row(bot_id, name="nuker", guilds=(1,)):
+    return an.blacklist_row(str(bot_id), {"name": name, "reason": "test", "timestamp": 100.0, "guilds_detected": list(guilds)})
+
+
+# ========== 全域黑白名單 ==========
+
+def test_blacklist_upsert_and_delete(backend):
+    backend.bulk_upsert("blacklist", [blacklist_row(1001), blacklist_row(1002)])
+    backend.bulk_upsert("blacklist", [blacklist_row(1001, name="renamed", guilds=(1, 2))])
+    data = backend.load_blacklist()
+    assert set(data) == {"1001", "1002"}
+    assert data["1001"]["name"] == "renamed"
+    assert data["1001"]["guilds_detected"] == [1, 2]
+    assert data["1001"]["timestamp"] == 100.0
+
+    backend.write_batch({("blacklist", 1002): ("delete", (1002,))})
+    assert set(backend.load_blacklist()) == {"1001"}
+
+
+def test_whitelist_upsert_and_delete(backend):
+    rows = [(2001, "good bot", "trusted", 50.0), (2002, "other", "", None)]
+    backend.bulk_upsert("whitelist", rows)
+    data = backend.load_whitelist()
+    assert data["2001"] == {"name": "good bot", "reason": "trusted", "timestamp": 50.0}
+    assert data["2002"]["timestamp"] == 0
+
+    backend.write_batch({("whitelist", 2001): ("delete", (2001,))})
+    assert set(backend.load_whitelist()) == {"2002"}
+
+
+def test_server_whitelist_drops_expired_temporary(backend):
+    now = time.time()
+    backend.write_batch({
+        ("server_whitelist", 1, "permanent", 10): ("upsert", (1, "permanent", 10, None)),
+        ("server_whitelist", 1, "temporary", 11): ("upsert", (1, "temporary", 11, now - 5)),
+        ("server_whitelist", 1, "temporary", 12): ("upsert", (1, "temporary", 12, now + 600)),
+        ("server_settings", 1): ("upsert", (1, 555)),
+    })
+    entries, settings = backend.load_server_whitelist(now)
+    assert {(e["list_type"], e["user_id"]) for e in entries} == {("permanent", 10), ("temporary", 12)}
+    assert [(s["guild_id"], s["log_channel_id"]) for s in settings] == [(1, 555)]
+
+    # 過期的臨時白名單已在讀取時刪除
+    entries, _ = backend.load_server_whitelist(now - 60)
+    assert ("temporary", 11) not in {(e["list_type"], e["user_id"]) for e in entries}
+
+
+def test_guilds_data_roundtrip(backend):
+    backend.write_batch({
+        ("guilds", 1): ("upsert", (1, 123.0, 999)),
+        ("guilds", 2): ("upsert", (2, 456.0, None)),
+    })
+    data = backend.load_guilds_data()
+    assert data["1"] == {"joined_at": 123.0, "welcome_channel_id": 999}
+    assert data["2"]["welcome_channel_id"] is None
+
+    backend.write_batch({("guilds", 2): ("delete", (2,))})
+    assert set(backend.load_guilds_data()) == {"1"}
+
+
+# ========== write-behind 批次順序 ==========
+
+def test_guild_reset_runs_before_upserts_in_same_batch(backend):
+    backend.write_batch({
+        ("server_whitelist", 1, "permanent", 10): ("upsert", (1, "permanent", 10, None)),
+        ("server_settings", 1): ("upsert", (1, 555)),
+    })
+    # 同一批次：先清空整個伺服器，再寫入新資料；新資料必須留下
+    batch = {}
+    batch[("server_whitelist", 1, "permanent", 20)] = ("upsert", (1, "permanent", 20, None))
+    batch[("server_settings", 1)] = ("upsert", (1, 777))
+    batch[("server_guild", 1)] = ("delete", (1,))
+    backend.write_batch(batch)
+
+    entries, settings = backend.load_server_whitelist(time.time())
+    assert [(e["list_type"], e["user_id"]) for e in entries] == [("permanent", 20)]
+    assert [s["log_channel_id"] for s in settings] == [777]
+
+
+def test_deletes_and_upserts_of_different_kinds_in_one_batch(backend):
+    backend.bulk_upsert("blacklist", [blacklist_row(1001)])
+    backend.write_batch({
+        ("blacklist", 1001): ("delete", (1001,)),
+        ("whitelist", 1001): ("upsert", (1001, "moved", "", 1.0)),
+        ("server_whitelist", 1, "anti_kick", 5): ("delete", (1, "anti_kick", 5)),
+    })
+    assert backend.load_blacklist() == {}
+    assert set(backend.load_whitelist()) == {"1001"}
+
+
+def test_failed_batch_is_rolled_back(backend):
+    backend.bulk_upsert("blacklist", [blacklist_row(1001)])
+    with pytest.raises(an.DB_ERRORS):
+        # 第二列缺少欄位，整批都不應寫入
+        backend.write_batch({
+            ("blacklist", 1001): ("delete", (1001,)),
+            ("whitelist", 2001): ("upsert", (2001, "ok", "", 1.0)),
+            ("whitelist", 2002): ("upsert", (2002, None, "", 1.0)),
+        })
+    assert set(backend.load_blacklist()) == {"1001"}
+    assert backend.load_whitelist() == {}
+
+
+# ========== 快照 ==========
+
+def test_snapshot_generations_trimmed_to_keep(backend):
+    ids = [backend.save_snapshot(1, 2, f"full-{i}".encode(), 100, 1000.0 + i, keep=3) for i in range(5)]
+    listed = backend.list_snapshots(1)
+    assert [row["id"] for row in listed] == ids[:1:-1]
+
+    latest = backend.load_snapshot(1)
+    assert latest["id"] == ids[-1]
+    assert bytes(latest["snapshot_data"]) == b"full-4"
+    assert backend.load_snapshot(1, ids[0]) is None
+    assert backend.latest_snapshot_meta(1)["id"] == ids[-1]
+    assert backend.latest_snapshot_meta(2) is None
+
+
+def test_snapshot_trim_keeps_referenced_base(backend):
+    base_id = backend.save_snapshot(1, 2, b"base", 100, 1000.0, keep=2, struct_hash="h")
+    delta_ids = [
+        backend.save_snapshot(1, 2, f"delta-{i}".encode(), 10, 1001.0 + i, keep=2, base_id=base_id, struct_hash="h")
+        for i in range(4)
+    ]
+    listed = {row["id"] for row in backend.list_snapshots(1)}
+    assert listed == {base_id, delta_ids[-1], delta_ids[-2]}
+
+    delta = backend.load_snapshot(1, delta_ids[-1])
+    assert delta["base_id"] == base_id
+    assert bytes(delta["base"]["snapshot_data"]) == b"base"
+
+    # 新的完整快照取代基底後，舊基底與其增量一起被淘汰
+    full_ids = [backend.save_snapshot(1, 2, f"full-{i}".encode(), 100, 2000.0 + i, keep=2) for i in range(2)]
+    assert {row["id"] for row in backend.list_snapshots(1)} == set(full_ids)
+
+
+def test_touch_snapshot_moves_generation_forward(backend):
+    first = backend.save_snapshot(1, 2, b"a", 1, 1000.0, keep=5)
+    second = backend.save_snapshot(1, 2, b"b", 1, 1001.0, keep=5)
+    assert backend.latest_snapshot_meta(1)["id"] == second
+    backend.touch_snapshot(first, 1002.0)
+    meta = backend.latest_snapshot_meta(1)
+    assert meta["id"] == first
+    assert meta["created_at"] == 1002.0
+
+
+def test_touch_only_checkpoints_do_not_use_retention(backend):
+    ids = [backend.save_snapshot(1, 2, f"full-{i}".encode(), 100, 1000.0 + i, keep=3) for i in range(3)]
+    for i in range(10):
+        backend.touch_snapshot(ids[-1], 2000.0 + i)
+    assert {row["id"] for row in backend.list_snapshots(1)} == set(ids)
+
+
+def test_pinned_generation_survives_trim(backend):
+    pinned = backend.save_snapshot(1, 2, b"base", 100, 1000.0, keep=2)
+    delta = backend.save_snapshot(1, 2, b"good", 10, 1001.0, keep=2, base_id=pinned)
+    backend.save_snapshot(1, 2, b"full", 100, 1002.0, keep=2)
+    ids = [backend.save_snapshot(1, 2, f"after-{i}".encode(), 100, 1003.0 + i, keep=2, pinned=delta) for i in range(5)]
+    # 被釘選的增量與其基底都保留，且不佔 keep 的名額
+    assert {row["id"] for row in backend.list_snapshots(1)} == {pinned, delta, ids[-1], ids[-2]}
+    assert bytes(backend.load_snapshot(1, delta)["base"]["snapshot_data"]) == b"base"
+
+
+def test_expire_snapshots_keeps_base_of_live_delta(backend):
+    base_id = backend.save_snapshot(1, 2, b"base", 100, 1000.0, keep=10)
+    delta_id = backend.save_snapshot(1, 2, b"delta", 10, 5000.0, keep=10, base_id=base_id)
+    old_ids = [backend.save_snapshot(2, 2, b"old", 100, 1000.0 + i, keep=10) for i in range(5)]
+
+    deleted = backend.delete_expired_snapshots(cutoff=4000.0, batch_size=2)
+    assert deleted == len(old_ids)
+    assert backend.list_snapshots(2) == []
+    assert {row["id"] for row in backend.list_snapshots(1)} == {base_id, delta_id}
+
+    # 增量本身也過期後，基底一併刪除
+    assert backend.delete_expired_snapshots(cutoff=6000.0, batch_size=2) == 2
+    assert backend.list_snapshots(1) == []
+
+
+def test_snapshot_totals(backend):
+    assert backend.snapshot_totals() == {"count": 0, "raw_size": 0, "stored_size": 0}
+    backend.save_snapshot(1, 2, b"12345", 50, 1000.0, keep=5)
+    backend.save_snapshot(2, 2, b"123", 30, 1000.0, keep=5)
+    assert backend.snapshot_totals() == {"count": 2, "raw_size": 80, "stored_size": 8}
+
+
+def test_legacy_snapshots_migrated_once(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE snapshots (guild_id INTEGER PRIMARY KEY, snapshot_json TEXT, updated_at REAL)")
+    conn.execute("INSERT INTO snapshots VALUES (1, '{}', 1000.0)")
+    conn.commit()
+    conn.close()
+
+    storage = an.SQLiteStorageBackend(path)
+    storage.ensure_schema()
+    assert len(storage.list_snapshots(1)) == 1
+
+    # 世代全部過期後重新啟動，舊快照不會再被搬回來
+    storage.delete_expired_snapshots(cutoff=2000.0, batch_size=10)
+    storage = an.SQLiteStorageBackend(path)
+    storage.ensure_schema()
+    assert storage.list_snapshots(1) == []
+    with storage.connection() as conn:
+        assert not storage.table_exists(conn, "snapshots")
+        assert storage.table_exists(conn, "snapshots_legacy")
+
+
+# ========== 還原進度 ==========
+
+def test_restore_run_and_oplog(backend):
+    backend.start_restore_run(1, "plan-a", 42, "full", 1000.0)
+    backend.record_restore_ops(1, "plan-a", [("role:1", 111, 1001.0), ("channel:2", 222, 1002.0)])
+    backend.record_restore_ops(1, "plan-a", [("role:1", 333, 1003.0)])
+    runs = backend.load_restore_runs()
+    assert len(runs) == 1
+    run = runs[0]
+    assert (run["guild_id"], run["plan_id"], run["snapshot_id"], run["mode"]) == (1, "plan-a", 42, "full")
+    assert run["ops"] == {"role:1": 333, "channel:2": 222}
+
+    # 同一伺服器重新開始還原會取代舊紀錄並清空操作紀錄
+    backend.start_restore_run(1, "plan-b", 43, "roles", 2000.0)
+    backend.start_restore_run(2, "plan-c", None, "full", 2000.0)
+    run = backend.load_restore_runs(1)[0]
+    assert run["plan_id"] == "plan-b"
+    assert run["ops"] == {}
+    assert len(backend.load_restore_runs()) == 2
+
+    backend.finish_restore_run(1, "plan-b")
+    assert backend.load_restore_runs(1) == []
+    assert [r["guild_id"] for r in backend.load_restore_runs()] == [2]
+
+
+# ========== 吞吐量 ==========
+
+def test_write_batch_throughput(backend):
+    rows = 5000
+    batch = {("blacklist", 10_000 + i): ("upsert", blacklist_row(10_000 + i)) for i in range(rows)}
+    started = time.perf_counter()
+    backend.write_batch(batch)
+    elapsed = time.perf_counter() - started
+    print(f"\n[{backend.label}] write_batch {rows} 筆：{elapsed:.3f} 秒（{rows / elapsed:,.0f} 筆/秒）")
+    assert len(backend.load_blacklist()) == rows
+    assert elapsed < 10